@@ -6,20 +6,36 @@ from google.oauth2 import service_account
 import gspread
 import pytz
 import json
+import unicodedata
+import hashlib
 import altair as alt
 import io
+import os
+import re
+import threading
+import logging
+import heapq
+import itertools
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import plotly.graph_objects as go
 import plotly.express as px
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+
+logger = logging.getLogger(__name__)
 
 # ── Imports pour organigrammes annotés ────────────────────────────────────────
 try:
     import pypdfium2 as _pdfium
-    from PIL import Image as _PILImage, ImageDraw as _PILDraw, ImageFont as _PILFont
+    import organigramme_rendu as _rendu
     _HAS_PDF_ANNOTE = True
 except ImportError:
     _HAS_PDF_ANNOTE = False
 
+from export_excel import to_excel, to_excel_sheets
+
 
 # --- CONFIGURATION DE LA PAGE ---
 st.set_page_config(
@@ -82,6 +98,13 @@ def init_session_state():
     if 'last_save_time' not in st.session_state:
         st.session_state.last_save_time = None
     
+    # Identifiant de la session (échecs d'écriture confirmés en arrière-plan)
+    if 'session_uid' not in st.session_state:
+        st.session_state.session_uid = uuid.uuid4().hex
+    
+    if 'last_page' not in st.session_state:
+        st.session_state.last_page = None
+    
     if 'show_fiche_detail' not in st.session_state:
         st.session_state.show_fiche_detail = False
     
@@ -114,465 +137,1458 @@ def get_gsheet_connection():
         st.error(f"Erreur de configuration des credentials : {str(e)}")
         return None
 
-def api_call_with_retry(func, max_retries=5, initial_delay=1):
+# --- RÉGULATION DU QUOTA GOOGLE SHEETS (token bucket) ---
+# Quotas par minute du compte de service (lectures / écritures)
+SHEETS_READ_QUOTA_PER_MINUTE = 60
+SHEETS_WRITE_QUOTA_PER_MINUTE = 60
+# Rafale autorisée : le débit de recharge est réduit d'autant, pour que
+# rafale + recharge sur 60 s ne dépasse jamais le quota
+SHEETS_BURST = 10
+
+# Priorités d'accès au quota (la plus petite passe en premier)
+PRIORITY_INTERACTIVE = 0   # sauvegardes, décisions, lectures demandées par un utilisateur
+PRIORITY_BACKGROUND = 1    # relectures de cache en arrière-plan
+
+@st.cache_resource(show_spinner=False)
+def get_sheets_governor():
     """
-    Exécute un appel API avec retry et backoff exponentiel
-    pour gérer les limites de quota Google Sheets
+    Régulateur unique de tous les appels Google Sheets du processus.
+    Un seau de jetons par type d'appel (lecture / écriture), une file
+    par priorité : un appel attend son jeton au lieu de provoquer un 429.
     """
-    import time
-    import random
-    
+    now = time.time()
+
+    def bucket(quota):
+        return {
+            "capacity": SHEETS_BURST,
+            "tokens": float(SHEETS_BURST),
+            "rate": (quota - SHEETS_BURST) / 60.0,   # jetons par seconde
+            "quota": quota,
+            "updated": now,
+            "queue": [],                              # tas de (priorité, ordre d'arrivée)
+            "history": deque(),                       # horodatage des appels de la dernière minute
+            "calls": 0,
+            "waited": 0.0,
+            "throttled": 0,                           # 429 reçus malgré tout (quota partagé)
+        }
+
+    return {
+        "cond": threading.Condition(),
+        "seq": itertools.count(),
+        "buckets": {
+            "read": bucket(SHEETS_READ_QUOTA_PER_MINUTE),
+            "write": bucket(SHEETS_WRITE_QUOTA_PER_MINUTE),
+        },
+    }
+
+def _refill_bucket(bucket, now):
+    bucket["tokens"] = min(bucket["capacity"], bucket["tokens"] + (now - bucket["updated"]) * bucket["rate"])
+    bucket["updated"] = now
+    while bucket["history"] and bucket["history"][0] < now - 60:
+        bucket["history"].popleft()
+
+def _acquire_sheets_token(kind, priority):
+    """Attend son tour (priorité puis ordre d'arrivée) et un jeton disponible"""
+    governor = get_sheets_governor()
+    bucket = governor["buckets"][kind]
+    cond = governor["cond"]
+    with cond:
+        ticket = (priority, next(governor["seq"]))
+        heapq.heappush(bucket["queue"], ticket)
+        start = time.time()
+        obtenu = False
+        try:
+            while True:
+                now = time.time()
+                _refill_bucket(bucket, now)
+                if bucket["queue"][0] == ticket and bucket["tokens"] >= 1:
+                    heapq.heappop(bucket["queue"])
+                    obtenu = True
+                    bucket["tokens"] -= 1
+                    bucket["history"].append(now)
+                    bucket["calls"] += 1
+                    bucket["waited"] += now - start
+                    cond.notify_all()
+                    return
+                if bucket["queue"][0] == ticket:
+                    cond.wait((1 - bucket["tokens"]) / bucket["rate"])
+                else:
+                    cond.wait(1.0)
+        finally:
+            if not obtenu:
+                # Attente interrompue (rerun Streamlit, arrêt du thread...) : le ticket
+                # ne doit pas rester en tête de file et bloquer tous les appels suivants
+                bucket["queue"].remove(ticket)
+                heapq.heapify(bucket["queue"])
+                cond.notify_all()
+
+def sheets_call(func, kind="read", priority=None, max_retries=3):
+    """
+    Exécute un appel Google Sheets après avoir obtenu un jeton du régulateur.
+    kind : "read" ou "write". Sans priorité explicite, un appel fait depuis le
+    script est interactif et un appel fait depuis un thread de fond ne l'est pas.
+    """
+    if priority is None:
+        in_script = get_script_run_ctx(suppress_warning=True) is not None
+        priority = PRIORITY_INTERACTIVE if in_script else PRIORITY_BACKGROUND
+
     for attempt in range(max_retries):
+        _acquire_sheets_token(kind, priority)
         try:
             return func()
         except gspread.exceptions.APIError as e:
-            if e.response.status_code == 429:
-                if attempt < max_retries - 1:
-                    delay = initial_delay * (2 ** attempt) + random.uniform(0, 1)
-                    st.warning(f"⏳ Limite de quota API atteinte. Nouvelle tentative dans {delay:.1f}s...")
-                    time.sleep(delay)
-                    continue
-                else:
-                    st.error("❌ Impossible de charger les données après plusieurs tentatives. Veuillez réessayer dans quelques minutes.")
-                    raise
-            else:
+            if e.response.status_code != 429 or attempt == max_retries - 1:
                 raise
-        except Exception as e:
-            raise
-    
-    return None
+            # Quota consommé ailleurs (autre application, édition manuelle) :
+            # on vide le seau pour que tous les appelants ralentissent ensemble
+            governor = get_sheets_governor()
+            with governor["cond"]:
+                bucket = governor["buckets"][kind]
+                bucket["tokens"] = min(bucket["tokens"], 0.0)
+                bucket["throttled"] += 1
+
+def get_sheets_usage():
+    """Consommation actuelle du quota, par type d'appel"""
+    governor = get_sheets_governor()
+    usage = {}
+    with governor["cond"]:
+        now = time.time()
+        for kind, bucket in governor["buckets"].items():
+            _refill_bucket(bucket, now)
+            usage[kind] = {
+                "last_minute": len(bucket["history"]),
+                "quota": bucket["quota"],
+                "tokens": bucket["tokens"],
+                "queued": len(bucket["queue"]),
+                "calls": bucket["calls"],
+                "avg_wait": bucket["waited"] / bucket["calls"] if bucket["calls"] else 0.0,
+                "throttled": bucket["throttled"],
+            }
+    return usage
 
-@st.cache_data(ttl=60)
-def load_data_from_gsheet(_client, sheet_url):
+# --- REGISTRE DES ONGLETS (Spreadsheet / Worksheet / en-têtes mis en cache) ---
+@st.cache_resource(show_spinner=False)
+def get_worksheet_registry():
     """
-    Charge les données depuis Google Sheets avec gestion du quota.
-    Onglets : CAP 2025 (collaborateurs) et Postes (référentiel)
+    Objets gspread partagés par toutes les sessions : le classeur et chaque onglet
+    ne sont ouverts qu'une fois (open_by_url et worksheet() coûtent chacun une
+    lecture de métadonnées). Les lignes d'en-têtes sont aussi mémorisées.
+    """
+    return {
+        "lock": threading.RLock(),
+        "spreadsheets": {},   # sheet_url → Spreadsheet
+        "worksheets": {},     # (sheet_url, onglet) → Worksheet
+        "headers": {},        # (sheet_url, onglet, ligne) → [en-têtes]
+    }
+
+def get_spreadsheet(_client, sheet_url, priority=None):
+    registry = get_worksheet_registry()
+    with registry["lock"]:
+        spreadsheet = registry["spreadsheets"].get(sheet_url)
+    if spreadsheet is None:
+        spreadsheet = sheets_call(lambda: _client.open_by_url(sheet_url), priority=priority)
+        with registry["lock"]:
+            registry["spreadsheets"][sheet_url] = spreadsheet
+    return spreadsheet
+
+def get_worksheet(_client, sheet_url, title, priority=None):
+    """Onglet `title` du classeur ; lève gspread.WorksheetNotFound s'il n'existe pas"""
+    registry = get_worksheet_registry()
+    key = (sheet_url, title)
+    with registry["lock"]:
+        worksheet = registry["worksheets"].get(key)
+    if worksheet is None:
+        spreadsheet = get_spreadsheet(_client, sheet_url, priority=priority)
+        worksheet = sheets_call(lambda: spreadsheet.worksheet(title), priority=priority)
+        with registry["lock"]:
+            registry["worksheets"][key] = worksheet
+    return worksheet
+
+def register_worksheet(sheet_url, worksheet):
+    """Enregistre un onglet tout juste créé (add_worksheet)"""
+    registry = get_worksheet_registry()
+    with registry["lock"]:
+        registry["worksheets"][(sheet_url, worksheet.title)] = worksheet
+
+def get_sheet_headers(_client, sheet_url, title, header_row=1, priority=None, refresh=False):
+    """En-têtes de l'onglet (liste, colonne = position + 1), lus une seule fois"""
+    registry = get_worksheet_registry()
+    key = (sheet_url, title, header_row)
+    with registry["lock"]:
+        headers = None if refresh else registry["headers"].get(key)
+    if headers is None:
+        worksheet = get_worksheet(_client, sheet_url, title, priority=priority)
+        headers = sheets_call(lambda: worksheet.row_values(header_row), priority=priority)
+        with registry["lock"]:
+            registry["headers"][key] = headers
+    return list(headers)
+
+def remember_sheet_headers(sheet_url, title, header_row, headers):
+    """Met à jour les en-têtes mémorisés à partir d'une lecture complète de l'onglet"""
+    registry = get_worksheet_registry()
+    with registry["lock"]:
+        registry["headers"][(sheet_url, title, header_row)] = list(headers)
+
+def register_sheet_header(sheet_url, title, header_row, header):
+    """Ajoute une colonne créée par l'application à la fin des en-têtes mémorisés"""
+    registry = get_worksheet_registry()
+    with registry["lock"]:
+        headers = registry["headers"].get((sheet_url, title, header_row))
+        if headers is not None and header not in headers:
+            headers.append(header)
+
+def invalidate_worksheet(sheet_url, title=None):
+    """
+    Oublie les objets mis en cache (onglet renommé/supprimé, colonnes déplacées) :
+    ils seront relus au prochain accès.
+    """
+    registry = get_worksheet_registry()
+    with registry["lock"]:
+        if title is None:
+            registry["spreadsheets"].pop(sheet_url, None)
+        for key in [k for k in registry["worksheets"] if k[0] == sheet_url and title in (None, k[1])]:
+            del registry["worksheets"][key]
+        for key in [k for k in registry["headers"] if k[0] == sheet_url and title in (None, k[1])]:
+            del registry["headers"][key]
+
+# --- CACHE NOMMÉ DES DONNÉES (invalidation ciblée) ---
+# Durée de validité des données lues dans Google Sheets
+DATA_CACHE_TTL_SECONDS = 60
+
+# Jeux de données dérivés à invalider quand une source change
+_CACHE_DEPENDANCES = {
+    "cap2025": ("agregats", "index_candidats", "analyse_postes", "treemaps", "sankey",
+                "retenus_annotes", "retenus_dynamiques"),
+    "postes": ("agregats", "analyse_postes", "treemaps", "sankey", "resolveur_postes"),
+    "entretiens": ("entretiens_index",),
+}
+
+@st.cache_resource(show_spinner=False)
+def get_data_store(sheet_url):
+    """
+    Cache partagé par toutes les sessions, une entrée nommée par jeu de données
+    ("cap2025", "postes", "agregats"...). Chaque entrée porte un numéro de version :
+    une écriture n'invalide que le jeu touché et ceux qui en dépendent.
+    Un seul chargement par jeu est en cours à un instant donné (single-flight) ;
+    une entrée expirée reste servie pendant sa relecture en arrière-plan.
+    """
+    return {
+        "lock": threading.RLock(),
+        "entries": {},
+        "next_version": 1,
+        "inflight": {},      # nom → {"event", "generation", "error"}
+        "generations": {},   # nom → compteur incrémenté à chaque invalidation / modification locale
+        "content_memo": {},  # nom → (empreinte du contenu des sources, valeur calculée)
+        "memoire": {},       # nom → (octets avant, octets après compactage)
+        "pending_cap2025": {},       # n° d'écriture → {"matricule", "values"} non encore confirmée
+        "next_pending_cap2025": 1,
+    }
+
+def _store_dataset(store, name, value, sources=None, version=None):
+    with store["lock"]:
+        now = time.time()
+        if version is None:
+            version = store["next_version"]
+        entry = {
+            "value": value,
+            "version": version,
+            "loaded_at": now,
+            "checked_at": now,
+            "sources": sources,
+            "error": None,
+        }
+        store["next_version"] += 1
+        store["entries"][name] = entry
+        return entry
+
+def _bump_generation(store, name):
+    """Rend caduc tout chargement en cours de `name` (son résultat serait antérieur)"""
+    with store["lock"]:
+        store["generations"][name] = store["generations"].get(name, 0) + 1
+
+def _dataset_copy(value):
+    """Copie rendue au script : les pages modifient leurs DataFrames sans toucher au cache partagé"""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.copy()
+    if isinstance(value, tuple):
+        return tuple(_dataset_copy(v) for v in value)
+    if isinstance(value, list):
+        return [dict(v) if isinstance(v, dict) else v for v in value]
+    return value
+
+def _run_dataset_loader(store, names, loader, flight):
+    """
+    Exécute un chargement et publie son résultat, sauf pour les jeux rendus caducs
+    entre-temps. Pour un groupe de jeux, `loader()` retourne {nom: valeur} et tous
+    sont publiés avec le même numéro de version (un seul instantané cohérent).
     """
     try:
-        spreadsheet = api_call_with_retry(lambda: _client.open_by_url(sheet_url))
+        values = loader() if len(names) > 1 else {names[0]: loader()}
+        with store["lock"]:
+            version = store["next_version"]
+            for name, value in values.items():
+                if store["generations"].get(name, 0) == flight["generations"].get(name, 0):
+                    if name == "cap2025":
+                        value = _reapply_pending_cap2025(store, value)
+                    _store_dataset(store, name, value, version=version)
     except Exception as e:
-        st.error(f"Impossible d'ouvrir le Google Sheet : {str(e)}")
-        return pd.DataFrame(), pd.DataFrame()
-    
-    # Charger l'onglet "CAP 2025" (collaborateurs)
+        flight["error"] = e
+        with store["lock"]:
+            for name in names:
+                entry = store["entries"].get(name)
+                if entry is not None:
+                    # On garde la dernière version valide ; nouvel essai après un TTL
+                    entry["checked_at"] = time.time()
+                    entry["error"] = str(e)
+    finally:
+        with store["lock"]:
+            for name in names:
+                if store["inflight"].get(name) is flight:
+                    del store["inflight"][name]
+        flight["event"].set()
+
+def _start_flight(store, names):
+    with store["lock"]:
+        flight = {
+            "event": threading.Event(),
+            "generations": {name: store["generations"].get(name, 0) for name in names},
+            "error": None,
+        }
+        for name in names:
+            store["inflight"][name] = flight
+        return flight
+
+def record_versions(versions, names, values):
+    """
+    Note dans le dictionnaire `versions` (s'il est fourni) la version servie de chaque jeu.
+    Deux versions différentes d'un même jeu dans un calcul : None (instantané mélangé).
+    """
+    if versions is None:
+        return
+    for name, version in zip(names, values):
+        versions[name] = version if versions.get(name, version) == version else None
+
+def cached_dataset(sheet_url, name, loader, ttl=DATA_CACHE_TTL_SECONDS, group=None, copy=True, versions=None):
+    """
+    Retourne le jeu de données `name`.
+    - présent et récent : servi tel quel ;
+    - expiré : la dernière version est servie immédiatement, une seule relecture
+      est lancée en arrière-plan pour toutes les sessions ;
+    - absent : un seul appelant charge, les autres attendent son résultat.
+    Avec `group` (tuple de noms), `loader()` charge tous les jeux du groupe d'un coup
+    et une seule relecture sert tous les jeux du groupe.
+    Avec copy=False, la valeur partagée est rendue telle quelle (lecture seule).
+    `versions` (optionnel) : dictionnaire où noter la version servie (voir record_versions).
+    Un échec du chargement n'est jamais mis en cache.
+    """
+    result = _dataset_copy if copy else (lambda value: value)
+    store = get_data_store(sheet_url)
+    names = tuple(group) if group else (name,)
+    while True:
+        with store["lock"]:
+            entry = store["entries"].get(name)
+            flight = store["inflight"].get(name)
+            if flight is not None and flight["generations"].get(name) != store["generations"].get(name, 0):
+                flight = None   # chargement caduc : son résultat sera ignoré
+            leader = False
+            if entry is not None:
+                if flight is None and time.time() - entry["checked_at"] >= ttl:
+                    flight = _start_flight(store, names)
+                    threading.Thread(
+                        target=_run_dataset_loader, args=(store, names, loader, flight),
+                        name=f"refresh-{name}", daemon=True
+                    ).start()
+                record_versions(versions, (name,), (entry["version"],))
+                return result(entry["value"])
+            if flight is None:
+                flight = _start_flight(store, names)
+                leader = True
+
+        if leader:
+            _run_dataset_loader(store, names, loader, flight)
+        else:
+            flight["event"].wait()
+
+        with store["lock"]:
+            entry = store["entries"].get(name)
+        if entry is not None:
+            record_versions(versions, (name,), (entry["version"],))
+            return result(entry["value"])
+        if flight["error"] is not None:
+            raise flight["error"]
+        # Chargement rendu caduc par une invalidation : on recommence
+
+def get_dataset_age(sheet_url, *names):
+    """Âge (secondes) de la plus ancienne des versions servies, et relecture en cours ou non"""
+    store = get_data_store(sheet_url)
+    with store["lock"]:
+        loaded = [store["entries"][n]["loaded_at"] for n in names if n in store["entries"]]
+        refreshing = any(n in store["inflight"] for n in names)
+        errors = [store["entries"][n]["error"] for n in names if n in store["entries"] and store["entries"][n]["error"]]
+    age = time.time() - min(loaded) if loaded else None
+    return age, refreshing, errors
+
+def derived_dataset(sheet_url, name, sources, compute, copy=True, content_key=None, defaults=None, versions=None):
+    """
+    Retourne un jeu calculé à partir d'autres jeux du cache ; recalculé
+    seulement si la version d'une de ses sources a changé.
+    `compute` reçoit les valeurs des sources (dans la version utilisée pour la clé).
+    `content_key(*sources)` (optionnel) : empreinte du contenu utile des sources ;
+    une nouvelle version au contenu identique (relecture, écriture sans effet
+    sur le calcul) réutilise alors le dernier résultat au lieu de le recalculer.
+    `defaults` (optionnel) : valeurs à utiliser pour les sources absentes du cache
+    (invalidées entre-temps) ; le résultat est alors calculé sans être mémorisé.
+    `versions` (optionnel) : dictionnaire où noter la version de chaque source utilisée
+    (voir record_versions).
+    """
+    store = get_data_store(sheet_url)
+    with store["lock"]:
+        source_versions = tuple(
+            store["entries"][src]["version"] if src in store["entries"] else None
+            for src in sources
+        )
+        source_values = [
+            store["entries"][src]["value"] if src in store["entries"] else None
+            for src in sources
+        ]
+        entry = store["entries"].get(name)
+    record_versions(versions, sources, source_versions)
+    if defaults is not None and None in source_versions:
+        values = [default if version is None else value
+                  for value, version, default in zip(source_values, source_versions, defaults)]
+        return compute(*values)
+    if entry is None or entry["sources"] != source_versions:
+        if content_key is None:
+            value = compute(*source_values)
+        else:
+            key = content_key(*source_values)
+            with store["lock"]:
+                memo = store["content_memo"].get(name)
+            if memo is not None and memo[0] == key:
+                value = memo[1]
+            else:
+                value = compute(*source_values)
+                with store["lock"]:
+                    store["content_memo"][name] = (key, value)
+        entry = _store_dataset(store, name, value, sources=source_versions)
+    return _dataset_copy(entry["value"]) if copy else entry["value"]
+
+def _replace_dataset_value(store, name, value):
+    """
+    Remplace la valeur d'un jeu modifié localement (après une écriture de l'application) :
+    nouvelle version pour les jeux dérivés, relecture en cours rendue caduque.
+    """
+    with store["lock"]:
+        entry = store["entries"][name]
+        store["entries"][name] = dict(entry, value=value, version=store["next_version"])
+        store["next_version"] += 1
+        _bump_generation(store, name)
+        for dependant in _CACHE_DEPENDANCES.get(name, ()):
+            invalidate_dataset_entry(store, dependant)
+
+def get_dataset_version(sheet_url, name):
+    store = get_data_store(sheet_url)
+    with store["lock"]:
+        entry = store["entries"].get(name)
+        return entry["version"] if entry else None
+
+def invalidate_dataset_entry(store, name):
+    """Supprime le jeu `name` et, en cascade, les jeux qui en dépendent"""
+    with store["lock"]:
+        store["entries"].pop(name, None)
+        _bump_generation(store, name)
+        for dependant in _CACHE_DEPENDANCES.get(name, ()):
+            invalidate_dataset_entry(store, dependant)
+
+def snapshot_hash(*frames):
+    """Empreinte du contenu (en-têtes et valeurs) d'un ou plusieurs DataFrames"""
+    digest = hashlib.sha1()
+    for df in frames:
+        digest.update(repr(list(df.columns)).encode("utf-8"))
+        digest.update(pd.util.hash_pandas_object(df.astype(str), index=False).values.tobytes())
+    return digest.hexdigest()
+
+def invalidate_dataset(sheet_url, name):
+    invalidate_dataset_entry(get_data_store(sheet_url), name)
+
+def invalidate_all_datasets(sheet_url):
+    store = get_data_store(sheet_url)
+    with store["lock"]:
+        for name in list(store["entries"]) + list(store["inflight"]):
+            _bump_generation(store, name)
+        store["entries"].clear()
+
+# Onglets lus ensemble au démarrage (un seul values_batch_get) et jeux de données correspondants
+BOOTSTRAP_TABS = ("CAP 2025", "Postes", "Entretien RH")
+BOOTSTRAP_DATASETS = ("cap2025", "postes", "entretiens")
+
+# --- SCHÉMA CANONIQUE DES ONGLETS ---
+# En-têtes « Vœux n » / « Voeux n » / « Vœux Retenu », quelle que soit leur graphie dans la feuille
+_VOEU_HEADER = re.compile(r"^v(?:œ|oe)ux\s+(\d|retenu)$", re.IGNORECASE)
+
+# Marqueur saisi dans CAP 2025 à la place d'un vœu
+VOEU_MANQUANT = "Positionnement manquant"
+
+def canonical_column(name):
+    """Nom canonique d'une colonne : espaces superflus retirés, graphies « Voeux » ramenées à « Vœux »"""
+    name = " ".join(str(name).split())
+    match = _VOEU_HEADER.match(name)
+    if match:
+        return f"Vœux {match.group(1).capitalize()}"
+    return name
+
+def _entiers(serie):
+    """Conversion en entiers (partie entière, comme int(float(x))) ; NaN si non numérique"""
+    nombres = pd.to_numeric(serie.astype(str).str.strip(), errors="coerce")
+    return nombres.where(nombres.abs() != float("inf")).apply(lambda x: x if pd.isna(x) else int(x))
+
+def normalize_postes(df_postes):
+    """
+    Onglet Postes aux colonnes canoniques et typées, une fois au chargement :
+    - "Nombre total de postes" : entier (0 si vide ou non numérique) ;
+    - "Nombre de postes vacants" : entier nullable (NA si vide, 0 si non numérique).
+    """
+    df_postes = df_postes.rename(columns=canonical_column)
+    if "Nombre total de postes" in df_postes.columns:
+        df_postes["Nombre total de postes"] = _entiers(df_postes["Nombre total de postes"]).fillna(0).astype(int)
+    if "Nombre de postes vacants" in df_postes.columns:
+        raw = df_postes["Nombre de postes vacants"]
+        vide = raw.isna() | (raw.astype(str).str.strip() == "")
+        df_postes["Nombre de postes vacants"] = (
+            _entiers(raw).fillna(0).astype(int).astype("Int64").mask(vide)
+        )
+    return df_postes
+
+# Formats de date acceptés dans CAP 2025, par ordre d'essai
+DATE_FORMATS = ("%d/%m/%Y", "%Y-%m-%d", "%d-%m-%Y")
+
+# Colonnes calculées une fois par instantané de CAP 2025
+COL_DATE_RDV = "_date_rdv"          # "Date de rdv" en datetime (NaT si vide ou illisible)
+COL_DATE_ENTREE = "_date_entree"    # "Date entrée groupe" en datetime
+COL_ANCIENNETE = "_anciennete"      # libellé d'ancienneté calculé depuis "Date entrée groupe"
+COLONNES_DATES = {"Date de rdv", "Date entrée groupe"}
+
+def parse_dates(serie):
+    """Dates en datetime (NaT si vide ou illisible) : chaque format est essayé sur les cellules encore non lues"""
+    serie = serie.fillna("").astype(str)
+    dates = pd.Series(pd.NaT, index=serie.index, dtype="datetime64[ns]")
+    for fmt in DATE_FORMATS:
+        restantes = dates.isna() & (serie.str.strip() != "")
+        if not restantes.any():
+            break
+        dates[restantes] = pd.to_datetime(serie[restantes], format=fmt, errors="coerce")
+    return dates
+
+def anciennete_labels(dates, brutes, maintenant=None):
+    """Libellés d'ancienneté ("< 1 année", "1 année", "n années") ; N/A si vide, valeur brute si illisible"""
+    brutes = brutes.fillna("").astype(str)
+    annees = (pd.Timestamp(maintenant or datetime.now()) - dates).dt.days / 365.25
+    labels = annees.fillna(0).astype(int).astype(str) + " années"
+    labels = labels.mask(annees < 2, "1 année").mask(annees < 1, "< 1 année")
+    return labels.where(dates.notna(), brutes.where(brutes.str.strip() != "", "N/A"))
+
+def add_date_columns(collaborateurs_df):
+    """Ajoute les colonnes de dates typées et l'ancienneté (une seule lecture des dates par instantané)"""
+    def column(name):
+        if name not in collaborateurs_df.columns:
+            return pd.Series("", index=collaborateurs_df.index)
+        return collaborateurs_df[name]
+
+    date_entree = column("Date entrée groupe")
+    collaborateurs_df[COL_DATE_RDV] = parse_dates(column("Date de rdv"))
+    collaborateurs_df[COL_DATE_ENTREE] = parse_dates(date_entree)
+    collaborateurs_df[COL_ANCIENNETE] = anciennete_labels(collaborateurs_df[COL_DATE_ENTREE], date_entree)
+    return collaborateurs_df
+
+# Colonnes de CAP 2025 stockées en catégories (quelques centaines de valeurs distinctes) :
+# toutes les colonnes de postes partagent un même dictionnaire, donc les mêmes codes entiers.
+# Sur ces colonnes : groupby(..., observed=True), value_counts() sans les comptes nuls,
+# et passage en objets (astype(object)) avant .map() ou une comparaison entre deux colonnes
+COLONNES_POSTE = ("Poste libellé", "Vœux 1", "Vœux 2", "Vœux 3", "Vœux 4", "Vœux Retenu")
+COLONNES_CATEGORIELLES = ("Direction libellé", "Service libellé", "Priorité", "Référente RH")
+
+def _categories(*series):
+    """Dictionnaire trié des valeurs, avec "" (fillna("") reste toujours possible)"""
+    valeurs = set()
+    for serie in series:
+        valeurs.update(serie.dropna().astype(str))
+    return pd.CategoricalDtype(sorted(valeurs | {""}))
+
+def compact_collaborateurs(collaborateurs_df):
+    """
+    Représentation compacte de CAP 2025 : colonnes répétitives en catégories.
+    Retourne (DataFrame, (octets avant, octets après)).
+    """
+    avant = int(collaborateurs_df.memory_usage(deep=True).sum())
+    postes = [c for c in COLONNES_POSTE if c in collaborateurs_df.columns]
+    if postes:
+        dtype_postes = _categories(*(collaborateurs_df[c] for c in postes))
+        for c in postes:
+            collaborateurs_df[c] = collaborateurs_df[c].astype(dtype_postes)
+    for c in COLONNES_CATEGORIELLES:
+        if c in collaborateurs_df.columns:
+            collaborateurs_df[c] = collaborateurs_df[c].astype(_categories(collaborateurs_df[c]))
+    return collaborateurs_df, (avant, int(collaborateurs_df.memory_usage(deep=True).sum()))
+
+def _set_cell(df, mask, col, value):
+    """Affectation dans une colonne éventuellement catégorielle (nouvelle valeur ajoutée au dictionnaire)"""
+    dtype = df[col].dtype
+    if isinstance(dtype, pd.CategoricalDtype) and value not in dtype.categories:
+        # Le dictionnaire des postes reste commun à toutes les colonnes qui le partagent
+        nouveau = pd.CategoricalDtype(list(dtype.categories) + [value])
+        for c in df.columns:
+            if df[c].dtype == dtype:
+                df[c] = df[c].astype(nouveau)
+    df.loc[mask, col] = value
+
+def _cap2025_from_values(sheet_url, all_values):
+    """DataFrame des collaborateurs (en-têtes en ligne 2, données à partir de la ligne 3)"""
+    headers = all_values[1]
+    data = all_values[2:]
+    # Lecture complète : les en-têtes mémorisés (écritures ciblées) sont remis à jour gratuitement
+    remember_sheet_headers(sheet_url, "CAP 2025", 2, headers)
+    
+    collaborateurs_df = pd.DataFrame(data, columns=[canonical_column(h) for h in headers])
+    collaborateurs_df = collaborateurs_df.loc[:, ~collaborateurs_df.columns.str.contains('^Unnamed')]
+    collaborateurs_df, memoire = compact_collaborateurs(add_date_columns(collaborateurs_df))
+    store = get_data_store(sheet_url)
+    with store["lock"]:
+        store["memoire"]["cap2025"] = memoire
+    return collaborateurs_df
+
+def _records_from_values(values):
+    """Équivalent de get_all_records() à partir des valeurs brutes d'un onglet"""
+    values = gspread.utils.fill_gaps(values) if values else []
+    if not values:
+        return []
+    keys = values[0]
+    return [dict(zip(keys, gspread.utils.numericise_all(row))) for row in values[1:]]
+
+def _fetch_cap2025(_client, sheet_url):
+    """Lit l'onglet "CAP 2025" seul"""
+    cap_sheet = get_worksheet(_client, sheet_url, "CAP 2025")
     try:
-        cap_sheet = api_call_with_retry(lambda: spreadsheet.worksheet("CAP 2025"))
-        all_values = api_call_with_retry(lambda: cap_sheet.get_all_values())
-        
-        headers = all_values[1]
-        data = all_values[2:]
-        
-        collaborateurs_df = pd.DataFrame(data, columns=headers)
-        collaborateurs_df = collaborateurs_df.loc[:, ~collaborateurs_df.columns.str.contains('^Unnamed')]
-        
-    except gspread.WorksheetNotFound:
-        st.error("⚠️ L'onglet 'CAP 2025' n'a pas été trouvé.")
-        collaborateurs_df = pd.DataFrame()
-    except Exception as e:
-        st.error(f"Erreur lors du chargement de 'CAP 2025' : {str(e)}")
-        collaborateurs_df = pd.DataFrame()
-    
-    # Charger l'onglet "Postes" (référentiel)
+        all_values = sheets_call(lambda: cap_sheet.get_all_values())
+    except Exception:
+        invalidate_worksheet(sheet_url, "CAP 2025")
+        raise
+    return _cap2025_from_values(sheet_url, all_values)
+
+def _fetch_postes(_client, sheet_url):
+    """Lit l'onglet "Postes" (référentiel) seul"""
+    postes_sheet = get_worksheet(_client, sheet_url, "Postes")
     try:
-        postes_sheet = api_call_with_retry(lambda: spreadsheet.worksheet("Postes"))
-        postes_data = api_call_with_retry(lambda: postes_sheet.get_all_records())
-        postes_df = pd.DataFrame(postes_data)
-        
+        postes_data = sheets_call(lambda: postes_sheet.get_all_records())
+    except Exception:
+        invalidate_worksheet(sheet_url, "Postes")
+        raise
+    return normalize_postes(pd.DataFrame(postes_data))
+
+def _fetch_entretiens(_client, sheet_url):
+    """Lit l'onglet "Entretien RH" seul (liste vide s'il n'existe pas encore)"""
+    try:
+        worksheet = get_worksheet(_client, sheet_url, "Entretien RH")
+        return sheets_call(lambda: worksheet.get_all_records())
     except gspread.WorksheetNotFound:
-        st.error("⚠️ L'onglet 'Postes' n'a pas été trouvé.")
-        postes_df = pd.DataFrame()
+        return []
+    except Exception:
+        invalidate_worksheet(sheet_url, "Entretien RH")
+        raise
+
+def _fetch_bootstrap(_client, sheet_url):
+    """
+    Lit CAP 2025, Postes et Entretien RH en une seule requête (values_batch_get)
+    et construit les trois jeux de données d'un même instantané.
+    """
+    spreadsheet = get_spreadsheet(_client, sheet_url)
+    try:
+        response = sheets_call(lambda: spreadsheet.values_batch_get([f"'{tab}'" for tab in BOOTSTRAP_TABS]))
+    except gspread.exceptions.APIError as e:
+        if e.response.status_code != 400:
+            invalidate_worksheet(sheet_url)
+            raise
+        # Plage refusée : un onglet manque ou a été renommé, lecture onglet par onglet
+        # (l'erreur levée nomme alors l'onglet en cause)
+        invalidate_worksheet(sheet_url)
+        return {
+            "cap2025": _fetch_cap2025(_client, sheet_url),
+            "postes": _fetch_postes(_client, sheet_url),
+            "entretiens": _fetch_entretiens(_client, sheet_url),
+        }
+
+    cap_values, postes_values, entretien_values = (
+        value_range.get("values", []) for value_range in response.get("valueRanges", [])
+    )
+    return {
+        "cap2025": _cap2025_from_values(sheet_url, gspread.utils.fill_gaps(cap_values)),
+        "postes": normalize_postes(pd.DataFrame(_records_from_values(postes_values))),
+        "entretiens": _records_from_values(entretien_values),
+    }
+
+def load_data_from_gsheet(_client, sheet_url, versions=None):
+    """
+    Charge les données depuis Google Sheets avec gestion du quota.
+    Onglets : CAP 2025 (collaborateurs) et Postes (référentiel)
+    Les trois onglets sont lus ensemble (une requête) et publiés comme un seul
+    instantané versionné ; chacun reste une entrée distincte du cache nommé,
+    invalidable séparément.
+    """
+    loader = lambda: _fetch_bootstrap(_client, sheet_url)
+    try:
+        collaborateurs_df = cached_dataset(sheet_url, "cap2025", loader, group=BOOTSTRAP_DATASETS, versions=versions)
+        postes_df = cached_dataset(sheet_url, "postes", loader, group=BOOTSTRAP_DATASETS, versions=versions)
+    except gspread.WorksheetNotFound as e:
+        st.error(f"⚠️ L'onglet '{str(e)}' n'a pas été trouvé.")
+        return pd.DataFrame(), pd.DataFrame()
     except Exception as e:
-        st.error(f"Erreur lors du chargement de 'Postes' : {str(e)}")
-        postes_df = pd.DataFrame()
+        st.error(f"Erreur lors du chargement des données : {str(e)}")
+        return pd.DataFrame(), pd.DataFrame()
     
     return collaborateurs_df, postes_df
 
+def load_entretiens(_client, sheet_url, copy=True, versions=None):
+    """
+    Enregistrements de l'onglet "Entretien RH" (comme get_all_records), issus de
+    l'instantané partagé : aucune lecture de l'onglet à chaque rerun.
+    """
+    return cached_dataset(
+        sheet_url, "entretiens", lambda: _fetch_bootstrap(_client, sheet_url),
+        group=BOOTSTRAP_DATASETS, copy=copy, versions=versions
+    )
+
+def _index_entretiens(records):
+    """Index Matricule → enregistrement"""
+    return {
+        str(record.get("Matricule", "")).strip(): record
+        for record in (records or [])
+        if str(record.get("Matricule", "")).strip()
+    }
+
 def load_entretien_from_gsheet(_client, sheet_url, matricule):
     """
-    Charge un entretien existant depuis Google Sheets avec gestion du quota
+    Charge un entretien existant depuis l'instantané partagé de l'onglet "Entretien RH"
     """
     try:
-        spreadsheet = api_call_with_retry(lambda: _client.open_by_url(sheet_url))
-        worksheet = api_call_with_retry(lambda: spreadsheet.worksheet("Entretien RH"))
-        
-        all_records = api_call_with_retry(lambda: worksheet.get_all_records())
-        
-        for record in all_records:
-            if str(record.get("Matricule", "")) == str(matricule):
-                return record
-        
-        return None
+        load_entretiens(_client, sheet_url, copy=False)
+        index = derived_dataset(sheet_url, "entretiens_index", ("entretiens",), _index_entretiens, copy=False)
+        record = index.get(str(matricule).strip())
+        if record is None:
+            return None
+        record = dict(record)
+        remember_entretien_snapshot(sheet_url, record)
+        return record
         
-    except gspread.WorksheetNotFound:
-        st.warning("L'onglet 'Entretien RH' n'existe pas encore. Il sera créé lors de la première sauvegarde.")
-        return None
     except Exception as e:
         st.error(f"Erreur lors du chargement de l'entretien : {str(e)}")
         return None
 
+def _patch_entretien_cache(sheet_url, entretien_data):
+    """
+    Reporte dans l'instantané partagé un entretien que l'application vient d'écrire,
+    sans relire l'onglet.
+    """
+    matricule = str(entretien_data.get("Matricule", "")).strip()
+    store = get_data_store(sheet_url)
+    with store["lock"]:
+        entry = store["entries"].get("entretiens")
+        if entry is None:
+            return
+        written = {h: entretien_data.get(h, "") for h in ENTRETIEN_HEADERS}
+        records = list(entry["value"])
+        for position, record in enumerate(records):
+            if str(record.get("Matricule", "")).strip() == matricule:
+                records[position] = dict(record, **written)
+                break
+        else:
+            records.append(written)
+        _replace_dataset_value(store, "entretiens", records)
+
+# --- COLONNES DE L'ONGLET "ENTRETIEN RH" (A → BX, dans l'ordre de la feuille) ---
+ENTRETIEN_HEADERS = [
+    "Matricule", "Nom", "Prénom", "Date_Entretien", "Referente_RH",
+    # Vœu 1
+    "Voeu_1", "V1_Motivations", "V1_Vision_Enjeux", "V1_Premieres_Actions",
+    "V1_Competence_1_Nom", "V1_Competence_1_Niveau", "V1_Competence_1_Justification",
+    "V1_Competence_2_Nom", "V1_Competence_2_Niveau", "V1_Competence_2_Justification",
+    "V1_Competence_3_Nom", "V1_Competence_3_Niveau", "V1_Competence_3_Justification",
+    "V1_Experience_Niveau", "V1_Experience_Justification",
+    "V1_Besoin_Accompagnement", "V1_Type_Accompagnement",
+    # Vœu 2
+    "Voeu_2", "V2_Motivations", "V2_Vision_Enjeux", "V2_Premieres_Actions",
+    "V2_Competence_1_Nom", "V2_Competence_1_Niveau", "V2_Competence_1_Justification",
+    "V2_Competence_2_Nom", "V2_Competence_2_Niveau", "V2_Competence_2_Justification",
+    "V2_Competence_3_Nom", "V2_Competence_3_Niveau", "V2_Competence_3_Justification",
+    "V2_Experience_Niveau", "V2_Experience_Justification",
+    "V2_Besoin_Accompagnement", "V2_Type_Accompagnement",
+    # Vœu 3
+    "Voeu_3", "V3_Motivations", "V3_Vision_Enjeux", "V3_Premieres_Actions",
+    "V3_Competence_1_Nom", "V3_Competence_1_Niveau", "V3_Competence_1_Justification",
+    "V3_Competence_2_Nom", "V3_Competence_2_Niveau", "V3_Competence_2_Justification",
+    "V3_Competence_3_Nom", "V3_Competence_3_Niveau", "V3_Competence_3_Justification",
+    "V3_Experience_Niveau", "V3_Experience_Justification",
+    "V3_Besoin_Accompagnement", "V3_Type_Accompagnement",
+    # Avis RH
+    "Attentes_Manager", "Avis_RH_Synthese", "Decision_RH_Poste",
+    # ✅ NOUVEAU : Vœu 4
+    "Voeu_4", "V4_Motivations", "V4_Vision_Enjeux", "V4_Premieres_Actions",
+    "V4_Competence_1_Nom", "V4_Competence_1_Niveau", "V4_Competence_1_Justification",
+    "V4_Competence_2_Nom", "V4_Competence_2_Niveau", "V4_Competence_2_Justification",
+    "V4_Competence_3_Nom", "V4_Competence_3_Niveau", "V4_Competence_3_Justification",
+    "V4_Experience_Niveau", "V4_Experience_Justification",
+    "V4_Besoin_Accompagnement", "V4_Type_Accompagnement"
+]
+
 def create_entretien_sheet_if_not_exists(_client, sheet_url):
     """
     Crée l'onglet "Entretien RH" s'il n'existe pas déjà.
     """
     try:
-        spreadsheet = _client.open_by_url(sheet_url)
-        
         try:
-            spreadsheet.worksheet("Entretien RH")
+            get_worksheet(_client, sheet_url, "Entretien RH")
             return True
         except gspread.WorksheetNotFound:
-            worksheet = spreadsheet.add_worksheet(title="Entretien RH", rows="1000", cols="76")  # ← MODIFIÉ : 59 → 76 colonnes
+            spreadsheet = get_spreadsheet(_client, sheet_url)
+            worksheet = sheets_call(lambda: spreadsheet.add_worksheet(title="Entretien RH", rows="1000", cols="76"), "write")  # ← MODIFIÉ : 59 → 76 colonnes
             
-            headers = [
-                "Matricule", "Nom", "Prénom", "Date_Entretien", "Referente_RH",
-                # Vœu 1
-                "Voeu_1", "V1_Motivations", "V1_Vision_Enjeux", "V1_Premieres_Actions",
-                "V1_Competence_1_Nom", "V1_Competence_1_Niveau", "V1_Competence_1_Justification",
-                "V1_Competence_2_Nom", "V1_Competence_2_Niveau", "V1_Competence_2_Justification",
-                "V1_Competence_3_Nom", "V1_Competence_3_Niveau", "V1_Competence_3_Justification",
-                "V1_Experience_Niveau", "V1_Experience_Justification",
-                "V1_Besoin_Accompagnement", "V1_Type_Accompagnement",
-                # Vœu 2
-                "Voeu_2", "V2_Motivations", "V2_Vision_Enjeux", "V2_Premieres_Actions",
-                "V2_Competence_1_Nom", "V2_Competence_1_Niveau", "V2_Competence_1_Justification",
-                "V2_Competence_2_Nom", "V2_Competence_2_Niveau", "V2_Competence_2_Justification",
-                "V2_Competence_3_Nom", "V2_Competence_3_Niveau", "V2_Competence_3_Justification",
-                "V2_Experience_Niveau", "V2_Experience_Justification",
-                "V2_Besoin_Accompagnement", "V2_Type_Accompagnement",
-                # Vœu 3
-                "Voeu_3", "V3_Motivations", "V3_Vision_Enjeux", "V3_Premieres_Actions",
-                "V3_Competence_1_Nom", "V3_Competence_1_Niveau", "V3_Competence_1_Justification",
-                "V3_Competence_2_Nom", "V3_Competence_2_Niveau", "V3_Competence_2_Justification",
-                "V3_Competence_3_Nom", "V3_Competence_3_Niveau", "V3_Competence_3_Justification",
-                "V3_Experience_Niveau", "V3_Experience_Justification",
-                "V3_Besoin_Accompagnement", "V3_Type_Accompagnement",
-                # Avis RH
-                "Attentes_Manager", "Avis_RH_Synthese", "Decision_RH_Poste",
-                # ✅ NOUVEAU : Vœu 4
-                "Voeu_4", "V4_Motivations", "V4_Vision_Enjeux", "V4_Premieres_Actions",
-                "V4_Competence_1_Nom", "V4_Competence_1_Niveau", "V4_Competence_1_Justification",
-                "V4_Competence_2_Nom", "V4_Competence_2_Niveau", "V4_Competence_2_Justification",
-                "V4_Competence_3_Nom", "V4_Competence_3_Niveau", "V4_Competence_3_Justification",
-                "V4_Experience_Niveau", "V4_Experience_Justification",
-                "V4_Besoin_Accompagnement", "V4_Type_Accompagnement"
-            ]
             
-            worksheet.update('A1:BX1', [headers])  # ← MODIFIÉ : BG1 → BX1
+            sheets_call(lambda: worksheet.update(range_name='A1:BX1', values=[ENTRETIEN_HEADERS]), "write")  # ← MODIFIÉ : BG1 → BX1
+            register_worksheet(sheet_url, worksheet)
             return True
             
     except Exception as e:
         st.error(f"Erreur lors de la création de l'onglet 'Entretien RH' : {str(e)}")
         return False
 
-def auto_save_entretien(gsheet_client, sheet_url, entretien_data):
-    """Sauvegarde automatique silencieuse avec gestion des accès concurrents"""
-    if entretien_data and entretien_data.get("Matricule"):
+@st.cache_resource(show_spinner=False)
+def get_entretien_row_index(sheet_url):
+    """
+    Index persistant Matricule → numéro de ligne de l'onglet "Entretien RH".
+    Partagé par toutes les sessions, un index par Google Sheet.
+    """
+    return {
+        "lock": threading.Lock(),
+        "rows": None,
+        "snapshots": {},    # (session, matricule) → dernière version connue de la session
+        "generation": 0,    # incrémenté à chaque invalidation
+        "loading": None,    # threading.Event de la lecture en cours de la colonne Matricule
+    }
+
+def _ensure_entretien_row_index(worksheet, sheet_url):
+    """
+    Construit l'index une seule fois (lecture de la seule colonne Matricule).
+    La lecture (et l'attente de quota) se fait hors du verrou : les autres
+    sessions attendent la lecture en cours au lieu de se sérialiser derrière le verrou.
+    """
+    index = get_entretien_row_index(sheet_url)
+    while True:
+        with index["lock"]:
+            if index["rows"] is not None:
+                return index
+            loading = index["loading"]
+            if loading is None:
+                loading = index["loading"] = threading.Event()
+                generation = index["generation"]
+                break
+        # Lecture lancée par une autre session : on attend son résultat
+        loading.wait()
+
+    rows = None
+    try:
+        matricules = sheets_call(lambda: worksheet.col_values(1), priority=PRIORITY_INTERACTIVE)
+        rows = {
+            str(m).strip(): row
+            for row, m in enumerate(matricules[1:], start=2)
+            if str(m).strip()
+        }
+    finally:
+        with index["lock"]:
+            # Invalidation pendant la lecture : le résultat est peut-être déjà faux
+            if rows is not None and index["generation"] == generation:
+                index["rows"] = rows
+            if index["loading"] is loading:
+                index["loading"] = None
+        loading.set()
+    if rows is None or index["rows"] is None:
+        return _ensure_entretien_row_index(worksheet, sheet_url)
+    return index
+
+def invalidate_entretien_row_index(sheet_url):
+    """Force la reconstruction de l'index au prochain accès (lignes supprimées/déplacées à la main)"""
+    index = get_entretien_row_index(sheet_url)
+    with index["lock"]:
+        index["rows"] = None
+        index["generation"] += 1
+
+def _entretien_cell(value):
+    """Valeur d'une cellule telle que relue dans la feuille (comparaison des versions)"""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    return str(value)
+
+def _session_uid(session_uid=None):
+    """Identifiant de la session courante (explicite hors du thread du script)"""
+    return session_uid if session_uid is not None else st.session_state.session_uid
+
+def remember_entretien_snapshot(sheet_url, entretien_data, session_uid=None):
+    """
+    Mémorise, pour la session, la dernière version d'un entretien qu'elle a chargée
+    ou sauvegardée : ses sauvegardes suivantes n'écrivent que ses propres modifications.
+    Une version par (session, matricule) : deux référentes sur le même collaborateur
+    ont chacune leur référence et ne réécrivent pas les champs saisis par l'autre.
+    """
+    matricule = str(entretien_data.get("Matricule", "")).strip()
+    if not matricule:
+        return
+    index = get_entretien_row_index(sheet_url)
+    with index["lock"]:
+        index["snapshots"][(_session_uid(session_uid), matricule)] = [
+            _entretien_cell(entretien_data.get(h, "")) for h in ENTRETIEN_HEADERS
+        ]
+
+def _entretien_cell_norm(value):
+    """
+    Valeur de cellule comparable entre le formulaire et la feuille : les
+    enregistrements relus sont numérisés (get_all_records : "01" → 1),
+    les deux côtés le sont donc aussi pour la comparaison.
+    """
+    return _entretien_cell(gspread.utils.numericise(_entretien_cell(value)))
+
+def _entretien_dirty_ranges(row, snapshot, row_data, live=None):
+    """
+    Compare la ligne à écrire à la version de référence de la session et regroupe
+    les colonnes modifiées en plages contiguës (format de batch_update).
+    Avec `live` (ligne relue dans la feuille), une cellule qui contient déjà
+    la nouvelle valeur n'est pas réécrite.
+    """
+    changed = [
+        col for col, (old, new) in enumerate(zip(snapshot, row_data))
+        if _entretien_cell_norm(old) != _entretien_cell_norm(new)
+        and (live is None or _entretien_cell_norm(live[col]) != _entretien_cell_norm(new))
+    ]
+    runs = []
+    for col in changed:
+        if runs and runs[-1][1] == col - 1:
+            runs[-1][1] = col
+        else:
+            runs.append([col, col])
+    return [
+        {
+            "range": f"{gspread.utils.rowcol_to_a1(row, start + 1)}:{gspread.utils.rowcol_to_a1(row, end + 1)}",
+            "values": [row_data[start:end + 1]],
+        }
+        for start, end in runs
+    ]
+
+def _row_from_append_response(response):
+    """Extrait le numéro de ligne écrit de la réponse d'append_row ('Entretien RH'!A12:BX12 → 12)"""
+    try:
+        updated_range = response["updates"]["updatedRange"]
+        return int(re.search(r"![A-Z]+(\d+)", updated_range).group(1))
+    except (KeyError, TypeError, AttributeError, ValueError):
+        return None
+
+# --- ÉCRITURE DIFFÉRÉE DES ENTRETIENS (write-behind) ---
+# Délai de calme après la dernière modification avant l'écriture dans Google Sheets
+AUTOSAVE_DEBOUNCE_SECONDS = 2.0
+# Délai maximal entre la première modification non sauvegardée et son écriture
+AUTOSAVE_MAX_DELAY_SECONDS = 10.0
+# Délai avant une nouvelle tentative après un échec d'écriture
+AUTOSAVE_RETRY_SECONDS = 10.0
+# Nombre d'écritures tentées pour un même tampon avant abandon (matricule supprimé, droits...)
+AUTOSAVE_MAX_ATTEMPTS = 5
+
+@st.cache_resource(show_spinner=False)
+def get_entretien_write_queue():
+    """
+    File d'écriture différée partagée par toutes les sessions.
+    Un seul tampon par (Google Sheet, matricule, session) : les rafales de modifications
+    sont fusionnées en une seule écriture, faite par un thread de fond ; deux sessions
+    sur le même matricule gardent chacune leur tampon.
+    """
+    return {
+        "cond": threading.Condition(),
+        "pending": {},   # (sheet_url, matricule, session) → {"client", "data", "due", "first", "seq", "max_retries", "attempts"}
+        "status": {},    # (sheet_url, matricule, session) → {"state", "seq", "done_seq", "flushed_seq", "flushed_at", "error", "attempts"}
+        "worker": None,
+    }
+
+def _entretien_write_worker(queue):
+    """
+    Boucle du thread d'écriture : écrit les tampons dont le délai de calme est écoulé.
+    Un tampon en échec est retenté AUTOSAVE_MAX_ATTEMPTS fois puis abandonné (état "error") ;
+    une erreur inattendue est journalisée sans arrêter le thread.
+    """
+    paris_tz = pytz.timezone('Europe/Paris')
+    cond = queue["cond"]
+    while True:
+        key = entry = None
         try:
-            save_entretien_to_gsheet(gsheet_client, sheet_url, entretien_data, show_success=False)
-            paris_tz = pytz.timezone('Europe/Paris')
-            st.session_state.last_save_time = datetime.now(paris_tz)
+            with cond:
+                while True:
+                    now = time.time()
+                    due_keys = [k for k, e in queue["pending"].items() if e["due"] <= now]
+                    if due_keys:
+                        key = min(due_keys, key=lambda k: queue["pending"][k]["due"])
+                        entry = queue["pending"].pop(key)
+                        queue["status"][key]["state"] = "writing"
+                        break
+                    next_due = min((e["due"] for e in queue["pending"].values()), default=None)
+                    cond.wait(None if next_due is None else max(0.05, next_due - now))
+
+            try:
+                _write_entretien_row(entry["client"], key[0], entry["data"],
+                                     max_retries=entry["max_retries"], session_uid=key[2])
+                error = None
+            except Exception as e:
+                error = str(e)
+
+            with cond:
+                status = queue["status"][key]
+                status["done_seq"] = entry["seq"]
+                if error is None:
+                    status["flushed_seq"] = entry["seq"]
+                    status["flushed_at"] = datetime.now(paris_tz)
+                    status["error"] = None
+                    status["attempts"] = 0
+                else:
+                    entry["attempts"] += 1
+                    status["attempts"] = entry["attempts"]
+                    if entry["attempts"] >= AUTOSAVE_MAX_ATTEMPTS:
+                        status["error"] = f"{error} (abandon après {entry['attempts']} tentatives)"
+                        logger.error("Entretien %s non enregistré : %s", key[1], status["error"])
+                    else:
+                        status["error"] = error
+                        # Pas de version plus récente en attente : on garde les données et on retente
+                        if key not in queue["pending"]:
+                            entry["due"] = time.time() + AUTOSAVE_RETRY_SECONDS
+                            queue["pending"][key] = entry
+                if key in queue["pending"]:
+                    status["state"] = "pending"
+                else:
+                    status["state"] = "synced" if error is None else "error"
+                cond.notify_all()
         except Exception as e:
-            pass
+            # Le thread survit : l'élément en cours est signalé en échec, les autres continuent
+            logger.exception("Écriture différée des entretiens : erreur inattendue")
+            if key is not None:
+                with cond:
+                    status = queue["status"].get(key)
+                    if status is not None:
+                        status["error"] = str(e)
+                        status["done_seq"] = max(status["done_seq"], entry["seq"])
+                        status["state"] = "pending" if key in queue["pending"] else "error"
+                    cond.notify_all()
+
+def enqueue_entretien_save(_client, sheet_url, entretien_data, delay=AUTOSAVE_DEBOUNCE_SECONDS, max_retries=3):
+    """Place (ou remplace) l'entretien dans le tampon de son matricule, sans attendre le réseau"""
+    matricule = str(entretien_data.get("Matricule", "")).strip()
+    if not matricule:
+        return None
 
-def save_entretien_to_gsheet(_client, sheet_url, entretien_data, show_success=True, max_retries=3):
+    queue = get_entretien_write_queue()
+    key = (sheet_url, matricule, _session_uid())
+    now = time.time()
+    with queue["cond"]:
+        status = queue["status"].setdefault(key, {
+            "state": "synced", "seq": 0, "done_seq": 0, "flushed_seq": 0, "flushed_at": None,
+            "error": None, "attempts": 0,
+        })
+        status["seq"] += 1
+        previous = queue["pending"].get(key)
+        first = previous["first"] if previous else now
+        queue["pending"][key] = {
+            "client": _client,
+            "data": dict(entretien_data),
+            "due": min(now + delay, first + AUTOSAVE_MAX_DELAY_SECONDS),
+            "first": first,
+            "seq": status["seq"],
+            "max_retries": max_retries,
+            "attempts": 0,
+        }
+        if status["state"] != "writing":
+            status["state"] = "pending"
+
+        if queue["worker"] is None or not queue["worker"].is_alive():
+            queue["worker"] = threading.Thread(
+                target=_entretien_write_worker, args=(queue,), name="entretien-write-behind", daemon=True
+            )
+            queue["worker"].start()
+        queue["cond"].notify_all()
+    return status["seq"]
+
+def flush_entretien_save(sheet_url, matricule, wait=False, timeout=30):
+    """
+    Déclenche immédiatement l'écriture du tampon d'un matricule (changement de page,
+    bouton « Sauvegarder maintenant »). Avec wait=True, attend la fin de l'écriture.
+    """
+    queue = get_entretien_write_queue()
+    key = (sheet_url, str(matricule).strip(), _session_uid())
+    with queue["cond"]:
+        if key in queue["pending"]:
+            queue["pending"][key]["due"] = 0
+            queue["cond"].notify_all()
+        status = queue["status"].get(key)
+        if status is None:
+            return {"ok": False, "state": None}
+        target = status["seq"]
+        if wait:
+            queue["cond"].wait_for(lambda: status["done_seq"] >= target, timeout=timeout)
+        return dict(status, ok=status["flushed_seq"] >= target)
+
+def get_entretien_save_status(sheet_url, matricule):
+    """État de sauvegarde d'un matricule pour la session : pending / writing / synced / error"""
+    queue = get_entretien_write_queue()
+    with queue["cond"]:
+        status = queue["status"].get((sheet_url, str(matricule).strip(), _session_uid()))
+        return dict(status) if status else None
+
+def auto_save_entretien(gsheet_client, sheet_url, entretien_data):
+    """Sauvegarde automatique silencieuse : mise en tampon, écrite en arrière-plan"""
+    if entretien_data and entretien_data.get("Matricule"):
+        enqueue_entretien_save(gsheet_client, sheet_url, entretien_data)
+
+def _write_entretien_row(_client, sheet_url, entretien_data, max_retries=3, session_uid=None):
     """
-    Sauvegarde un entretien RH dans l'onglet "Entretien RH".
+    Écrit un entretien RH dans l'onglet "Entretien RH" (sans aucun appel Streamlit,
+    utilisable depuis le thread d'écriture différée avec `session_uid` explicite).
     Gère les sauvegardes concurrentes avec système de retry.
+    La ligne est retrouvée via l'index Matricule → ligne (aucune relecture de l'onglet) ;
+    pour une ligne existante, seules les cellules modifiées par la session sont écrites,
+    après relecture de la ligne (ligne déplacée, cellules déjà à jour).
+    Lève la dernière exception si toutes les tentatives échouent.
     """
+    matricule = str(entretien_data.get("Matricule", "")).strip()
+    row_data = [entretien_data.get(h, "") for h in ENTRETIEN_HEADERS]
+    snapshot_key = (_session_uid(session_uid), matricule)
+
+    # Rien n'a changé depuis la dernière version connue de la session : aucun appel réseau
+    index = get_entretien_row_index(sheet_url)
+    with index["lock"]:
+        snapshot = index["snapshots"].get(snapshot_key)
+        existing_row = index["rows"].get(matricule) if index["rows"] else None
+    if snapshot is not None and existing_row \
+            and not _entretien_dirty_ranges(existing_row, snapshot, row_data):
+        return True
+
     for attempt in range(max_retries):
         try:
-            spreadsheet = _client.open_by_url(sheet_url)
-            worksheet = spreadsheet.worksheet("Entretien RH")
-            
-            all_records = worksheet.get_all_records()
-            existing_row = None
-            
-            for idx, record in enumerate(all_records):
-                if str(record.get("Matricule", "")) == str(entretien_data.get("Matricule", "")):
-                    existing_row = idx + 2
-                    break
-            
-            row_data = [
-                entretien_data.get("Matricule", ""),
-                entretien_data.get("Nom", ""),
-                entretien_data.get("Prénom", ""),
-                entretien_data.get("Date_Entretien", ""),
-                entretien_data.get("Referente_RH", ""),
-                # Vœu 1
-                entretien_data.get("Voeu_1", ""),
-                entretien_data.get("V1_Motivations", ""),
-                entretien_data.get("V1_Vision_Enjeux", ""),
-                entretien_data.get("V1_Premieres_Actions", ""),
-                entretien_data.get("V1_Competence_1_Nom", ""),
-                entretien_data.get("V1_Competence_1_Niveau", ""),
-                entretien_data.get("V1_Competence_1_Justification", ""),
-                entretien_data.get("V1_Competence_2_Nom", ""),
-                entretien_data.get("V1_Competence_2_Niveau", ""),
-                entretien_data.get("V1_Competence_2_Justification", ""),
-                entretien_data.get("V1_Competence_3_Nom", ""),
-                entretien_data.get("V1_Competence_3_Niveau", ""),
-                entretien_data.get("V1_Competence_3_Justification", ""),
-                entretien_data.get("V1_Experience_Niveau", ""),
-                entretien_data.get("V1_Experience_Justification", ""),
-                entretien_data.get("V1_Besoin_Accompagnement", ""),
-                entretien_data.get("V1_Type_Accompagnement", ""),
-                # Vœu 2
-                entretien_data.get("Voeu_2", ""),
-                entretien_data.get("V2_Motivations", ""),
-                entretien_data.get("V2_Vision_Enjeux", ""),
-                entretien_data.get("V2_Premieres_Actions", ""),
-                entretien_data.get("V2_Competence_1_Nom", ""),
-                entretien_data.get("V2_Competence_1_Niveau", ""),
-                entretien_data.get("V2_Competence_1_Justification", ""),
-                entretien_data.get("V2_Competence_2_Nom", ""),
-                entretien_data.get("V2_Competence_2_Niveau", ""),
-                entretien_data.get("V2_Competence_2_Justification", ""),
-                entretien_data.get("V2_Competence_3_Nom", ""),
-                entretien_data.get("V2_Competence_3_Niveau", ""),
-                entretien_data.get("V2_Competence_3_Justification", ""),
-                entretien_data.get("V2_Experience_Niveau", ""),
-                entretien_data.get("V2_Experience_Justification", ""),
-                entretien_data.get("V2_Besoin_Accompagnement", ""),
-                entretien_data.get("V2_Type_Accompagnement", ""),
-                # Vœu 3
-                entretien_data.get("Voeu_3", ""),
-                entretien_data.get("V3_Motivations", ""),
-                entretien_data.get("V3_Vision_Enjeux", ""),
-                entretien_data.get("V3_Premieres_Actions", ""),
-                entretien_data.get("V3_Competence_1_Nom", ""),
-                entretien_data.get("V3_Competence_1_Niveau", ""),
-                entretien_data.get("V3_Competence_1_Justification", ""),
-                entretien_data.get("V3_Competence_2_Nom", ""),
-                entretien_data.get("V3_Competence_2_Niveau", ""),
-                entretien_data.get("V3_Competence_2_Justification", ""),
-                entretien_data.get("V3_Competence_3_Nom", ""),
-                entretien_data.get("V3_Competence_3_Niveau", ""),
-                entretien_data.get("V3_Competence_3_Justification", ""),
-                entretien_data.get("V3_Experience_Niveau", ""),
-                entretien_data.get("V3_Experience_Justification", ""),
-                entretien_data.get("V3_Besoin_Accompagnement", ""),
-                entretien_data.get("V3_Type_Accompagnement", ""),
-                # Avis RH
-                entretien_data.get("Attentes_Manager", ""),
-                entretien_data.get("Avis_RH_Synthese", ""),
-                entretien_data.get("Decision_RH_Poste", ""),
-                # ✅ NOUVEAU : Vœu 4
-                entretien_data.get("Voeu_4", ""),
-                entretien_data.get("V4_Motivations", ""),
-                entretien_data.get("V4_Vision_Enjeux", ""),
-                entretien_data.get("V4_Premieres_Actions", ""),
-                entretien_data.get("V4_Competence_1_Nom", ""),
-                entretien_data.get("V4_Competence_1_Niveau", ""),
-                entretien_data.get("V4_Competence_1_Justification", ""),
-                entretien_data.get("V4_Competence_2_Nom", ""),
-                entretien_data.get("V4_Competence_2_Niveau", ""),
-                entretien_data.get("V4_Competence_2_Justification", ""),
-                entretien_data.get("V4_Competence_3_Nom", ""),
-                entretien_data.get("V4_Competence_3_Niveau", ""),
-                entretien_data.get("V4_Competence_3_Justification", ""),
-                entretien_data.get("V4_Experience_Niveau", ""),
-                entretien_data.get("V4_Experience_Justification", ""),
-                entretien_data.get("V4_Besoin_Accompagnement", ""),
-                entretien_data.get("V4_Type_Accompagnement", "")
-            ]
-            
-            if existing_row:
-                worksheet.update(f'A{existing_row}:BX{existing_row}', [row_data])  # ← MODIFIÉ : BG → BX
+            worksheet = get_worksheet(_client, sheet_url, "Entretien RH", priority=PRIORITY_INTERACTIVE)
+
+            index = _ensure_entretien_row_index(worksheet, sheet_url)
+            with index["lock"]:
+                existing_row = index["rows"].get(matricule) if index["rows"] else None
+                snapshot = index["snapshots"].get(snapshot_key)
+
+            written = entretien_data
+            if existing_row and snapshot is not None:
+                # Ligne relue : les champs saisis en parallèle par une autre session
+                # sont conservés, seules les modifications de cette session sont envoyées
+                live = sheets_call(lambda: worksheet.row_values(existing_row), priority=PRIORITY_INTERACTIVE)
+                if not live or str(live[0]).strip() != matricule:
+                    raise ValueError(f"Ligne {existing_row} : matricule {matricule} déplacé")
+                live = (live + [""] * len(ENTRETIEN_HEADERS))[:len(ENTRETIEN_HEADERS)]
+                dirty_ranges = _entretien_dirty_ranges(existing_row, snapshot, row_data, live)
+                if dirty_ranges:
+                    sheets_call(lambda: worksheet.batch_update(dirty_ranges), "write", PRIORITY_INTERACTIVE)
+                written = dict(zip(ENTRETIEN_HEADERS, live))
+                written.update(
+                    (h, new) for h, old, new in zip(ENTRETIEN_HEADERS, snapshot, row_data)
+                    if _entretien_cell_norm(old) != _entretien_cell_norm(new)
+                )
+            elif existing_row:
+                sheets_call(lambda: worksheet.update(range_name=f'A{existing_row}:BX{existing_row}', values=[row_data]), "write", PRIORITY_INTERACTIVE)  # ← MODIFIÉ : BG → BX
             else:
-                worksheet.append_row(row_data)
-            
-            paris_tz = pytz.timezone('Europe/Paris')
-            st.session_state.last_save_time = datetime.now(paris_tz)
-            
-            if show_success:
-                st.success(f"✅ Sauvegarde effectuée à {st.session_state.last_save_time.strftime('%H:%M:%S')}")
-            
+                # Verrou : deux sessions ne doivent pas créer chacune une ligne pour le même matricule
+                with index["lock"]:
+                    existing_row = index["rows"].get(matricule)
+                    if existing_row:
+                        sheets_call(lambda: worksheet.update(range_name=f'A{existing_row}:BX{existing_row}', values=[row_data]), "write", PRIORITY_INTERACTIVE)
+                    else:
+                        response = sheets_call(lambda: worksheet.append_row(row_data), "write", PRIORITY_INTERACTIVE)
+                        new_row = _row_from_append_response(response)
+                        if new_row:
+                            index["rows"][matricule] = new_row
+                        else:
+                            index["rows"] = None
+
+            # Référence de la session : sa propre version (ses champs non modifiés
+            # restent ceux qu'elle a chargés) ; cache partagé : la ligne telle qu'écrite
+            remember_entretien_snapshot(sheet_url, entretien_data, session_uid=snapshot_key[0])
+            _patch_entretien_cache(sheet_url, written)
             return True
             
-        except Exception as e:
+        except Exception:
+            # L'index (lignes modifiées à la main) ou l'onglet mis en cache ont pu
+            # devenir faux : ils seront relus
+            invalidate_entretien_row_index(sheet_url)
+            invalidate_worksheet(sheet_url, "Entretien RH")
             if attempt < max_retries - 1:
                 time.sleep(0.5 * (attempt + 1))
                 continue
-            else:
-                if show_success:
-                    st.error(f"Erreur lors de la sauvegarde après {max_retries} tentatives : {str(e)}")
-                return False
+            raise
 
-def update_voeu_retenu(_client, sheet_url, matricule, poste):
+def save_entretien_to_gsheet(_client, sheet_url, entretien_data, show_success=True, max_retries=3):
     """
-    Met à jour la colonne 'Vœux Retenu' dans l'onglet CAP 2025
+    Sauvegarde immédiate d'un entretien RH (boutons « Sauvegarder », décisions RH).
+    Passe par la file d'écriture différée pour garder l'ordre des écritures
+    d'un même matricule, puis attend la confirmation de Google Sheets.
     """
-    try:
-        spreadsheet = _client.open_by_url(sheet_url)
-        worksheet = spreadsheet.worksheet("CAP 2025")
-        
-        all_values = worksheet.get_all_values()
-        headers = all_values[1]
-        
+    matricule = str(entretien_data.get("Matricule", "")).strip()
+    if not matricule:
+        return False
+
+    enqueue_entretien_save(_client, sheet_url, entretien_data, delay=0, max_retries=max_retries)
+    status = flush_entretien_save(sheet_url, matricule, wait=True)
+
+    if status.get("ok"):
+        st.session_state.last_save_time = status["flushed_at"]
+        if show_success:
+            st.success(f"✅ Sauvegarde effectuée à {st.session_state.last_save_time.strftime('%H:%M:%S')}")
+        return True
+
+    if show_success:
+        st.error(f"Erreur lors de la sauvegarde après {max_retries} tentatives : {status.get('error') or 'délai dépassé'}")
+    return False
+
+# --- ÉCRITURES DANS CAP 2025 (application locale immédiate, confirmation en arrière-plan) ---
+@st.cache_resource(show_spinner=False)
+def get_cap2025_writer():
+    """
+    Écrivain unique des cellules de CAP 2025, partagé par toutes les sessions.
+    Un seul thread : les écritures sont confirmées dans l'ordre où elles ont été faites.
+    Les échecs sont rangés par session et affichés au rerun suivant.
+    """
+    return {
+        "executor": ThreadPoolExecutor(max_workers=1, thread_name_prefix="cap2025-writer"),
+        "lock": threading.Lock(),
+        "errors": {},   # session_uid → [messages]
+    }
+
+def _apply_cap2025_values(df, matricule, values, expected=None):
+    """
+    Copie de `df` où la ligne du matricule reçoit `values` ({colonne: valeur}).
+    Avec `expected`, n'applique que si la ligne contient encore ces valeurs (annulation).
+    Retourne (copie modifiée, anciennes valeurs), ou None si rien n'est appliqué.
+    """
+    columns = {canonical_column(c): c for c in df.columns}
+    values = {canonical_column(col): val for col, val in values.items()}
+    if expected is not None:
+        expected = {canonical_column(col): val for col, val in expected.items()}
+    if "Matricule" not in columns:
+        return None
+    mask = df[columns["Matricule"]] == str(matricule)
+    if not mask.any():
+        return None
+
+    def current(col):
+        return df.loc[mask, columns[col]].iloc[0] if col in columns else ""
+
+    if expected is not None and any(current(col) != val for col, val in expected.items()):
+        return None
+
+    old_values = {col: current(col) for col in values}
+    # Copie puis remplacement : les sessions qui lisent l'ancienne version ne sont pas affectées
+    patched = df.copy()
+    for col, value in values.items():
+        if col not in columns:
+            patched[col] = ""
+            columns[col] = col
+        _set_cell(patched, mask, columns[col], value)
+    if COLONNES_DATES & set(values):
+        patched = add_date_columns(patched)
+    return patched, old_values
+
+def _patch_cap2025_cache(sheet_url, matricule, values, expected=None):
+    """
+    Applique `values` ({colonne: valeur}) à la ligne du matricule dans le CAP 2025 en cache.
+    Avec `expected`, n'applique que si la ligne contient encore ces valeurs (annulation).
+    Retourne les anciennes valeurs, ou None si le matricule n'est pas dans le cache.
+    """
+    store = get_data_store(sheet_url)
+    with store["lock"]:
+        entry = store["entries"].get("cap2025")
+        if entry is None:
+            return None
+        applied = _apply_cap2025_values(entry["value"], matricule, values, expected)
+        if applied is None:
+            return None
+        patched, old_values = applied
+        # Nouvelle version : les jeux dérivés (agrégats) seront recalculés,
+        # une relecture en cours (antérieure à l'écriture) sera ignorée
+        _replace_dataset_value(store, "cap2025", patched)
+        return old_values
+
+def _reapply_pending_cap2025(store, df):
+    """
+    Réapplique à un CAP 2025 relu les écritures pas encore confirmées (verrou du cache tenu) :
+    une relecture lancée après l'application locale ne les contient peut-être pas encore.
+    """
+    for write in store["pending_cap2025"].values():
+        applied = _apply_cap2025_values(df, write["matricule"], write["values"])
+        if applied is not None:
+            df = applied[0]
+    return df
+
+def _write_cap2025_cells(_client, sheet_url, matricule, values, append_cols=(), create_missing=False, max_retries=3):
+    """
+    Écrit les cellules d'un matricule dans l'onglet CAP 2025 (sans appel Streamlit).
+    Onglet et en-têtes viennent du registre : seule la colonne Matricule est lue,
+    puis un seul batch_update. Une colonne ou un matricule introuvable provoque
+    une relecture des en-têtes (colonnes déplacées dans la feuille).
+    """
+    for attempt in range(max_retries):
         try:
-            voeu_retenu_col = headers.index("Vœux Retenu") + 1
-            matricule_col = headers.index("Matricule") + 1
+            worksheet = get_worksheet(_client, sheet_url, "CAP 2025", priority=PRIORITY_INTERACTIVE)
+            headers = get_sheet_headers(_client, sheet_url, "CAP 2025", header_row=2,
+                                        priority=PRIORITY_INTERACTIVE, refresh=attempt > 0)
+
+            # Colonnes repérées par leur nom canonique ("Voeux 3" et "Vœux 3" désignent la même)
+            columns = {}
+            for i, header in enumerate(headers):
+                columns.setdefault(canonical_column(header), i + 1)
+            if "Matricule" not in columns:
+                raise ValueError("Colonne 'Matricule' introuvable")
+            matricules = sheets_call(lambda: worksheet.col_values(columns["Matricule"]), priority=PRIORITY_INTERACTIVE)
+            try:
+                row = matricules.index(str(matricule), 2) + 1
+            except ValueError:
+                raise ValueError(f"Matricule {matricule} introuvable")
+
+            data = []
+            new_headers = []
+            for col_name, value in values.items():
+                if canonical_column(col_name) not in columns:
+                    if not create_missing:
+                        raise ValueError(f"Colonne '{col_name}' introuvable")
+                    # Ajouter la colonne en fin de ligne d'en-têtes
+                    headers.append(col_name)
+                    new_headers.append(col_name)
+                    columns[canonical_column(col_name)] = len(headers)
+                    data.append({"range": gspread.utils.rowcol_to_a1(2, len(headers)), "values": [[col_name]]})
+                col = columns[canonical_column(col_name)]
+                if col_name in append_cols:
+                    existing = sheets_call(lambda: worksheet.cell(row, col).value, priority=PRIORITY_INTERACTIVE)
+                    value = f"{existing}\n{value}" if existing else value
+                data.append({"range": gspread.utils.rowcol_to_a1(row, col), "values": [[value]]})
+
+            sheets_call(lambda: worksheet.batch_update(data, raw=False), "write", PRIORITY_INTERACTIVE)
+            for col_name in new_headers:
+                register_sheet_header(sheet_url, "CAP 2025", 2, col_name)
+            return True
+
         except ValueError:
-            st.error("Colonnes 'Vœux Retenu' ou 'Matricule' introuvables")
-            return False
-        
-        for idx, row in enumerate(all_values[2:], start=3):
-            if row[matricule_col - 1] == str(matricule):
-                worksheet.update_cell(idx, voeu_retenu_col, poste)
-                st.cache_data.clear()
-                return True
-        
-        st.error("Matricule introuvable")
-        return False
-        
+            # En-têtes mémorisés peut-être périmés : une seule nouvelle tentative après relecture
+            if attempt == 0 and max_retries > 1:
+                continue
+            raise
+        except Exception:
+            invalidate_worksheet(sheet_url, "CAP 2025")
+            if attempt < max_retries - 1:
+                time.sleep(0.5 * (attempt + 1))
+                continue
+            raise
+
+def _confirm_cap2025_update(_client, sheet_url, write_id, matricule, values, local_values, old_values, session_uid, label, **write_options):
+    """Tâche de fond : écrit dans Google Sheets, annule l'application locale en cas d'échec"""
+    store = get_data_store(sheet_url)
+    try:
+        _write_cap2025_cells(_client, sheet_url, matricule, values, **write_options)
     except Exception as e:
-        st.error(f"Erreur lors de la mise à jour : {str(e)}")
-        return False
+        # On ne revient en arrière que si personne n'a modifié ces cellules depuis ;
+        # sinon, on relira la feuille au prochain chargement
+        with store["lock"]:
+            store["pending_cap2025"].pop(write_id, None)
+            if old_values is None or _patch_cap2025_cache(sheet_url, matricule, old_values, expected=local_values) is None:
+                invalidate_dataset(sheet_url, "cap2025")
+        writer = get_cap2025_writer()
+        with writer["lock"]:
+            writer["errors"].setdefault(session_uid, []).append(f"{label} (matricule {matricule}) : {str(e)}")
+    finally:
+        with store["lock"]:
+            store["pending_cap2025"].pop(write_id, None)
+
+def update_cap2025_row(_client, sheet_url, matricule, values, label, append_cols=(), create_missing=False):
+    """
+    Met à jour des colonnes d'un collaborateur dans CAP 2025 :
+    le cache est modifié tout de suite, l'écriture Google Sheets est confirmée en arrière-plan.
+    """
+    store = get_data_store(sheet_url)
+    with store["lock"]:
+        entry = store["entries"].get("cap2025")
+        cached = entry["value"] if entry else None
+
+    row = pd.DataFrame()
+    if cached is not None:
+        columns = {canonical_column(c): c for c in cached.columns}
+        if "Matricule" in columns:
+            row = cached[cached[columns["Matricule"]] == str(matricule)].rename(columns=canonical_column)
+            if row.empty:
+                st.error("Matricule introuvable")
+                return False
+
+    local_values = dict(values)
+    for col in append_cols:
+        existing = row[canonical_column(col)].iloc[0] if canonical_column(col) in row.columns else ""
+        local_values[col] = f"{existing}\n{values[col]}" if existing else values[col]
+
+    # Écriture en attente enregistrée avant l'application locale : toute relecture
+    # publiée d'ici sa confirmation la réappliquera
+    with store["lock"]:
+        write_id = store["next_pending_cap2025"]
+        store["next_pending_cap2025"] += 1
+        store["pending_cap2025"][write_id] = {"matricule": str(matricule), "values": local_values}
+        old_values = _patch_cap2025_cache(sheet_url, matricule, local_values)
+    get_cap2025_writer()["executor"].submit(
+        _confirm_cap2025_update, _client, sheet_url, write_id, matricule, values, local_values, old_values,
+        st.session_state.session_uid, label, append_cols=append_cols, create_missing=create_missing
+    )
+    return True
+
+def pop_cap2025_errors(session_uid):
+    """Échecs d'écriture CAP 2025 de la session, à afficher une seule fois"""
+    writer = get_cap2025_writer()
+    with writer["lock"]:
+        return writer["errors"].pop(session_uid, [])
+
+def update_voeu_retenu(_client, sheet_url, matricule, poste):
+    """
+    Met à jour la colonne 'Vœux Retenu' dans l'onglet CAP 2025
+    """
+    return update_cap2025_row(
+        _client, sheet_url, matricule, {"Vœux Retenu": poste},
+        label="Erreur lors de la mise à jour du vœu retenu"
+    )
 
 # NOUVELLE FONCTION : Mise à jour du Vœu 4
 def update_voeu_4(_client, sheet_url, matricule, poste):
     """
-    Met à jour la colonne 'Voeux 4' dans l'onglet CAP 2025
+    Met à jour la colonne 'Voeux 4' dans l'onglet CAP 2025 (créée si absente)
     """
-    try:
-        spreadsheet = _client.open_by_url(sheet_url)
-        worksheet = spreadsheet.worksheet("CAP 2025")
-        
-        all_values = worksheet.get_all_values()
-        headers = all_values[1]
-        
-        # Vérifier si la colonne Voeux 4 existe, sinon la créer
-        if "Voeux 4" not in headers:
-            # Ajouter la colonne en fin de ligne d'en-têtes
-            voeux_4_col = len(headers) + 1
-            worksheet.update_cell(2, voeux_4_col, "Voeux 4")
-        else:
-            voeux_4_col = headers.index("Voeux 4") + 1
-        
-        try:
-            matricule_col = headers.index("Matricule") + 1
-        except ValueError:
-            st.error("Colonne 'Matricule' introuvable")
-            return False
-        
-        for idx, row in enumerate(all_values[2:], start=3):
-            if row[matricule_col - 1] == str(matricule):
-                worksheet.update_cell(idx, voeux_4_col, poste)
-                st.cache_data.clear()
-                return True
-        
-        st.error("Matricule introuvable")
-        return False
-        
-    except Exception as e:
-        st.error(f"Erreur lors de la mise à jour du Vœu 4 : {str(e)}")
-        return False
+    return update_cap2025_row(
+        _client, sheet_url, matricule, {"Voeux 4": poste},
+        label="Erreur lors de la mise à jour du Vœu 4", create_missing=True
+    )
 
 # NOUVELLE FONCTION : Réorganiser les vœux
 def update_voeux_order(_client, sheet_url, matricule, voeu1, voeu2, voeu3):
     """
     Met à jour l'ordre des vœux dans l'onglet CAP 2025
     """
-    try:
-        spreadsheet = _client.open_by_url(sheet_url)
-        worksheet = spreadsheet.worksheet("CAP 2025")
-        
-        all_values = worksheet.get_all_values()
-        headers = all_values[1]
-        
-        try:
-            voeu1_col = headers.index("Vœux 1") + 1
-            voeu2_col = headers.index("Vœux 2") + 1
-            voeu3_col = headers.index("Voeux 3") + 1
-            matricule_col = headers.index("Matricule") + 1
-        except ValueError as e:
-            st.error(f"Colonnes de vœux introuvables : {str(e)}")
-            return False
-        
-        for idx, row in enumerate(all_values[2:], start=3):
-            if row[matricule_col - 1] == str(matricule):
-                worksheet.update_cell(idx, voeu1_col, voeu1)
-                worksheet.update_cell(idx, voeu2_col, voeu2)
-                worksheet.update_cell(idx, voeu3_col, voeu3)
-                st.cache_data.clear()
-                return True
-        
-        st.error("Matricule introuvable")
-        return False
-        
-    except Exception as e:
-        st.error(f"Erreur lors de la réorganisation des vœux : {str(e)}")
-        return False
+    return update_cap2025_row(
+        _client, sheet_url, matricule, {"Vœux 1": voeu1, "Vœux 2": voeu2, "Voeux 3": voeu3},
+        label="Erreur lors de la réorganisation des vœux"
+    )
 
 def update_commentaire_rh(_client, sheet_url, matricule, commentaire):
     """
     Ajoute un commentaire dans la colonne 'Commentaires RH' de l'onglet CAP 2025
     """
-    try:
-        spreadsheet = _client.open_by_url(sheet_url)
-        worksheet = spreadsheet.worksheet("CAP 2025")
-        
-        all_values = worksheet.get_all_values()
-        headers = all_values[1]
-        
-        try:
-            commentaire_col = headers.index("Commentaires RH") + 1
-            matricule_col = headers.index("Matricule") + 1
-        except ValueError:
-            st.error("Colonnes 'Commentaires RH' ou 'Matricule' introuvables")
-            return False
-        
-        for idx, row in enumerate(all_values[2:], start=3):
-            if row[matricule_col - 1] == str(matricule):
-                existing_comment = row[commentaire_col - 1]
-                new_comment = f"{existing_comment}\n{commentaire}" if existing_comment else commentaire
-                worksheet.update_cell(idx, commentaire_col, new_comment)
-                st.cache_data.clear()
-                return True
-        
-        st.error("Matricule introuvable")
-        return False
-        
-    except Exception as e:
-        st.error(f"Erreur lors de la mise à jour : {str(e)}")
-        return False
-
-def calculate_anciennete(date_str):
-    """Calcule l'ancienneté en années à partir d'une date"""
-    if not date_str or date_str.strip() == "":
-        return "N/A"
-    
-    try:
-        for fmt in ["%d/%m/%Y", "%Y-%m-%d", "%d-%m-%Y"]:
-            try:
-                date_entree = datetime.strptime(date_str, fmt)
-                delta = datetime.now() - date_entree
-                annees = delta.days / 365.25
-                
-                if annees < 1:
-                    return "< 1 année"
-                elif annees < 2:
-                    return "1 année"
-                else:
-                    return f"{int(annees)} années"
-            except ValueError:
-                continue
-        
-        return date_str
-    except:
-        return date_str
-
-def parse_date(date_str):
-    """Parse une date en gérant différents formats"""
-    if not date_str or date_str.strip() == "":
-        return None
-    
-    for fmt in ["%d/%m/%Y", "%Y-%m-%d", "%d-%m-%Y"]:
-        try:
-            return datetime.strptime(date_str, fmt).date()
-        except ValueError:
-            continue
-    return None
+    return update_cap2025_row(
+        _client, sheet_url, matricule, {"Commentaires RH": commentaire},
+        label="Erreur lors de l'ajout du commentaire RH", append_cols=("Commentaires RH",)
+    )
 
 def get_safe_value(value):
     """Retourne une valeur string sûre, évitant les Series pandas"""
@@ -588,43 +1604,53 @@ def get_safe_value(value):
         pass
     return str(value) if value else ""
 
-def to_excel(df):
-    """Convertit un DataFrame en fichier Excel en mémoire avec formatage"""
-    output = io.BytesIO()
-    
-    # ✅ CORRECTION : Utiliser openpyxl au lieu de xlsxwriter
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Données')
-        
-        # Accéder au workbook et à la feuille
-        workbook = writer.book
-        worksheet = writer.sheets['Données']
-        
-        # Formatage des en-têtes
-        from openpyxl.styles import Font, PatternFill, Alignment
-        
-        header_fill = PatternFill(start_color="008080", end_color="008080", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF")
-        
-        for cell in worksheet[1]:
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal="center", vertical="center")
-        
-        # Auto-ajuster la largeur des colonnes
-        for column in worksheet.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 50)
-            worksheet.column_dimensions[column_letter].width = adjusted_width
-    
-    return output.getvalue()
+# --- EXPORTS EXCEL À LA DEMANDE ---
+EXPORT_CACHE_BUDGET = 64 * 1024 * 1024  # octets
+
+@st.cache_resource(show_spinner=False)
+def get_export_cache():
+    """
+    Classeurs Excel déjà générés, partagés par toutes les sessions :
+    clé (Google Sheet, export, versions des jeux sources, filtres actifs). LRU bornée en octets.
+    """
+    return {"lock": threading.Lock(), "entries": OrderedDict(), "bytes": 0}
+
+def excel_export(sheet_url, export, sources, versions, filtres, df):
+    """
+    Contenu à passer à st.download_button(data=...) : le classeur n'est construit
+    qu'au clic, puis servi depuis le cache pour un export identique
+    (mêmes versions des jeux `sources`, mêmes `filtres`).
+    `versions` : {jeu: version} noté au moment où les données de `df` ont été lues
+    (record_versions), jamais relu au moment de l'export : une relecture survenue
+    entre-temps ne peut pas associer ces données à une version plus récente.
+    `df` : DataFrame (une feuille), ou fonction sans argument retournant
+    {titre de feuille: DataFrame}, appelée elle aussi seulement au clic.
+    """
+    versions = tuple(versions.get(name) for name in sources)
+    cle = (sheet_url, export, versions, json.dumps(filtres, sort_keys=True, default=str))
+    cache = get_export_cache()
+    # Version inconnue (jeu invalidé) ou instantané mélangé : pas de mise en cache
+    memorisable = None not in versions
+
+    def _contenu():
+        if memorisable:
+            with cache["lock"]:
+                contenu = cache["entries"].get(cle)
+                if contenu is not None:
+                    cache["entries"].move_to_end(cle)
+                    return contenu
+        contenu = to_excel(df) if isinstance(df, pd.DataFrame) else to_excel_sheets(df())
+        if memorisable:
+            with cache["lock"]:
+                if cle not in cache["entries"]:
+                    cache["entries"][cle] = contenu
+                    cache["bytes"] += len(contenu)
+                while cache["bytes"] > EXPORT_CACHE_BUDGET and len(cache["entries"]) > 1:
+                    _, ancien = cache["entries"].popitem(last=False)
+                    cache["bytes"] -= len(ancien)
+        return contenu
+
+    return _contenu
 
 def get_voeux_alternatifs(df_collabs, matricule, voeu_bloque):
     collab = df_collabs[df_collabs['Matricule'] == matricule]
@@ -646,118 +1672,476 @@ def get_voeux_alternatifs(df_collabs, matricule, voeu_bloque):
             voeux.append(f"V2: {v2}")
     
     if voeu_bloque != "Vœu 3":
-        v3 = get_safe_value(collab.get('Voeux 3', ''))
+        v3 = get_safe_value(collab.get('Vœux 3', ''))
         if v3 and v3 != 'Positionnement manquant':
             voeux.append(f"V3: {v3}")
     
     if voeu_bloque != "Vœu 4":
-        v4 = get_safe_value(collab.get('Voeux 4', ''))
+        v4 = get_safe_value(collab.get('Vœux 4', ''))
         if v4 and v4 != 'Positionnement manquant':
             voeux.append(f"V4: {v4}")
     
     return " | ".join(voeux) if voeux else "Aucun vœu alternatif"
 
+# ========================================
+# INDEX POSTE → CANDIDATS
+# ========================================
+
+# Colonnes de vœux de CAP 2025, par rang
+VOEU_COLUMNS = {1: "Vœux 1", 2: "Vœux 2", 3: "Vœux 3", 4: "Vœux 4"}
+
+def voeux_long(df_collabs):
+    """
+    Vœux de CAP 2025 au format long : une ligne par vœu émis (poste, rank, matricule,
+    nom, prenom, priorite, poste_actuel, voeu_retenu, anciennete,
+    _row = position du collaborateur dans CAP 2025), triée par poste, rang puis ordre de la feuille.
+    Les vœux vides ou « Positionnement manquant » ne sont pas des candidatures.
+    """
+    df = df_collabs
+
+    def column(name):
+        if name not in df.columns:
+            return pd.Series("", index=df.index)
+        return df[name].fillna("").astype(str)
+
+    base = pd.DataFrame({
+        "_row": range(len(df)),
+        "matricule": column("Matricule").values,
+        "nom": column("NOM").values,
+        "prenom": column("Prénom").values,
+        "priorite": column("Priorité").values,
+        "poste_actuel": column("Poste libellé").values,
+        "voeu_retenu": column("Vœux Retenu").values,
+        "anciennete": column(COL_ANCIENNETE).values,
+    })
+    long = pd.concat(
+        [base.assign(poste=column(col).values, rank=rank) for rank, col in VOEU_COLUMNS.items()],
+        ignore_index=True
+    )
+    return long[~long["poste"].isin(["", VOEU_MANQUANT])].sort_values(["poste", "rank", "_row"], kind="stable").reset_index(drop=True)
+
+def build_poste_candidate_index(df_collabs):
+    """
+    Index poste → candidats, construit une seule fois par version de CAP 2025.
+    - "long" : vœux au format long (voir voeux_long) ;
+    - "par_poste" : {poste: sous-tableau de "long"}.
+    """
+    long = voeux_long(df_collabs)
+    return {
+        "long": long,
+        "par_poste": {poste: group for poste, group in long.groupby("poste", sort=False)},
+    }
+
+def get_poste_candidate_index(sheet_url, df_collabs, versions=None):
+    """
+    Index poste → candidats de l'instantané courant (partagé, lecture seule).
+    `df_collabs` ne sert que si CAP 2025 a été invalidé depuis le chargement de la page.
+    """
+    return derived_dataset(
+        sheet_url, "index_candidats", ("cap2025",), build_poste_candidate_index,
+        copy=False, defaults=(df_collabs,), versions=versions
+    )
+
+def candidats_du_poste(index, poste, max_rank=4, first_match=False):
+    """
+    Candidats d'un poste dans l'ordre de CAP 2025.
+    first_match=True : un collaborateur n'est compté qu'une fois, à son meilleur rang.
+    """
+    candidats = index["par_poste"].get(poste)
+    if candidats is None:
+        return index["long"].iloc[0:0]
+    candidats = candidats[candidats["rank"] <= max_rank]
+    if first_match:
+        candidats = candidats.drop_duplicates("_row", keep="first")
+    return candidats.sort_values("_row", kind="stable")
+
  # ========================================
 # FONCTIONS UTILITAIRES & CACHE
 # ========================================
 
-@st.cache_data(ttl=600) # Cache les données pour 10 minutes ou jusqu'au reboot
-def prepare_aggregated_data(df_postes, df_collabs):
+# Colonnes dont dépend le tableau agrégé (noms sans espaces superflus)
+AGREGAT_COLONNES_POSTES = ("Poste", "Direction", "Nombre de postes vacants")
+AGREGAT_COLONNES_COLLABS = ("Poste libellé",) + tuple(VOEU_COLUMNS.values())
+
+def _colonnes_utiles(df, colonnes):
+    return df[[c for c in colonnes if c in df.columns]]
+
+def get_aggregated_data(sheet_url, df_postes, df_collabs, versions=None):
     """
-    Traitement vectorisé optimisé pour la performance.
-    Remplace les boucles for imbriquées par des opérations Pandas natives.
+    Tableau agrégé des vœux, recalculé seulement quand le contenu utile
+    de CAP 2025 ou de Postes a changé (empreinte des colonnes concernées).
+    `df_postes` / `df_collabs` ne servent que si ces jeux ont été invalidés entre-temps.
     """
-    # 1. NETTOYAGE DES POSTES (Le filtre critique demandé)
-    # On normalise la colonne des vacances
-    col_vacants = "Nombre de postes vacants " # Attention à l'espace final dans votre source
-    
-    # Conversion en numérique, les erreurs deviennent NaN
-    df_postes["_vacants_clean"] = pd.to_numeric(df_postes[col_vacants], errors='coerce')
-    
-    # FILTRE STRICT : On ne garde que les postes avec > 0 vacance définie
-    df_p_clean = df_postes[df_postes["_vacants_clean"] > 0].copy()
-    
-    if df_p_clean.empty:
-        return pd.DataFrame()
+    return derived_dataset(
+        sheet_url, "agregats", ("cap2025", "postes"),
+        lambda df_collabs, df_postes: prepare_aggregated_data(df_postes, df_collabs),
+        content_key=lambda df_collabs, df_postes: snapshot_hash(
+            _colonnes_utiles(df_postes, AGREGAT_COLONNES_POSTES),
+            _colonnes_utiles(df_collabs, AGREGAT_COLONNES_COLLABS),
+        ),
+        defaults=(df_collabs, df_postes), versions=versions
+    )
 
-    # 2. PRÉPARATION DES COLLABORATEURS (Format "Long")
-    # On transforme les colonnes Vœux 1, 2, 3, 4 en lignes pour pouvoir grouper
-    # On normalise les noms de colonnes (parfois "Vœux", parfois "Voeux")
-    cols_to_map = {
-        "Vœux 1": "1", "Vœux 2": "2", "Voeux 3": "3", "Voeux 4": "4"
+def prepare_aggregated_data(df_postes, df_collabs):
+    """
+    Tableau agrégé des vœux par poste (page « Tableau agrégé AM »), sans boucle
+    poste × collaborateur : une ligne par poste de l'onglet Postes, dans l'ordre de la feuille.
+    - "Nombre de postes vacants" non renseigné (NA après normalize_postes) : poste ignoré.
+    - Pour chaque rang de vœu (1 à 4) : nombre de candidatures et profils métiers
+      "Poste libellé (nb)" dans l'ordre d'apparition dans CAP 2025.
+    """
+    postes = df_postes
+
+    def column(name):
+        if name not in postes.columns:
+            return pd.Series(pd.NA if name == "Nombre de postes vacants" else "", index=postes.index)
+        return postes[name]
+
+    # 1. FILTRAGE DES POSTES : on ignore ceux dont le nombre de postes vacants est vide
+    vacants = column("Nombre de postes vacants")
+    postes = postes[vacants.notna()]
+    vacants = vacants[vacants.notna()]
+    cles = column("Poste").fillna("").astype(str)
+
+    # 2. COMPTAGES ET PROFILS PAR (poste visé, rang), à partir de l'index poste → candidats
+    long = voeux_long(df_collabs)
+    rangs = list(VOEU_COLUMNS)
+    comptes = long.groupby(["poste", "rank"]).size().unstack(fill_value=0).reindex(columns=rangs, fill_value=0)
+    par_profil = long.groupby(["poste", "rank", "poste_actuel"], sort=False).size().reset_index(name="nb")
+    profils = defaultdict(list)
+    for poste, rank, poste_actuel, nb in par_profil.itertuples(index=False):
+        profils[(poste, rank)].append(f"{poste_actuel} ({nb})")
+
+    # 3. TABLEAU FINAL (mêmes colonnes que l'affichage)
+    table = {
+        "POSTE PROJETE": column("Poste").values,
+        "DIRECTION": column("Direction").values,
+        "POSTES OUVERTS": vacants.astype(int).values,
     }
-    
-    # On s'assure que les colonnes existent
-    existing_cols = [c for c in cols_to_map.keys() if c in df_collabs.columns]
-    
-    # On crée une vue simplifiée : [Poste Actuel, Vœu, Rang]
-    df_melted = df_collabs.melt(
-        id_vars=['Poste libellé'], # Votre colonne poste actuel
-        value_vars=existing_cols,
-        var_name="Source_Voeu",
-        value_name="Poste_Vise"
+    candidatures = {rank: comptes[rank].reindex(cles).fillna(0).astype(int).values for rank in rangs}
+    table["CANDIDATURES TOTAL"] = sum(candidatures.values())
+    for rank in rangs:
+        table[f"CANDIDATURES VŒUX {rank}"] = candidatures[rank]
+        table[f"PROFILS DE METIER / CANDIDAT (Vœux {rank})"] = ["; ".join(profils.get((cle, rank), ())) for cle in cles]
+    return pd.DataFrame(table)
+
+# --- TABLEAU DE COMMISSION RH ---
+# Statuts d'un poste, dans l'ordre d'affichage du tableau de commission
+STATUTS_COMMISSION = ("🟢 POURVU 💯", "🟠 Presque pourvu", "🔴 Disponible", "⚠️ Poste totalement vacant")
+
+def _quota_postes(df_postes, defaut=0):
+    """Quota ("Nombre total de postes", entier depuis normalize_postes) de chaque poste, `defaut` si la colonne manque"""
+    if "Nombre total de postes" not in df_postes.columns:
+        return pd.Series(defaut, index=df_postes.index, dtype=int)
+    return df_postes["Nombre total de postes"].astype(int)
+
+def _noms_par_cle(cles, noms):
+    """{clé: [noms dans l'ordre de CAP 2025]} en un seul parcours"""
+    groupes = defaultdict(list)
+    for cle, nom in zip(cles, noms):
+        groupes[cle].append(nom)
+    return groupes
+
+def compter_postes_satures(df_mobi, v_retenu_clean):
+    """Nombre de postes dont le quota est atteint (vœux retenus déjà nettoyés des espaces)"""
+    nb_retenus = df_mobi["Poste"].astype(str).str.strip().map(v_retenu_clean.value_counts()).fillna(0)
+    return int((nb_retenus >= _quota_postes(df_mobi)).sum())
+
+def build_commission_table(df_postes, df_collabs, voeux, priorites=None):
+    """
+    Tableau de la Commission RH : une ligne par poste ouvert à la mobilité (ordre de l'onglet Postes).
+    - Retenus : collaborateurs dont "Vœux Retenu" est ce poste ;
+    - V1 à V4 : collaborateurs sans vœu retenu ayant ce poste en vœu n, limités à `priorites` si fournies ;
+    - Proposition Comité de mobilité : collaborateurs proposés sur ce poste.
+    `voeux` est le format long de CAP 2025 (index poste → candidats).
+    Retourne (tableau, candidats) ; `candidats` (poste, rank, nom_complet, priorite, matricule)
+    sert aussi à la section de repositionnement.
+    """
+    df_mobi = df_postes[df_postes["Mobilité interne"].str.lower() == "oui"]
+    postes = df_mobi["Poste"].tolist()
+    quota = _quota_postes(df_mobi).values
+
+    def column(name):
+        return df_collabs[name].fillna("").astype(str)
+
+    noms = column("Prénom") + " " + column("NOM")
+
+    # Retenus
+    retenus = _noms_par_cle(df_collabs["Vœux Retenu"], noms)
+    nb_retenus = pd.Series([len(retenus.get(p, ())) for p in postes], dtype=int).values
+
+    # Proposition Comité de mobilité
+    col_proposition = "Proposition Comité de mobilité"
+    if col_proposition in df_collabs.columns:
+        noms_proposition = noms.str.strip()
+        avec_nom = noms_proposition != ""
+        propositions = _noms_par_cle(
+            column(col_proposition).str.strip()[avec_nom], noms_proposition[avec_nom]
+        )
+    else:
+        propositions = {}
+
+    # Candidats en attente (sans vœu retenu) par (poste, rang)
+    candidats = voeux[voeux["voeu_retenu"] == ""]
+    if priorites:
+        candidats = candidats[candidats["priorite"].isin(priorites)]
+    candidats = candidats.assign(nom_complet=candidats["prenom"] + " " + candidats["nom"])
+    par_rang = _noms_par_cle(zip(candidats["poste"], candidats["rank"]), candidats["nom_complet"])
+
+    # Statut : pourvu > totalement vacant > presque pourvu (≤ 2 places) > disponible
+    places = quota - nb_retenus
+    statut = (
+        pd.Series(STATUTS_COMMISSION[2], index=range(len(postes)))
+        .mask(places <= 2, STATUTS_COMMISSION[1])
+        .mask(nb_retenus == 0, STATUTS_COMMISSION[3])
+        .mask(nb_retenus >= quota, STATUTS_COMMISSION[0])
     )
-    
-    # Nettoyage des vœux vides
-    df_melted = df_melted[df_melted["Poste_Vise"].notna() & (df_melted["Poste_Vise"] != "")]
-    df_melted["Rang"] = df_melted["Source_Voeu"].map(cols_to_map).astype(int)
-
-    # 3. AGGRÉGATION (Comptage et Profils)
-    # Compte total par poste visé
-    counts = df_melted.groupby("Poste_Vise").size().reset_index(name="CANDIDATURES TOTAL")
-    
-    # Compte par rang (Vœu 1, Vœu 2...)
-    pivot_ranks = df_melted.pivot_table(
-        index="Poste_Vise", 
-        columns="Rang", 
-        aggfunc='size', 
-        fill_value=0
-    ).add_prefix("Vœu ")
-    
-    # Agrégation des profils métiers (concaténation de texte optimisée)
-    # Ex: On veut savoir d'où viennent les gens pour le Vœu 1
-    v1_only = df_melted[df_melted["Rang"] == 1]
-    
-    def get_profiles_summary(sub_df):
-        if sub_df.empty: return ""
-        counts = sub_df['Poste libellé'].value_counts()
-        return "; ".join([f"{metier} ({nb})" for metier, nb in counts.items()])
-
-    # On applique cela pour chaque poste visé (uniquement sur le Vœu 1 pour alléger, ou tout)
-    profiles_summary = v1_only.groupby("Poste_Vise").apply(get_profiles_summary).reset_index(name="PROFILS (V1)")
-
-    # 4. FUSION FINALE
-    # On part des postes ouverts (Master Data)
-    df_final = df_p_clean.merge(counts, left_on="Poste", right_on="Poste_Vise", how="left")
-    df_final = df_final.merge(pivot_ranks, left_on="Poste", right_index=True, how="left")
-    df_final = df_final.merge(profiles_summary, left_on="Poste", right_on="Poste_Vise", how="left")
-    
-    # Remplir les NaN par 0 pour les chiffres
-    numeric_cols = ["CANDIDATURES TOTAL"] + [c for c in df_final.columns if c.startswith("Vœu ")]
-    df_final[numeric_cols] = df_final[numeric_cols].fillna(0)
-    
-    # Calcul de la tension (Candidats / Postes)
-    df_final["Tension"] = df_final["CANDIDATURES TOTAL"] / df_final["_vacants_clean"]
-    
-    # Sélection et renommage propre pour l'affichage
-    display_cols = {
-        "Poste": "POSTE PROJETE",
-        "Direction": "DIRECTION",
-        "_vacants_clean": "POSTES OUVERTS",
-        "CANDIDATURES TOTAL": "TOTAL CANDIDATS",
-        "Tension": "TENSION",
-        "PROFILS (V1)": "ORIGINE CANDIDATS (V1)"
+
+    table = {
+        "Statut": statut.values,
+        "Poste": postes,
+        "Direction": df_mobi["Direction"].tolist(),
+        "Quota": quota,
+        "Retenus": nb_retenus,
+        "Places": places,
+        "Nbre Prop CM": [len(propositions.get(p, ())) for p in postes],
+        "Liste des retenus": ["; ".join(retenus.get(p, ())) for p in postes],
     }
-    # Ajouter les colonnes de voeux dynamiquement
-    for col in df_final.columns:
-        if col.startswith("Vœu "):
-            display_cols[col] = col.upper()
+    for rank in VOEU_COLUMNS:
+        noms_rang = [par_rang.get((str(p), rank), ()) for p in postes]
+        table[f"V{rank}"] = [len(n) for n in noms_rang]
+        table[f"Candidats V{rank}"] = ["; ".join(n) for n in noms_rang]
+    table["Proposition Comité de Mobilité"] = ["; ".join(propositions.get(p, ())) for p in postes]
+    return pd.DataFrame(table), candidats[["poste", "rank", "nom_complet", "priorite", "matricule", "_row"]]
+
+# --- ANALYSE PAR POSTE (viviers et tension) ---
+def build_job_analysis(df_postes, voeux, df_collabs):
+    """
+    Analyse des viviers des postes ouverts à la mobilité (ordre de l'onglet Postes) :
+    postes totaux, attribués ("Vœux Retenu"), ouverts, candidats et statut de tension.
+    Un candidat est compté une fois par poste, à son meilleur vœu (V1 à V4).
+    Retourne (analyse, candidats) ; `candidats` (poste, nom_affiche, matricule, une ligne
+    par candidat dans l'ordre de CAP 2025) n'est filtré que pour le poste consulté.
+    """
+    df_mobi = df_postes[df_postes["Mobilité interne"].str.lower() == "oui"]
+    postes = df_mobi["Poste"]
+    # Un poste par défaut si la colonne manque, comme l'ancienne Analyse par Poste
+    nb_total = _quota_postes(df_mobi, defaut=1)
+    retenus = df_collabs["Vœux Retenu"].value_counts()
+    nb_attribues = postes.map(retenus[retenus > 0]).fillna(0).astype(int)
+    nb_disponibles = nb_total - nb_attribues
+
+    # Meilleur vœu de chaque collaborateur pour chaque poste, dans l'ordre de CAP 2025
+    candidats = voeux.drop_duplicates(["poste", "_row"]).sort_values(["poste", "_row"], kind="stable")
+    poste_actuel = candidats["poste_actuel"].where(candidats["poste_actuel"] != "", "N/A")
+    candidats = candidats.assign(
+        nom_affiche=candidats["nom"] + " " + candidats["prenom"],
+        label=(candidats["nom"] + " " + candidats["prenom"] + " (V" + candidats["rank"].astype(str)
+               + ") - Actuellement : \"" + poste_actuel + "\""),
+    )
+    labels = _noms_par_cle(candidats["poste"], candidats["label"])
+    cles = postes.astype(str)
+    nb_candidats = pd.Series([len(labels.get(p, ())) for p in cles], index=postes.index, dtype=int)
+
+    # Statut : pourvu > aucun candidat > manque > vivier actif > niveau de tension (candidats / places)
+    ratio = (nb_candidats / nb_disponibles).where(nb_disponibles > 0, nb_candidats)
+    statut = (
+        pd.Series("🔴🔴 Très forte tension", index=postes.index)
+        .mask(ratio <= 3, "🔴 Forte tension")
+        .mask(ratio <= 2, "🔶 Tension")
+        .mask(nb_candidats == nb_disponibles, "✅ Vivier actif")
+        .mask(nb_candidats < nb_disponibles, "⚠️ Manque " + (nb_disponibles - nb_candidats).astype(str) + " candidat(s)")
+        .mask(nb_candidats == 0, "⚠️ Aucun candidat")
+        .mask(nb_disponibles == 0, "✅ Poste(s) pourvu(s)")
+    )
 
-    df_final = df_final.rename(columns=display_cols)
-    
-    # On garde les colonnes pertinentes
-    final_columns = list(display_cols.values())
-    return df_final[final_columns]           
+    analyse = pd.DataFrame({
+        "Poste": postes,
+        "Direction": df_mobi["Direction"] if "Direction" in df_mobi.columns else "N/A",
+        "Postes totaux": nb_total,
+        "Ouverts mobilité": nb_disponibles,
+        "Postes attribués": nb_attribues,
+        "Nb_Candidats": nb_candidats,
+        "Candidats": [", ".join(labels.get(p, ())) for p in cles],
+        "Statut": statut,
+    }).reset_index(drop=True)
+    return analyse, candidats[["poste", "nom_affiche", "matricule"]].reset_index(drop=True)
+
+def get_job_analysis(sheet_url, df_postes, df_collabs, versions=None):
+    """Analyse par poste de l'instantané courant, recalculée seulement si CAP 2025 ou Postes changent"""
+    return derived_dataset(
+        sheet_url, "analyse_postes", ("cap2025", "postes"),
+        lambda collabs, postes: build_job_analysis(postes, voeux_long(collabs), collabs),
+        defaults=(df_collabs, df_postes), versions=versions
+    )
+
+# ========================================
+# TABLEAUX DES PAGES ET EXPORT CAMPAGNE
+# ========================================
+
+def _texte(df, col, defaut=""):
+    """Colonne en texte sûr (get_safe_value), `defaut` si la colonne est absente"""
+    if col not in df.columns:
+        return pd.Series(defaut, index=df.index, dtype=object)
+    return df[col].astype(object).map(get_safe_value)
+
+def build_candidatures_table(df_collabs):
+    """Tableau de la page Gestion des Candidatures (une ligne par collaborateur, Matricule en dernier)"""
+    date_rdv = _texte(df_collabs, "Date de rdv")
+    heure_rdv = _texte(df_collabs, "Heure de rdv")
+    a_date = date_rdv.str.strip() != ""
+    a_heure = heure_rdv.str.strip() != ""
+    entretien = date_rdv.where(~a_heure, date_rdv + " à " + heure_rdv).where(a_date, "")
+
+    assessment = _texte(df_collabs, "Assesment à planifier O/N", "Non")
+    assessment = assessment.where(assessment.str.strip() != "", "Non")
+
+    manager_actuel = (_texte(df_collabs, "Prénom Manager") + " " + _texte(df_collabs, "Nom Manager")).str.strip()
+
+    def voeu(col):
+        valeur = _texte(df_collabs, col)
+        return valeur.where(valeur != VOEU_MANQUANT, "")
+
+    table = pd.DataFrame({
+        "Prénom": _texte(df_collabs, "Prénom"),
+        "NOM": _texte(df_collabs, "NOM"),
+        "Poste actuel": _texte(df_collabs, "Poste libellé"),
+        "CSP": _texte(df_collabs, "CSP"),
+        "Classification": _texte(df_collabs, "Classification"),
+        "Manager": _texte(df_collabs, "Manager"),
+        "Nomade": _texte(df_collabs, "Nomade"),
+        "Ancienneté": df_collabs[COL_ANCIENNETE].astype(object),
+        "Direction": _texte(df_collabs, "Direction libellé"),
+        "Manager actuel": manager_actuel,
+        "Rencontre RH": _texte(df_collabs, "Rencontre RH / Positionnement"),
+        "Priorité": _texte(df_collabs, "Priorité"),
+        "Référente RH": _texte(df_collabs, "Référente RH"),
+        "📅 Entretien": entretien,
+        "Vœu 1": _texte(df_collabs, "Vœux 1"),
+        "Vœu 2": voeu("Vœux 2"),
+        "Vœu 3": voeu("Vœux 3"),
+        "Assessment": assessment,
+        "Date Assessment": _texte(df_collabs, "Date Assessment"),
+        "Vœux Retenu": _texte(df_collabs, "Vœux Retenu"),
+        "Commentaires RH": _texte(df_collabs, "Commentaires RH"),
+        "Matricule": _texte(df_collabs, "Matricule"),
+    })
+    return table.reset_index(drop=True)
+
+def build_mouvements_table(df_collabs, df_postes):
+    """Tableau des mouvements individuels : poste actuel → poste retenu et type de mouvement"""
+    # Mapping Poste → Direction (dernière ligne de l'onglet Postes pour un libellé)
+    poste_to_direction = {}
+    if not df_postes.empty:
+        for poste_name, direction_name in zip(_texte(df_postes, "Poste"), _texte(df_postes, "Direction")):
+            if poste_name:
+                poste_to_direction[poste_name] = direction_name
+
+    retenu = df_collabs["Vœux Retenu"].astype(object)
+    direction_cible = retenu.map(poste_to_direction)
+    sans_positionnement = retenu.isna() | (retenu == "")
+    change_direction = df_collabs["Direction libellé"].astype(object) != direction_cible
+    type_mouvement = (
+        pd.Series("Même direction", index=df_collabs.index)
+        .mask(change_direction, "Changement de direction")
+        .mask(sans_positionnement, "Sans positionnement")
+    )
+
+    table = df_collabs[[
+        'Matricule', 'NOM', 'Prénom',
+        'Direction libellé', 'Service libellé', 'Poste libellé',
+        'Vœux Retenu'
+    ]].copy()
+    table['Direction_Cible'] = direction_cible
+    table['Type_Mouvement'] = type_mouvement
+    # Colonnes facultatives de CAP 2025 : texte vide si absentes
+    table['Priorité'] = _texte(df_collabs, 'Priorité')
+    table['Date de rdv'] = _texte(df_collabs, 'Date de rdv')
+
+    return table.rename(columns={
+        'NOM': 'Nom',
+        'Direction libellé': 'Direction actuelle',
+        'Service libellé': 'Service actuel',
+        'Poste libellé': 'Poste actuel',
+        'Vœux Retenu': 'Poste cible',
+        'Direction_Cible': 'Direction cible',
+        'Type_Mouvement': 'Type de mouvement',
+        'Date de rdv': 'Date RDV'
+    })
+
+def build_entretiens_table(df_collabs):
+    """Liste des entretiens RH (collaborateurs ayant une date de rdv), triée par date puis heure"""
+    date_rdv = _texte(df_collabs, "Date de rdv")
+    avec_rdv = date_rdv.str.strip() != ""
+    sub = df_collabs[avec_rdv]
+    table = pd.DataFrame({
+        'Date': date_rdv[avec_rdv],
+        'Heure': _texte(sub, 'Heure de rdv'),
+        'Collaborateur': (_texte(sub, 'Prénom') + " " + _texte(sub, 'NOM')).str.upper(),
+        'Direction': _texte(sub, 'Direction libellé'),
+        'RRH': _texte(sub, 'Référente RH'),
+        'Vœu Retenu': _texte(sub, 'Vœux Retenu'),
+        'Mail': _texte(sub, 'Mail'),
+        'Priorité': _texte(sub, 'Priorité'),
+    })
+    return table.sort_values(by=['Date', 'Heure']).reset_index(drop=True)
+
+def sort_commission_table(df_commission):
+    """Tableau de Commission trié par statut (pourvus d'abord), puis direction et poste"""
+    ordre_statut = {statut: i for i, statut in enumerate(STATUTS_COMMISSION, start=1)}
+    return (
+        df_commission.assign(_ordre=df_commission['Statut'].map(ordre_statut))
+        .sort_values(['_ordre', 'Direction', 'Poste'])
+        .drop(columns=['_ordre'])
+    )
+
+def build_repositionnement_table(df_commission, candidats_commission, df_collabs):
+    """
+    Candidats en attente sur les postes pourvus du tableau de Commission,
+    dans l'ordre du tableau puis du vœu, avec leurs vœux alternatifs.
+    """
+    postes_pourvus = df_commission.loc[df_commission['Statut'] == STATUTS_COMMISSION[0], ['Poste']]
+    postes_pourvus = postes_pourvus.assign(poste=postes_pourvus['Poste'].astype(str), _ordre=range(len(postes_pourvus)))
+    df_repo = (
+        postes_pourvus.merge(candidats_commission, on='poste')
+        .sort_values(['_ordre', 'rank', '_row'])
+    )
+    if df_repo.empty:
+        return pd.DataFrame(columns=['Nom', 'Poste pourvu', 'Vœu bloqué', 'Priorité', 'Matricule', 'Vœux alternatifs'])
+
+    df_repo = pd.DataFrame({
+        'Nom': df_repo['nom_complet'].values,
+        'Poste pourvu': df_repo['Poste'].values,
+        'Vœu bloqué': ("Vœu " + df_repo['rank'].astype(str)).values,
+        'Priorité': df_repo['priorite'].values,
+        'Matricule': df_repo['matricule'].values
+    })
+    df_repo['Vœux alternatifs'] = df_repo.apply(lambda r: get_voeux_alternatifs(df_collabs, r['Matricule'], r['Vœu bloqué']), axis=1)
+    return df_repo
+
+def build_campaign_sheets(df_collabs, df_postes):
+    """
+    Feuilles du classeur « export campagne », toutes calculées sur le même
+    instantané CAP 2025 / Postes, sans filtre. Tout part des deux DataFrames reçus
+    (jamais des jeux dérivés du cache, qui peuvent avoir changé depuis) :
+    les vœux au format long sont construits une fois pour la Commission et l'analyse
+    par poste ; le tableau de Commission alimente aussi le Repositionnement.
+    """
+    avec_matricule = df_collabs[df_collabs["Matricule"].notna() & (df_collabs["Matricule"].astype(str).str.strip() != "")]
+    voeux = voeux_long(df_collabs)
+
+    df_commission, candidats_commission = build_commission_table(df_postes, df_collabs, voeux)
+    df_commission = sort_commission_table(df_commission)
+
+    return {
+        "Candidatures": build_candidatures_table(avec_matricule).drop(columns=["Matricule"]),
+        "Agrégé": prepare_aggregated_data(df_postes, df_collabs).sort_values("CANDIDATURES TOTAL", ascending=False),
+        "Analyse par Poste": build_job_analysis(df_postes, voeux, df_collabs)[0],
+        "Commission": df_commission,
+        "Repositionnement": build_repositionnement_table(df_commission, candidats_commission, df_collabs).drop(columns=["Matricule"]),
+        "Mouvements": build_mouvements_table(df_collabs, df_postes),
+        "Entretiens": build_entretiens_table(df_collabs),
+    }
 
 def badge_priorite(p):
     colors = {
@@ -958,6 +2342,412 @@ def create_treemap(org_structure, title):
     
     return fig
 
+def get_org_treemaps(sheet_url, df_collabs, df_postes):
+    """Treemaps organisation actuelle / CAP 2025, reconstruits seulement si CAP 2025 ou Postes changent"""
+    def _build(collabs, postes):
+        return (
+            create_treemap(create_org_structure(collabs, postes, mode="actuel"), "Structure Actuelle"),
+            create_treemap(create_org_structure(collabs, postes, mode="cap2025"), "Structure CAP 2025"),
+        )
+    # Figures Plotly en lecture seule : pas de copie défensive
+    return derived_dataset(
+        sheet_url, "treemaps", ("cap2025", "postes"), _build,
+        copy=False, defaults=(df_collabs, df_postes)
+    )
+
+def get_sankey_figure(sheet_url, df_collabs, df_postes):
+    """Sankey toutes directions confondues, reconstruit seulement si CAP 2025 ou Postes changent"""
+    return derived_dataset(
+        sheet_url, "sankey", ("cap2025", "postes"), create_sankey_diagram,
+        copy=False, defaults=(df_collabs, df_postes)
+    )
+
+# --- CACHE DES PAGES PDF RASTÉRISÉES (ORGANIGRAMMES ANNOTÉS) ---
+RASTER_CACHE_BUDGET = 256 * 1024 * 1024  # octets (RGBA non compressé)
+
+@st.cache_resource(show_spinner=False)
+def get_raster_cache():
+    """
+    Pages PDF rastérisées sans annotation, partagées par toutes les sessions.
+    LRU bornée en octets : clé (pdf, date de modification, page, échelle).
+    Les fichiers de police ne sont lus qu'une fois (octets, chemin → bytes).
+    """
+    return {
+        "lock": threading.Lock(),
+        "pages": OrderedDict(),
+        "bytes": 0,
+        "fonts": {},
+    }
+
+def _font_bytes(path):
+    """Contenu du fichier de police, lu une seule fois (None si introuvable)"""
+    cache = get_raster_cache()
+    with cache["lock"]:
+        if path in cache["fonts"]:
+            return cache["fonts"][path]
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        data = None
+    with cache["lock"]:
+        cache["fonts"][path] = data
+    return data
+
+def load_font(path, size):
+    """
+    Police TrueType propre à l'appelant (police par défaut de Pillow si introuvable).
+    Seuls les octets du fichier sont partagés : FreeType n'est pas sûr entre threads,
+    un même objet police ne doit pas servir à deux rendus simultanés.
+    """
+    return _rendu.police(_font_bytes(path), size)
+
+def _raster_key(pdf_path, page_idx, scale):
+    return (pdf_path, os.path.getmtime(pdf_path), page_idx, scale)
+
+# pdfium n'est pas sûr entre threads : un seul appel à la fois dans tout le processus
+_PDFIUM_LOCK = threading.Lock()
+
+def _rasterize(pdf_path, page_idx, scale):
+    """Rastérise une page du PDF en RGBA (sans passer par le cache)"""
+    with _PDFIUM_LOCK:
+        doc = _pdfium.PdfDocument(pdf_path)
+        try:
+            return doc[page_idx].render(scale=scale).to_pil().convert("RGBA")
+        finally:
+            doc.close()
+
+def cached_page_raster(pdf_path, page_idx, scale):
+    """Page de base si elle est déjà dans la LRU, None sinon (sans rastériser)"""
+    cache = get_raster_cache()
+    key = _raster_key(pdf_path, page_idx, scale)
+    with cache["lock"]:
+        img = cache["pages"].get(key)
+        if img is not None:
+            cache["pages"].move_to_end(key)
+        return img
+
+def base_page_raster(pdf_path, page_idx, scale):
+    """
+    Image RGBA de la page `page_idx` du PDF à l'échelle `scale`, servie depuis
+    la LRU si possible. L'image retournée est partagée : ne pas la modifier.
+    """
+    img = cached_page_raster(pdf_path, page_idx, scale)
+    if img is not None:
+        return img
+
+    cache = get_raster_cache()
+    key = _raster_key(pdf_path, page_idx, scale)
+    img = _rasterize(pdf_path, page_idx, scale)
+    taille = img.width * img.height * 4
+
+    with cache["lock"]:
+        if key not in cache["pages"]:
+            cache["pages"][key] = img
+            cache["bytes"] += taille
+        cache["pages"].move_to_end(key)
+        # Éviction des pages les moins récemment utilisées (on garde toujours la dernière)
+        while cache["bytes"] > RASTER_CACHE_BUDGET and len(cache["pages"]) > 1:
+            _, ancienne = cache["pages"].popitem(last=False)
+            cache["bytes"] -= ancienne.width * ancienne.height * 4
+        return cache["pages"][key]
+
+# --- RÉSOLUTION DES LIBELLÉS DE POSTE (ORGANIGRAMMES) ---
+def normalize_poste(label):
+    """Libellé sans accents, en minuscules, espaces normalisés"""
+    texte = unicodedata.normalize("NFKD", str(label))
+    texte = "".join(ch for ch in texte if not unicodedata.combining(ch))
+    return " ".join(texte.lower().split())
+
+def build_poste_lookup(mapping):
+    """
+    Index de résolution des libellés d'un dictionnaire {libellé de poste: valeur}.
+    Recherche exacte sur le libellé normalisé, puis index de trigrammes pour les
+    correspondances partielles (l'un contient l'autre, y compris au milieu d'un
+    mot : « Assistant » → « Assistante de direction »). Les résultats sont
+    mémorisés ; les correspondances ambiguës sont relevées dans "ambigus".
+    Index partagé entre threads : "memo" et "ambigus" sont protégés par "lock".
+    """
+    exact = {}
+    libelles = []
+    trigrammes = defaultdict(list)
+    nb_trigrammes = []
+    courts = []
+    for label in mapping:
+        norm = normalize_poste(label)
+        if not norm:
+            continue
+        exact.setdefault(norm, label)
+        position = len(libelles)
+        libelles.append((norm, label))
+        propres = _trigrammes(norm)
+        for trigramme in propres:
+            trigrammes[trigramme].append(position)
+        nb_trigrammes.append(len(propres))
+        if not propres:
+            # Moins de 3 caractères : vérifiés directement
+            courts.append(position)
+    return {"map": mapping, "exact": exact, "libelles": libelles,
+            "trigrammes": dict(trigrammes), "nb_trigrammes": nb_trigrammes, "courts": courts,
+            "memo": {}, "ambigus": {}, "lock": threading.Lock()}
+
+def _trigrammes(texte):
+    """Ensemble des sous-chaînes de 3 caractères de `texte`"""
+    return {texte[k:k + 3] for k in range(len(texte) - 2)}
+
+def _correspondances_partielles(lookup, q):
+    """
+    Libellés dont le libellé normalisé contient `q` ou est contenu dans `q`,
+    dans l'ordre du dictionnaire. Une chaîne contenue dans une autre en partage
+    tous les trigrammes : seuls les libellés ayant tous leurs trigrammes dans `q`,
+    ou tous ceux de `q`, sont vérifiés.
+    """
+    libelles = lookup["libelles"]
+    propres = _trigrammes(q)
+    communs = defaultdict(int)
+    for trigramme in propres:
+        for position in lookup["trigrammes"].get(trigramme, ()):
+            communs[position] += 1
+    candidats = [
+        position for position, nombre in communs.items()
+        if nombre == len(propres) or nombre == lookup["nb_trigrammes"][position]
+    ]
+    candidats += lookup["courts"]
+    if not propres:
+        # Recherche de moins de 3 caractères : aucun trigramme pour filtrer
+        candidats = range(len(libelles))
+    return [
+        libelles[position][1] for position in sorted(set(candidats))
+        if libelles[position][0] in q or q in libelles[position][0]
+    ]
+
+def resolve_poste(lookup, query):
+    """Libellé du dictionnaire correspondant à `query`, None si aucun"""
+    if not query:
+        return None
+    with lookup["lock"]:
+        if query in lookup["memo"]:
+            return lookup["memo"][query]
+    q = normalize_poste(query)
+    label = lookup["exact"].get(q)
+    trouves = []
+    if label is None and q:
+        trouves = _correspondances_partielles(lookup, q)
+        if trouves:
+            # Premier libellé dans l'ordre du dictionnaire, comme l'ancien parcours linéaire
+            label = trouves[0]
+    with lookup["lock"]:
+        if len(trouves) > 1:
+            lookup["ambigus"][query] = trouves
+        lookup["memo"][query] = label
+    return label
+
+def lookup_poste(lookup, query, default=None):
+    """Valeur associée au poste `query` (correspondance souple), `default` si aucune"""
+    label = resolve_poste(lookup, query)
+    return default if label is None else lookup["map"][label]
+
+def poste_infos(df_postes):
+    """{Poste: (mobilité interne, nombre total, nombre de vacants)}, première ligne par libellé"""
+    infos = {}
+    if df_postes.empty or "Poste" not in df_postes.columns:
+        return infos
+    for poste, mobilite, total, vac in zip(
+        df_postes["Poste"].astype(str),
+        df_postes.get("Mobilité interne", pd.Series("", index=df_postes.index)).astype(str),
+        df_postes.get("Nombre total de postes", pd.Series(0, index=df_postes.index)),
+        df_postes.get("Nombre de postes vacants", pd.Series(pd.NA, index=df_postes.index)),
+    ):
+        # Colonnes typées au chargement (vacants NA si non renseigné)
+        infos.setdefault(poste, (
+            mobilite.lower().strip() == "oui",
+            int(total),
+            0 if pd.isna(vac) else int(vac),
+        ))
+    return infos
+
+def get_postes_lookup(sheet_url, df_postes):
+    """Résolveur des postes du référentiel, construit une fois par version de l'onglet Postes"""
+    return derived_dataset(
+        sheet_url, "resolveur_postes", ("postes",),
+        lambda postes: build_poste_lookup(poste_infos(postes)),
+        copy=False, defaults=(df_postes,)
+    )
+
+def show_ambiguous_postes(*lookups):
+    """Expander listant les libellés résolus parmi plusieurs postes possibles"""
+    ambigus = {}
+    for lookup in lookups:
+        with lookup["lock"]:
+            ambigus.update(lookup["ambigus"])
+    if not ambigus:
+        return
+    with st.expander(f"⚠️ {len(ambigus)} correspondance(s) de poste ambiguë(s)", expanded=False):
+        st.caption("Le premier libellé est retenu ; préciser le libellé dans la cartographie pour lever l'ambiguïté.")
+        st.dataframe(
+            pd.DataFrame([
+                {"Libellé recherché": query, "Retenu": trouves[0], "Autres correspondances": " | ".join(trouves[1:])}
+                for query, trouves in sorted(ambigus.items())
+            ]),
+            hide_index=True, use_container_width=True
+        )
+
+def find_noms_poste(candidats, pos_name):
+    """Noms retenus pour une boîte de l'organigramme (correspondance souple), None si vacant"""
+    return lookup_poste(candidats, pos_name)
+
+def noms_des_boites(positions, candidats):
+    """{boîte: noms retenus, None si vacant} pour les boîtes d'une page"""
+    return {pos_name: find_noms_poste(candidats, pos_name) for pos_name in positions}
+
+def annotate_page(img, positions, candidats, scale, fb, fr):
+    """Compose les badges (retenu / vacant) sur une page de base et retourne le PNG"""
+    return _rendu.compose_badges(img, positions, noms_des_boites(positions, candidats), scale, fb, fr)
+
+# Délai maximal d'attente du rendu d'une page de l'export (processus bloqué ou tué)
+EXPORT_PAGE_TIMEOUT_SECONDS = 120
+
+class _PageDifferee:
+    """Page de l'export lue par img2pdf (read()) dès que son rendu est terminé"""
+
+    def __init__(self, future, on_read):
+        self.future = future
+        self.on_read = on_read
+
+    def read(self):
+        png = self.future.result(timeout=EXPORT_PAGE_TIMEOUT_SECONDS)
+        self.on_read()
+        return png
+
+def export_annotated_pdf(pdf_path, pos_map, candidats, scale, font_bold, font_reg, progress=None):
+    """
+    PDF annoté de toutes les pages de `pos_map`.
+    - pages déjà rastérisées dans la LRU : seuls les badges sont composés, dans des threads ;
+    - autres pages : rendu complet (pdfium, badges, PNG) en parallèle dans un pool de
+      processus « forkserver » qui n'importe que organigramme_rendu (document ouvert
+      dans chaque processus, aucun verrou hérité du serveur Streamlit) ;
+    - assemblage au fil de l'eau : img2pdf lit chaque page, dans l'ordre, dès qu'elle
+      est prête, pendant que les pages suivantes sont encore rendues.
+    `progress(faites, total)` est appelé depuis le thread appelant à chaque page assemblée.
+    Sans forkserver (Windows), les pages manquantes sont rastérisées dans la LRU, un appel
+    pdfium à la fois, et composées dans les threads.
+    """
+    import img2pdf as _img2pdf
+
+    pages = sorted(pos_map.keys())
+    total = len(pages)
+    taille_bold, taille_reg = max(10, int(13 * scale)), max(9, int(11 * scale))
+
+    def _composer(page_idx, img=None):
+        if img is None:
+            img = base_page_raster(pdf_path, page_idx, scale)
+        return annotate_page(img, pos_map[page_idx], candidats, scale,
+                             load_font(font_bold, taille_bold), load_font(font_reg, taille_reg))
+
+    en_cache = {page_idx: cached_page_raster(pdf_path, page_idx, scale) for page_idx in pages}
+    a_rendre = [page_idx for page_idx in pages if en_cache[page_idx] is None]
+
+    threads = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="export-organigramme")
+    pool = None
+    if a_rendre and "forkserver" in multiprocessing.get_all_start_methods():
+        contexte = multiprocessing.get_context("forkserver")
+        # Le serveur de processus ne charge que le module de rendu, jamais le script Streamlit
+        contexte.set_forkserver_preload(["organigramme_rendu"])
+        pool = ProcessPoolExecutor(max_workers=min(len(a_rendre), os.cpu_count() or 1), mp_context=contexte)
+
+    assemblees = 0
+
+    def _assemblee():
+        nonlocal assemblees
+        assemblees += 1
+        if progress is not None:
+            progress(assemblees, total)
+
+    try:
+        futures = []
+        for page_idx in pages:
+            if en_cache[page_idx] is not None:
+                futures.append(threads.submit(_composer, page_idx, en_cache[page_idx]))
+            elif pool is not None:
+                positions = pos_map[page_idx]
+                futures.append(pool.submit(
+                    _rendu.render_page, pdf_path, page_idx, scale, positions,
+                    noms_des_boites(positions, candidats), font_bold, font_reg
+                ))
+            else:
+                futures.append(threads.submit(_composer, page_idx))
+        return _img2pdf.convert([_PageDifferee(future, _assemblee) for future in futures])
+    finally:
+        threads.shutdown(wait=False, cancel_futures=True)
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+# --- CACHE DES ORGANIGRAMMES GRAPHVIZ ---
+GRAPHVIZ_CACHE_MAX = 64  # entrées (direction, empreinte des effectifs)
+
+@st.cache_resource(show_spinner=False)
+def get_graphviz_cache():
+    """
+    Artefacts Graphviz partagés par toutes les sessions : source DOT, SVG mis
+    en page et PDF, par (direction, empreinte des données utilisées par la
+    direction). Une direction dont les effectifs n'ont pas changé n'est ni
+    regénérée ni remise en page. LRU bornée en nombre d'entrées.
+    """
+    return {"lock": threading.Lock(), "entries": OrderedDict()}
+
+def staffing_hash(staffing):
+    """Empreinte des informations postes / candidats affichées par une direction"""
+    return hashlib.sha1(repr(sorted(staffing.items())).encode("utf-8")).hexdigest()
+
+def _pipe_dot(source, fmt):
+    """Mise en page Graphviz d'une source DOT (processus `dot` externe)"""
+    import graphviz as _gv
+    return _gv.Source(source).pipe(format=fmt)
+
+def graphviz_entry(direction, empreinte, build_source):
+    """Entrée de cache de la direction ; la source DOT n'est générée qu'au premier appel"""
+    cache = get_graphviz_cache()
+    key = (direction, empreinte)
+    with cache["lock"]:
+        entry = cache["entries"].get(key)
+        if entry is not None:
+            cache["entries"].move_to_end(key)
+            return entry
+    entry = {"dot": build_source()}
+    with cache["lock"]:
+        entry = cache["entries"].setdefault(key, entry)
+        cache["entries"].move_to_end(key)
+        while len(cache["entries"]) > GRAPHVIZ_CACHE_MAX:
+            cache["entries"].popitem(last=False)
+    return entry
+
+def graphviz_render(entry, fmt):
+    """Rendu `fmt` ("svg", "pdf") de l'entrée, mis en page une seule fois"""
+    return graphviz_render_many([entry], fmt)[0]
+
+def graphviz_render_many(entries, fmt):
+    """
+    Rendus `fmt` de plusieurs entrées ; celles absentes du cache sont mises en
+    page en parallèle (un processus `dot` par direction, pilotés par des threads).
+    Les entrées étant partagées entre sessions, elles ne sont lues et complétées
+    que sous le verrou du cache (mise en page elle-même hors verrou) ; si deux
+    sessions mettent en page la même entrée, le premier rendu publié est conservé.
+    """
+    lock = get_graphviz_cache()["lock"]
+    with lock:
+        a_rendre = [entry for entry in entries if fmt not in entry]
+    if len(a_rendre) == 1:
+        rendus = [_pipe_dot(a_rendre[0]["dot"], fmt)]
+    elif a_rendre:
+        with ThreadPoolExecutor(max_workers=min(len(a_rendre), os.cpu_count() or 1)) as pool:
+            rendus = list(pool.map(lambda e: _pipe_dot(e["dot"], fmt), a_rendre))
+    if a_rendre:
+        with lock:
+            for entry, rendu in zip(a_rendre, rendus):
+                entry.setdefault(fmt, rendu)
+    with lock:
+        return [entry[fmt] for entry in entries]
+
 def get_poste_capacity(postes_df, poste_name):
     """Retourne la capacité d'un poste depuis le référentiel"""
     if postes_df.empty:
@@ -991,8 +2781,10 @@ except Exception as e:
     st.stop()
 
 # --- CHARGEMENT DES DONNÉES (AVANT LA SIDEBAR) ---
+# Versions des jeux servis à ce rerun : clés des exports calculés sur ces DataFrames
+DONNEES_VERSIONS = {}
 with st.spinner("Chargement des données..."):
-    collaborateurs_df, postes_df = load_data_from_gsheet(gsheet_client, SHEET_URL)
+    collaborateurs_df, postes_df = load_data_from_gsheet(gsheet_client, SHEET_URL, versions=DONNEES_VERSIONS)
 
 # ✅ VÉRIFICATION ET CRÉATION DE LA COLONNE "Vœux Retenu" SI MANQUANTE
 if not collaborateurs_df.empty:
@@ -1009,6 +2801,10 @@ if collaborateurs_df.empty or postes_df.empty:
     st.error("Impossible de charger les données. Vérifiez la structure du Google Sheet.")
     st.stop()
 
+# Écritures CAP 2025 de cette session refusées par Google Sheets (déjà annulées localement)
+for message in pop_cap2025_errors(st.session_state.session_uid):
+    st.error(f"❌ {message}")
+
 # --- CSS POUR SIDEBAR ULTRA-COMPACTE ---
 st.sidebar.markdown("""
     <style>
@@ -1065,23 +2861,52 @@ page = st.sidebar.radio(
     label_visibility="collapsed"
 )
 
+# Changement de page : on écrit sans attendre les modifications en tampon de l'entretien ouvert
+if st.session_state.get("last_page") != page and st.session_state.current_matricule:
+    flush_entretien_save(SHEET_URL, st.session_state.current_matricule)
+st.session_state.last_page = page
+
 st.sidebar.markdown("<div style='margin: 10px 0;'></div>", unsafe_allow_html=True)
 
 if st.sidebar.button("🔄 Rafraîchir les données", use_container_width=True):
     st.sidebar.caption("ℹ️ Les données sont mises en cache pendant 1 minute")
     st.sidebar.warning("⚠️ Rafraîchissement en cours...")
     time.sleep(1)
-    st.cache_data.clear()
+    invalidate_all_datasets(SHEET_URL)
+    invalidate_entretien_row_index(SHEET_URL)
+    invalidate_worksheet(SHEET_URL)
     st.rerun()
 
 st.sidebar.markdown("<div style='margin: 8px 0;'></div>", unsafe_allow_html=True)
 
+# Âge des données servies (les relectures se font en arrière-plan, sans bloquer la page)
 paris_tz = pytz.timezone('Europe/Paris')
-paris_time = datetime.now(paris_tz)
-st.sidebar.caption(f"Dernière MAJ : {paris_time.strftime('%H:%M:%S')}")
+data_age, data_refreshing, data_errors = get_dataset_age(SHEET_URL, "cap2025", "postes")
+if data_age is not None:
+    data_time = datetime.now(paris_tz) - pd.Timedelta(seconds=data_age)
+    st.sidebar.caption(
+        f"Données du {data_time.strftime('%H:%M:%S')} (il y a {int(data_age)} s)"
+        + (" · 🔄 actualisation…" if data_refreshing else "")
+    )
+if data_errors:
+    st.sidebar.caption("⚠️ Actualisation impossible, dernières données valides affichées")
+
+# État de la sauvegarde différée : rempli en fin de script, après les saisies de la page
+save_status_placeholder = st.sidebar.empty()
 
-if st.session_state.last_save_time:
-    st.sidebar.caption(f"💾 Sauvegarde : {st.session_state.last_save_time.strftime('%H:%M:%S')}")
+# Export campagne : un seul classeur (7 feuilles) construit au clic, sur l'instantané de ce rerun
+if not collaborateurs_df.empty:
+    st.sidebar.download_button(
+        "📦 Export campagne (.xlsx)",
+        data=excel_export(
+            SHEET_URL, "campagne", ("cap2025", "postes"), DONNEES_VERSIONS, {},
+            lambda collabs=collaborateurs_df, postes=postes_df: build_campaign_sheets(collabs, postes)
+        ),
+        file_name=f"CAP25_Campagne_{datetime.now(paris_tz).strftime('%Y%m%d_%H%M')}.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        help="Candidatures, Agrégé, Analyse par Poste, Commission, Repositionnement, Mouvements et Entretiens, sans filtre",
+        use_container_width=True
+    )
 
 st.sidebar.markdown("<div style='margin: 18px 0;'></div>", unsafe_allow_html=True)
 
@@ -1212,15 +3037,10 @@ if page == "📊 Tableau de Bord":
     entretiens_aujourd_hui = 0
     entretiens_realises = 0
     
-    for idx, row in collaborateurs_df.iterrows():
-        date_rdv = parse_date(row.get("Date de rdv", ""))
-        if date_rdv:
-            if date_rdv > today:
-                entretiens_planifies += 1
-            elif date_rdv == today:
-                entretiens_aujourd_hui += 1
-            elif date_rdv < today:
-                entretiens_realises += 1
+    dates_rdv = collaborateurs_df[COL_DATE_RDV]
+    entretiens_planifies = int((dates_rdv > pd.Timestamp(today)).sum())
+    entretiens_aujourd_hui = int((dates_rdv == pd.Timestamp(today)).sum())
+    entretiens_realises = int((dates_rdv < pd.Timestamp(today)).sum())
     
     total_entretiens = entretiens_planifies + entretiens_aujourd_hui + entretiens_realises
     pct_planifies = (entretiens_planifies / total_entretiens * 100) if total_entretiens > 0 else 0
@@ -1247,7 +3067,7 @@ if page == "📊 Tableau de Bord":
     st.subheader("📊 La demande par poste")
     
     # Préparation des données (Voeux 1, 2 et 3 combinés)
-    all_voeux = pd.concat([collaborateurs_df["Vœux 1"], collaborateurs_df["Vœux 2"], collaborateurs_df["Voeux 3"]])
+    all_voeux = pd.concat([collaborateurs_df["Vœux 1"], collaborateurs_df["Vœux 2"], collaborateurs_df["Vœux 3"]]).astype(str)
     all_voeux = all_voeux[all_voeux.notna() & (all_voeux.str.strip() != "") & (all_voeux != "Positionnement manquant")]
 
     if all_voeux.empty:
@@ -1375,67 +3195,10 @@ elif page == "👥 Gestion des Candidatures":
         df_filtered = df_filtered[df_filtered["Référente RH"].isin(filtre_rrh)]
     
     if filtre_date_rdv:
-        df_filtered = df_filtered[df_filtered["Date de rdv"].apply(
-            lambda x: parse_date(x) == filtre_date_rdv
-        )]
+        df_filtered = df_filtered[df_filtered[COL_DATE_RDV] == pd.Timestamp(filtre_date_rdv)]
     
     # Préparer les données pour l'affichage
-    display_df = pd.DataFrame()
-    
-    for idx, row in df_filtered.iterrows():
-        anciennete = calculate_anciennete(get_safe_value(row.get("Date entrée groupe", "")))
-        
-        date_rdv = get_safe_value(row.get("Date de rdv", ""))
-        heure_rdv = get_safe_value(row.get("Heure de rdv", ""))
-        
-        if date_rdv and date_rdv.strip() != "":
-            entretien = f"{date_rdv} à {heure_rdv}" if heure_rdv and heure_rdv.strip() != "" else date_rdv
-        else:
-            entretien = ""
-        
-        assessment = get_safe_value(row.get("Assesment à planifier O/N", "Non"))
-        if not assessment or assessment.strip() == "":
-            assessment = "Non"
-        
-        prenom_manager = get_safe_value(row.get('Prénom Manager', ''))
-        nom_manager = get_safe_value(row.get('Nom Manager', ''))
-        manager_actuel = f"{prenom_manager} {nom_manager}".strip()
-        
-        voeu_1 = get_safe_value(row.get("Vœux 1", ""))
-        voeu_2 = get_safe_value(row.get("Vœux 2", ""))
-        voeu_3 = get_safe_value(row.get("Voeux 3", ""))
-        
-        if voeu_2 == "Positionnement manquant":
-            voeu_2 = ""
-        if voeu_3 == "Positionnement manquant":
-            voeu_3 = ""
-        
-        display_row = {
-            "Prénom": get_safe_value(row.get("Prénom", "")),
-            "NOM": get_safe_value(row.get("NOM", "")),
-            "Poste actuel": get_safe_value(row.get('Poste libellé', "")),
-            "CSP": get_safe_value(row.get("CSP", "")),
-            "Classification": get_safe_value(row.get("Classification", "")),
-            "Manager": get_safe_value(row.get("Manager", "")),
-            "Nomade": get_safe_value(row.get("Nomade", "")),
-            "Ancienneté": anciennete,
-            "Direction": get_safe_value(row.get("Direction libellé", "")),
-            "Manager actuel": manager_actuel,
-            "Rencontre RH": get_safe_value(row.get("Rencontre RH / Positionnement", "")),
-            "Priorité": get_safe_value(row.get("Priorité", "")),
-            "Référente RH": get_safe_value(row.get("Référente RH", "")),
-            "📅 Entretien": entretien,
-            "Vœu 1": voeu_1,
-            "Vœu 2": voeu_2,
-            "Vœu 3": voeu_3,
-            "Assessment": assessment,
-            "Date Assessment": get_safe_value(row.get("Date Assessment", "")),
-            "Vœux Retenu": get_safe_value(row.get("Vœux Retenu", "")),
-            "Commentaires RH": get_safe_value(row.get("Commentaires RH", "")),
-            "Matricule": get_safe_value(row.get("Matricule", ""))
-        }
-        
-        display_df = pd.concat([display_df, pd.DataFrame([display_row])], ignore_index=True)
+    display_df = build_candidatures_table(df_filtered)
     
     # Affichage du tableau
     if not display_df.empty:
@@ -1457,7 +3220,12 @@ elif page == "👥 Gestion des Candidatures":
         if filtres_actifs_candidatures:
             st.info("💡 Le fichier exporté contiendra les données **filtrées** affichées dans le tableau ci-dessus.")
 
-        excel_file = to_excel(display_df.drop(columns=["Matricule"]))
+        excel_file = excel_export(
+            SHEET_URL, "candidatures", ("cap2025",), DONNEES_VERSIONS,
+            {"direction": filtre_direction, "collaborateur": filtre_collaborateur, "nom": search_nom,
+             "rrh": filtre_rrh, "date_rdv": filtre_date_rdv},
+            display_df.drop(columns=["Matricule"])
+        )
 
         st.download_button(
             label="📥 Télécharger en Excel",
@@ -1506,7 +3274,7 @@ elif page == "👥 Gestion des Candidatures":
                             "Referente_RH": get_safe_value(collab.get('Référente RH', '')),
                             "Voeu_1": get_safe_value(collab.get('Vœux 1', '')),
                             "Voeu_2": get_safe_value(collab.get('Vœux 2', '')),
-                            "Voeu_3": get_safe_value(collab.get('Voeux 3', ''))
+                            "Voeu_3": get_safe_value(collab.get('Vœux 3', ''))
                       }
             
                     st.session_state.current_matricule = matricule
@@ -1604,7 +3372,7 @@ elif page == "📝 Entretien RH":
                     "Referente_RH": get_safe_value(collab.get('Référente RH', '')),
                     "Voeu_1": get_safe_value(collab.get('Vœux 1', '')),
                     "Voeu_2": get_safe_value(collab.get('Vœux 2', '')),
-                    "Voeu_3": get_safe_value(collab.get('Voeux 3', ''))
+                    "Voeu_3": get_safe_value(collab.get('Vœux 3', ''))
                 }
             
             st.session_state.current_matricule = matricule
@@ -1622,9 +3390,7 @@ elif page == "📝 Entretien RH":
             st.caption("Utilisez le bouton '🔄 Sélectionner un autre collaborateur' pour changer.")
         else:
             try:
-                spreadsheet = gsheet_client.open_by_url(SHEET_URL)
-                worksheet = spreadsheet.worksheet("Entretien RH")
-                all_records = worksheet.get_all_records()
+                all_records = load_entretiens(gsheet_client, SHEET_URL)
             
                 entretiens_existants = [f"{record['Nom']} {record['Prénom']}" for record in all_records if record.get('Matricule')]
             
@@ -1639,6 +3405,7 @@ elif page == "📝 Entretien RH":
                         for record in all_records:
                             if f"{record['Nom']} {record['Prénom']}" == selected_existing:
                                 st.session_state.entretien_data = record.copy()
+                                remember_entretien_snapshot(SHEET_URL, record)
                                 st.session_state.current_matricule = record['Matricule']
                                 st.session_state.selected_collaborateur = selected_existing
                                 st.session_state.force_reload_entretien = True
@@ -1665,8 +3432,8 @@ elif page == "📝 Entretien RH":
             # ✅ MISE À JOUR : Recharger les vœux actuels depuis CAP 2025
             voeu1_actuel_gsheet = get_safe_value(collab.get('Vœux 1', ''))
             voeu2_actuel_gsheet = get_safe_value(collab.get('Vœux 2', ''))
-            voeu3_actuel_gsheet = get_safe_value(collab.get('Voeux 3', ''))
-            voeu4_actuel_gsheet = get_safe_value(collab.get('Voeux 4', ''))
+            voeu3_actuel_gsheet = get_safe_value(collab.get('Vœux 3', ''))
+            voeu4_actuel_gsheet = get_safe_value(collab.get('Vœux 4', ''))
             
             # Mettre à jour st.session_state.entretien_data avec les valeurs du Google Sheet
             st.session_state.entretien_data['Voeu_1'] = voeu1_actuel_gsheet
@@ -1685,7 +3452,7 @@ elif page == "📝 Entretien RH":
                 with col_info2:
                     st.markdown(f"**Poste actuel** : {get_safe_value(collab.get('Poste libellé', 'N/A'))}")
                     st.markdown(f"**Direction** : {get_safe_value(collab.get('Direction libellé', 'N/A'))}")
-                    anciennete_display = calculate_anciennete(get_safe_value(collab.get("Date entrée groupe", "")))
+                    anciennete_display = collab.get(COL_ANCIENNETE, "N/A")
                     st.markdown(f"**Ancienneté** : {anciennete_display}")
                 
                 with col_info3:
@@ -1696,6 +3463,7 @@ elif page == "📝 Entretien RH":
             st.divider()
             
             if st.button("🔄 Sélectionner un autre collaborateur"):
+                flush_entretien_save(SHEET_URL, st.session_state.current_matricule)
                 st.session_state.current_matricule = None
                 st.session_state.selected_collaborateur = None
                 st.session_state.entretien_data = {}
@@ -1753,8 +3521,7 @@ elif page == "📝 Entretien RH":
                             st.session_state.entretien_data['Voeu_2'] = new_voeu2 if new_voeu2 else ""
                             st.session_state.entretien_data['Voeu_3'] = new_voeu3 if new_voeu3 else ""
                             
-                            st.success("✅ Ordre des vœux mis à jour avec succès !")
-                            time.sleep(1)
+                            st.toast("✅ Ordre des vœux mis à jour avec succès !")
                             st.rerun()
                 else:
                     st.info("Aucun vœu renseigné pour ce collaborateur")
@@ -1795,8 +3562,7 @@ elif page == "📝 Entretien RH":
                                     if success:
                                         st.session_state.entretien_data['Voeu_4'] = voeu4_selectionne
                                         
-                                        st.success(f"✅ Vœu 4 « {voeu4_selectionne} » ajouté avec succès !")
-                                        time.sleep(2)
+                                        st.toast(f"✅ Vœu 4 « {voeu4_selectionne} » ajouté avec succès !")
                                         st.rerun()
                     else:
                         st.info("Aucun poste trouvé avec ce terme de recherche")
@@ -2183,10 +3949,9 @@ elif page == "📝 Entretien RH":
                                     
                                     if success:
                                         st.session_state.entretien_data["Decision_RH_Poste"] = f"Option: {poste_final}"
-                                        save_entretien_to_gsheet(gsheet_client, SHEET_URL, st.session_state.entretien_data, show_success=False)
+                                        enqueue_entretien_save(gsheet_client, SHEET_URL, st.session_state.entretien_data, delay=0)
                                         
-                                        st.success("✅ Option RH enregistrée avec succès !")
-                                        time.sleep(2)
+                                        st.toast("✅ Option RH enregistrée avec succès !")
                                         st.rerun()
                             
 
@@ -2196,10 +3961,9 @@ elif page == "📝 Entretien RH":
                 
                                     if success:
                                         st.session_state.entretien_data["Decision_RH_Poste"] = f"Retenu: {poste_final}"
-                                        save_entretien_to_gsheet(gsheet_client, SHEET_URL, st.session_state.entretien_data, show_success=False)
+                                        enqueue_entretien_save(gsheet_client, SHEET_URL, st.session_state.entretien_data, delay=0)
                     
-                                        st.success("✅ Vœu retenu enregistré avec succès !")
-                                        time.sleep(2)
+                                        st.toast("✅ Vœu retenu enregistré avec succès !")
                                         st.rerun()
         
                                         st.divider()
@@ -2256,58 +4020,31 @@ elif page == "💻🔍 Candidatures/Poste":
         
         # Charger tous les entretiens
         try:
-            spreadsheet = gsheet_client.open_by_url(SHEET_URL)
-            worksheet_entretiens = spreadsheet.worksheet("Entretien RH")
-            all_entretiens = worksheet_entretiens.get_all_records()
+            versions_comparatif = dict(DONNEES_VERSIONS)
+            entretiens_par_matricule = _index_entretiens(
+                load_entretiens(gsheet_client, SHEET_URL, versions=versions_comparatif)
+            )
             
             # Trouver les candidats pour ce poste
             candidats_data = []
             
-            for _, collab in collaborateurs_df.iterrows():
-                voeu_match = None
-                ordre_voeu = 99  # Pour le tri
-                
-                voeu1 = get_safe_value(collab.get('Vœux 1', ''))
-                voeu2 = get_safe_value(collab.get('Vœux 2', ''))
-                voeu3 = get_safe_value(collab.get('Voeux 3', ''))
-                voeu4 = get_safe_value(collab.get('Voeux 4', '')) 
-                
-                if voeu1 == poste_compare:
-                    voeu_match = "Vœu 1"
-                    ordre_voeu = 1
-                elif voeu2 == poste_compare:
-                    voeu_match = "Vœu 2"
-                    ordre_voeu = 2
-                elif voeu3 == poste_compare:
-                    voeu_match = "Vœu 3"
-                    ordre_voeu = 3
-                elif voeu4 == poste_compare:
-                    voeu_match = "Vœu 4"
-                    ordre_voeu = 4                   
+            # Meilleur vœu (V1 à V4) de chaque collaborateur pour ce poste, via l'index
+            index_candidats = get_poste_candidate_index(SHEET_URL, collaborateurs_df)
+            for cand in candidats_du_poste(index_candidats, poste_compare, first_match=True).itertuples(index=False):
+                # Trouver l'entretien correspondant
+                entretien = entretiens_par_matricule.get(str(cand.matricule).strip())
                 
-                if voeu_match:
-                    matricule = get_safe_value(collab.get('Matricule', ''))
-                    nom = get_safe_value(collab.get('NOM', ''))
-                    prenom = get_safe_value(collab.get('Prénom', ''))
-                    
-                    # Trouver l'entretien correspondant
-                    entretien = None
-                    for ent in all_entretiens:
-                        if str(ent.get('Matricule', '')) == str(matricule):
-                            entretien = ent
-                            break
-                    
-                    candidats_data.append({
-                        'ordre_voeu': ordre_voeu,
-                        'nom': nom,
-                        'prenom': prenom,
-                        'voeu_match': voeu_match,
-                        'matricule': matricule,
-                        'entretien': entretien,
-                        'poste_actuel': get_safe_value(collab.get('Poste libellé', '')),
-                        'anciennete': calculate_anciennete(get_safe_value(collab.get("Date entrée groupe", ""))),
-                        'priorite': get_safe_value(collab.get('Priorité', ''))
-                    })
+                candidats_data.append({
+                    'ordre_voeu': cand.rank,
+                    'nom': cand.nom,
+                    'prenom': cand.prenom,
+                    'voeu_match': f"Vœu {cand.rank}",
+                    'matricule': cand.matricule,
+                    'entretien': entretien,
+                    'poste_actuel': cand.poste_actuel,
+                    'anciennete': cand.anciennete,
+                    'priorite': cand.priorite
+                })
             
             # Trier : d'abord par ordre de vœu, puis par nom
             candidats_data.sort(key=lambda x: (x['ordre_voeu'], x['nom'], x['prenom']))
@@ -2431,7 +4168,10 @@ elif page == "💻🔍 Candidatures/Poste":
                         st.info("💡 Le fichier exporté contiendra les données **filtrées** affichées dans le tableau ci-dessus.")
                 
                 with col_exp2:
-                    excel_data = to_excel(df_comparatif)
+                    excel_data = excel_export(
+                        SHEET_URL, "comparatif", ("cap2025", "entretiens"), versions_comparatif,
+                        {"poste": poste_compare}, df_comparatif
+                    )
                     
                     st.download_button(
                         label="📥 Télécharger en Excel",
@@ -2463,86 +4203,9 @@ elif page == "🗒️🔁 Tableau agrégé AM":
     st.divider()
     
     # ===== CONSTRUCTION DU TABLEAU AGRÉGÉ =====
-    aggregated_data = []
-    
-    for _, poste_row in postes_df.iterrows():
-        # --- FILTRAGE : On ignore si "Nombre de postes vacants" est vide ---
-        raw_vacants = poste_row.get("Nombre de postes vacants ", "")
-        
-        # Vérification robuste : si c'est null, NaN, ou une chaîne vide/espaces
-        if pd.isna(raw_vacants) or str(raw_vacants).strip() == "":
-            continue  # On passe au poste suivant immédiatement
-            
-        poste = poste_row.get("Poste", "")
-        direction = poste_row.get("Direction", "")
-        
-        # Conversion sécurisée en int maintenant qu'on sait que ce n'est pas vide
-        try:
-            postes_ouverts = int(float(raw_vacants)) # float permet de gérer le cas "3.0" issu d'Excel
-        except (ValueError, TypeError):
-            # Si la valeur est "Inconnu" ou du texte, on décide soit de mettre 0, soit de sauter.
-            # Ici, je mets 0 par sécurité, mais vous pouvez mettre 'continue' si vous voulez exclure les erreurs de format.
-            postes_ouverts = 0
-        
-        # Initialiser les compteurs
-        candidatures_v1 = 0
-        candidatures_v2 = 0
-        candidatures_v3 = 0
-        candidatures_v4 = 0
-        
-        profils_v1 = {}
-        profils_v2 = {}
-        profils_v3 = {}
-        profils_v4 = {}
-        
-        # Parcourir les collaborateurs
-        for _, collab in collaborateurs_df.iterrows():
-            poste_actuel = get_safe_value(collab.get('Poste libellé', "N/A"))
-            
-            # Vœu 1
-            if get_safe_value(collab.get("Vœux 1", "")) == poste:
-                candidatures_v1 += 1
-                profils_v1[poste_actuel] = profils_v1.get(poste_actuel, 0) + 1
-            
-            # Vœu 2
-            if get_safe_value(collab.get("Vœux 2", "")) == poste:
-                candidatures_v2 += 1
-                profils_v2[poste_actuel] = profils_v2.get(poste_actuel, 0) + 1
-            
-            # Vœu 3
-            if get_safe_value(collab.get("Voeux 3", "")) == poste:
-                candidatures_v3 += 1
-                profils_v3[poste_actuel] = profils_v3.get(poste_actuel, 0) + 1
-            
-            # Vœu 4
-            if get_safe_value(collab.get("Voeux 4", "")) == poste:
-                candidatures_v4 += 1
-                profils_v4[poste_actuel] = profils_v4.get(poste_actuel, 0) + 1
-        
-        # Formater les profils métiers
-        def format_profils(profils_dict):
-            if not profils_dict:
-                return ""
-            return "; ".join([f"{prof} ({count})" for prof, count in profils_dict.items()])
-        
-        candidatures_total = candidatures_v1 + candidatures_v2 + candidatures_v3 + candidatures_v4
-        
-        aggregated_data.append({
-            "POSTE PROJETE": poste,
-            "DIRECTION": direction,
-            "POSTES OUVERTS": postes_ouverts,
-            "CANDIDATURES TOTAL": candidatures_total,
-            "CANDIDATURES VŒUX 1": candidatures_v1,
-            "PROFILS DE METIER / CANDIDAT (Vœux 1)": format_profils(profils_v1),
-            "CANDIDATURES VŒUX 2": candidatures_v2,
-            "PROFILS DE METIER / CANDIDAT (Vœux 2)": format_profils(profils_v2),
-            "CANDIDATURES VŒUX 3": candidatures_v3,
-            "PROFILS DE METIER / CANDIDAT (Vœux 3)": format_profils(profils_v3),
-            "CANDIDATURES VŒUX 4": candidatures_v4,
-            "PROFILS DE METIER / CANDIDAT (Vœux 4)": format_profils(profils_v4)
-        })
-    
-    df_aggregated = pd.DataFrame(aggregated_data)
+    # Calcul vectorisé, partagé entre sessions et refait seulement si CAP 2025 / Postes changent
+    versions_agregats = dict(DONNEES_VERSIONS)
+    df_aggregated = get_aggregated_data(SHEET_URL, postes_df, collaborateurs_df, versions=versions_agregats)
     
     # Gestion du cas où le dataframe est vide après filtrage
     if df_aggregated.empty:
@@ -2732,7 +4395,11 @@ elif page == "🗒️🔁 Tableau agrégé AM":
             export_time = datetime.now(paris_tz)
             filename = f"EDL voeux CAP25 - {export_time.strftime('%d-%m-%Y %Hh%M')}.xlsx"
     
-            excel_data = to_excel(df_filtered_agg)
+            excel_data = excel_export(
+                SHEET_URL, "agregats", ("cap2025", "postes"), versions_agregats,
+                {"direction": filtre_direction_agg, "min_candidatures": filtre_min_candidatures},
+                df_filtered_agg
+            )
     
             st.download_button(
                 label="📥 Télécharger en Excel",
@@ -2750,88 +4417,9 @@ elif page == "🗒️🔁 Tableau agrégé AM":
 elif page == "🎯 Analyse par Poste":
     st.title("🎯 Analyse des Viviers par Poste")
     
-    # Liste des postes ouverts à la mobilité avec leur nombre total
-    postes_ouverts_df = postes_df[postes_df["Mobilité interne"].str.lower() == "oui"].copy()
-    
-    # Analyse par poste
-    job_analysis = []
-    
-    for _, poste_row in postes_ouverts_df.iterrows():
-        poste = poste_row["Poste"]
-        nb_postes_total = int(poste_row.get("Nombre total de postes", 1))
-        
-        # Compter les postes attribués
-        nb_postes_attribues = len(collaborateurs_df[
-            (collaborateurs_df["Vœux Retenu"] == poste)
-        ])
-        
-        # Calculer les postes disponibles
-        nb_postes_disponibles = nb_postes_total - nb_postes_attribues
-        
-        candidats = []
-        candidats_data = []
-        
-        for _, collab in collaborateurs_df.iterrows():
-            nom_collab = get_safe_value(collab.get('NOM', ''))
-            prenom_collab = get_safe_value(collab.get('Prénom', ''))
-            poste_actuel_collab = get_safe_value(collab.get('Poste libellé', ''))  # Bien noter le double espace
-            
-            voeu_match = None  # Variable pour capter quel vœu correspond
-            
-            if collab.get("Vœux 1") == poste:
-                voeu_match = "V1"
-            elif collab.get("Vœux 2") == poste:
-                voeu_match = "V2"
-            elif collab.get("Voeux 3") == poste:
-                voeu_match = "V3"
-            
-            if voeu_match:
-                # Format enrichi : NOM Prénom (Vx) - Actuellement : 'Poste libellé'
-                if poste_actuel_collab:
-                    candidat_label = f"{nom_collab} {prenom_collab} ({voeu_match}) - Actuellement : \"{poste_actuel_collab}\""
-                else:
-                    candidat_label = f"{nom_collab} {prenom_collab} ({voeu_match}) - Actuellement : \"N/A\""
-                
-                candidats.append(candidat_label)
-                candidats_data.append({
-                    "nom": f"{nom_collab} {prenom_collab}",
-                    "matricule": get_safe_value(collab.get('Matricule', ''))
-                })
-        
-        nb_candidats = len(candidats)
-        
-        # Déterminer le statut
-        if nb_postes_disponibles == 0:
-            statut = "✅ Poste(s) pourvu(s)"
-        elif nb_candidats == 0:
-            statut = "⚠️ Aucun candidat"
-        elif nb_candidats < nb_postes_disponibles:
-            statut = f"⚠️ Manque {nb_postes_disponibles - nb_candidats} candidat(s)"
-        elif nb_candidats == nb_postes_disponibles:
-            statut = "✅ Vivier actif"
-        else:
-            # Calcul du ratio de tension
-            ratio = nb_candidats / nb_postes_disponibles if nb_postes_disponibles > 0 else nb_candidats
-            if ratio <= 2:
-                statut = "🔶 Tension"
-            elif ratio <= 3:
-                statut = "🔴 Forte tension"
-            else:
-                statut = "🔴🔴 Très forte tension"
-        
-        job_analysis.append({
-            "Poste": poste,
-            "Direction": poste_row.get("Direction", "N/A"),
-            "Postes totaux": nb_postes_total,  # ✅ NOUVELLE COLONNE
-            "Ouverts mobilité": nb_postes_disponibles,  # ✅ RENOMMÉ
-            "Postes attribués": nb_postes_attribues,
-            "Nb_Candidats": nb_candidats,
-            "Candidats": ", ".join(candidats) if candidats else "",
-            "Candidats_Data": candidats_data,
-            "Statut": statut
-        })
-    
-    df_analysis = pd.DataFrame(job_analysis)
+    # Analyse par poste (calcul vectorisé partagé ; détail des candidats lu à la demande)
+    versions_analyse = dict(DONNEES_VERSIONS)
+    df_analysis, candidats_analyse = get_job_analysis(SHEET_URL, postes_df, collaborateurs_df, versions=versions_analyse)
     
     # Filtres
     col_filter1, col_filter2, col_filter3 = st.columns(3)
@@ -2886,7 +4474,7 @@ elif page == "🎯 Analyse par Poste":
     # Affichage
     if not df_filtered_analysis.empty:
         st.dataframe(
-            df_filtered_analysis.drop(columns=["Candidats_Data"]),
+            df_filtered_analysis,
             use_container_width=True,
             hide_index=True,
             column_config={
@@ -2949,7 +4537,11 @@ elif page == "🎯 Analyse par Poste":
                 st.info("💡 Le fichier exporté contiendra les données **filtrées** affichées dans le tableau ci-dessus.")
         
         with col_export_a2:
-            excel_analyse = to_excel(df_filtered_analysis.drop(columns=["Candidats_Data"]))
+            excel_analyse = excel_export(
+                SHEET_URL, "analyse_postes", ("cap2025", "postes"), versions_analyse,
+                {"sans_candidat": show_zero, "direction": filtre_direction_analyse, "statut": filtre_statut},
+                df_filtered_analysis
+            )
             
             st.download_button(
                 label="📥 Télécharger en Excel",
@@ -2972,15 +4564,15 @@ elif page == "🎯 Analyse par Poste":
         )
         
         if poste_selected != "-- Sélectionner --":
-            candidats_du_poste = df_filtered_analysis[df_filtered_analysis["Poste"] == poste_selected]["Candidats_Data"].iloc[0]
+            candidats_selectionnes = candidats_analyse[candidats_analyse["poste"] == str(poste_selected)]
             
-            if len(candidats_du_poste) > 0:
+            if len(candidats_selectionnes) > 0:
                 col_cand1, col_cand2 = st.columns([3, 1])
                 
                 with col_cand1:
                     candidat_selected = st.selectbox(
                         "Sélectionner un candidat",
-                        options=["-- Sélectionner --"] + [c["nom"] for c in candidats_du_poste]
+                        options=["-- Sélectionner --"] + candidats_selectionnes["nom_affiche"].tolist()
                     )
                 
                 with col_cand2:
@@ -3013,8 +4605,7 @@ elif page == "🎯 Analyse par Poste":
                             with col_info2:
                                 poste_actuel = get_safe_value(collab.get('Poste libellé', ''))
                                 direction = get_safe_value(collab.get('Direction libellé', ''))
-                                date_entree = get_safe_value(collab.get("Date entrée groupe", ""))
-                                anciennete_display = calculate_anciennete(date_entree)
+                                anciennete_display = collab.get(COL_ANCIENNETE, "N/A")
     
                                 st.markdown(f"**Poste actuel** : {poste_actuel if poste_actuel else '/'}")
                                 st.markdown(f"**Direction** : {direction if direction else '/'}")
@@ -3031,11 +4622,12 @@ elif page == "🎯 Analyse par Poste":
                         
                         # Afficher les vœux du candidat
                         st.markdown("##### 🎯 Vœux du candidat")
-                        voeux_col1, voeux_col2, voeux_col3 = st.columns(3)
+                        voeux_col1, voeux_col2, voeux_col3, voeux_col4 = st.columns(4)
                         
                         voeu1_cand = get_safe_value(collab.get('Vœux 1', ''))
                         voeu2_cand = get_safe_value(collab.get('Vœux 2', ''))
-                        voeu3_cand = get_safe_value(collab.get('Voeux 3', ''))
+                        voeu3_cand = get_safe_value(collab.get('Vœux 3', ''))
+                        voeu4_cand = get_safe_value(collab.get('Vœux 4', ''))
                         
                         with voeux_col1:
                             st.markdown(f"**Vœu 1** : {voeu1_cand if voeu1_cand else '/'}")
@@ -3043,6 +4635,8 @@ elif page == "🎯 Analyse par Poste":
                             st.markdown(f"**Vœu 2** : {voeu2_cand if voeu2_cand and voeu2_cand != 'Positionnement manquant' else '/'}")
                         with voeux_col3:
                             st.markdown(f"**Vœu 3** : {voeu3_cand if voeu3_cand and voeu3_cand != 'Positionnement manquant' else '/'}")
+                        with voeux_col4:
+                            st.markdown(f"**Vœu 4** : {voeu4_cand if voeu4_cand and voeu4_cand != 'Positionnement manquant' else '/'}")
                         
                         st.divider()
                         
@@ -3112,21 +4706,28 @@ elif page == "🏛️ Organigramme Cap25":
     Vous pouvez visualiser les structures, comparer les effectifs et analyser les flux de mobilité.
     """)
     
-    # Onglets pour différentes vues
-    tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs([
-        "🚀 Organigrammes dynamiques",
-        "📌 Organigrammes Annotés",
-        "📊 Vue d'ensemble",
-        "🔄 Flux de mobilité",
-        "📈 Comparaison détaillée",
-        "👥 Mouvements individuels",
-    ])
+    # Sélecteur de vue : contrairement à st.tabs, seule la vue affichée est calculée
+    # (un changement de zoom ne reconstruit pas le Sankey, les treemaps, etc.)
+    vue_organigramme = st.radio(
+        "Vue",
+        options=[
+            "🚀 Organigrammes dynamiques",
+            "📌 Organigrammes Annotés",
+            "📊 Vue d'ensemble",
+            "🔄 Flux de mobilité",
+            "📈 Comparaison détaillée",
+            "👥 Mouvements individuels",
+        ],
+        horizontal=True,
+        key="organigramme_vue",
+        label_visibility="collapsed"
+    )
     
     # ========================================
     # TAB 1 : VUE D'ENSEMBLE
     # ========================================
     
-    with tab3:
+    if vue_organigramme == "📊 Vue d'ensemble":
         st.subheader("📊 Vue d'ensemble de la transition")
         
         # KPIs de transition
@@ -3154,8 +4755,9 @@ elif page == "🏛️ Organigramme Cap25":
             (collaborateurs_df['Vœux Retenu'] != '')
         ].copy()
         
-        df_with_voeu['Direction_Cible'] = df_with_voeu['Vœux Retenu'].map(poste_to_direction)
-        changement_direction = (df_with_voeu['Direction libellé'] != df_with_voeu['Direction_Cible']).sum()
+        # Libellés en objets : deux catégorielles aux dictionnaires différents ne se comparent pas
+        df_with_voeu['Direction_Cible'] = df_with_voeu['Vœux Retenu'].astype(object).map(poste_to_direction)
+        changement_direction = (df_with_voeu['Direction libellé'].astype(object) != df_with_voeu['Direction_Cible']).sum()
         
         # Postes concernés
         postes_actuels = set(collaborateurs_df['Poste libellé'].dropna().unique())
@@ -3197,23 +4799,21 @@ elif page == "🏛️ Organigramme Cap25":
         # Treemaps côte à côte
         col_tree1, col_tree2 = st.columns(2)
         
+        fig_actuelle, fig_cap2025 = get_org_treemaps(SHEET_URL, collaborateurs_df, postes_df)
+        
         with col_tree1:
             st.subheader("🏢 Organisation Actuelle")
-            org_actuelle = create_org_structure(collaborateurs_df, postes_df, mode="actuel")
-            fig_actuelle = create_treemap(org_actuelle, "Structure Actuelle")
             st.plotly_chart(fig_actuelle, use_container_width=True)
         
         with col_tree2:
             st.subheader("🎯 Organisation CAP 2025")
-            org_cap2025 = create_org_structure(collaborateurs_df, postes_df, mode="cap2025")
-            fig_cap2025 = create_treemap(org_cap2025, "Structure CAP 2025")
             st.plotly_chart(fig_cap2025, use_container_width=True)
     
     # ========================================
     # TAB 2 : FLUX DE MOBILITÉ
     # ========================================
     
-    with tab4:
+    if vue_organigramme == "🔄 Flux de mobilité":
         st.subheader("🔄 Visualisation des flux de mobilité")
         
         st.info("💡 Ce diagramme Sankey montre les mouvements des collaborateurs de leur poste actuel vers leur poste CAP 2025 (Vœux Retenu)")
@@ -3241,8 +4841,11 @@ elif page == "🏛️ Organigramme Cap25":
         if direction_filter_sankey:
             df_sankey = df_sankey[df_sankey['Direction libellé'].isin(direction_filter_sankey)]
         
-        # Créer et afficher le Sankey
-        fig_sankey = create_sankey_diagram(df_sankey, postes_df)
+        # Créer et afficher le Sankey (vue sans filtre : calculée une fois par version des données)
+        if direction_filter_sankey:
+            fig_sankey = create_sankey_diagram(df_sankey, postes_df)
+        else:
+            fig_sankey = get_sankey_figure(SHEET_URL, collaborateurs_df, postes_df)
         st.plotly_chart(fig_sankey, use_container_width=True)
         
         st.divider()
@@ -3282,7 +4885,7 @@ elif page == "🏛️ Organigramme Cap25":
     # TAB 3 : COMPARAISON DÉTAILLÉE
     # ========================================
     
-    with tab5:
+    if vue_organigramme == "📈 Comparaison détaillée":
         st.subheader("📈 Comparaison détaillée par Direction")
         
         # Sélection de la direction à analyser
@@ -3310,7 +4913,7 @@ elif page == "🏛️ Organigramme Cap25":
                 collaborateurs_df['Vœux Retenu'].notna() & 
                 (collaborateurs_df['Vœux Retenu'] != '')
             ].copy()
-            df_with_voeu_comp['Direction_Cible'] = df_with_voeu_comp['Vœux Retenu'].map(poste_to_direction)
+            df_with_voeu_comp['Direction_Cible'] = df_with_voeu_comp['Vœux Retenu'].astype(object).map(poste_to_direction)
             effectif_cible = df_with_voeu_comp[df_with_voeu_comp['Direction_Cible'] == direction_selected].shape[0]
             
             # Flux sortants (personnes partant de cette direction)
@@ -3412,7 +5015,7 @@ elif page == "🏛️ Organigramme Cap25":
             # Récupérer tous les postes ciblés dans cette direction
             postes_cibles_direction = df_with_voeu_comp[
                 df_with_voeu_comp['Direction_Cible'] == direction_selected
-            ]['Vœux Retenu'].value_counts()
+            ]['Vœux Retenu'].astype(str).value_counts()
             
             if not postes_cibles_direction.empty:
                 capacity_data = []
@@ -3453,21 +5056,12 @@ elif page == "🏛️ Organigramme Cap25":
     # TAB 4 : MOUVEMENTS INDIVIDUELS
     # ========================================
     
-    with tab6:
+    if vue_organigramme == "👥 Mouvements individuels":
         st.subheader("👥 Analyse des mouvements individuels")
         
         # Filtres
         col_mv1, col_mv2, col_mv3, col_mv4 = st.columns(4)
         
-        # Créer le mapping Poste → Direction pour les filtres
-        poste_to_direction = {}
-        if not postes_df.empty:
-            for _, poste_row in postes_df.iterrows():
-                poste_name = get_safe_value(poste_row.get('Poste', ''))
-                direction_name = get_safe_value(poste_row.get('Direction', ''))
-                if poste_name:
-                    poste_to_direction[poste_name] = direction_name
-        
         with col_mv1:
             type_mouvement = st.selectbox(
                 "Type de mouvement",
@@ -3483,57 +5077,26 @@ elif page == "🏛️ Organigramme Cap25":
                 ["Toutes", "Priorité 1", "Priorité 2", "Priorité 3", "Priorité 4"]
             )
         
-        # Préparer les données
-        df_mouvements = collaborateurs_df.copy()
-        
-        # Ajouter la colonne de direction cible
-        df_mouvements['Direction_Cible'] = df_mouvements['Vœux Retenu'].map(poste_to_direction)
-        
-        # Ajouter le type de mouvement
-        def get_type_mouvement(row):
-            if pd.isna(row['Vœux Retenu']) or row['Vœux Retenu'] == '':
-                return "Sans positionnement"
-            elif row['Direction libellé'] != row['Direction_Cible']:
-                return "Changement de direction"
-            else:
-                return "Même direction"
-        
-        df_mouvements['Type_Mouvement'] = df_mouvements.apply(get_type_mouvement, axis=1)
+        # Préparer les données (direction cible et type de mouvement)
+        df_display = build_mouvements_table(collaborateurs_df, postes_df)
         
         # Appliquer les filtres
         if type_mouvement != "Tous":
-            df_mouvements = df_mouvements[df_mouvements['Type_Mouvement'] == type_mouvement]
+            df_display = df_display[df_display['Type de mouvement'] == type_mouvement]
         
         if search_nom:
-            df_mouvements = df_mouvements[
-                df_mouvements['NOM'].str.contains(search_nom, case=False, na=False) |
-                df_mouvements['Prénom'].str.contains(search_nom, case=False, na=False)
+            df_display = df_display[
+                df_display['Nom'].str.contains(search_nom, case=False, na=False) |
+                df_display['Prénom'].str.contains(search_nom, case=False, na=False)
             ]
         
         if filtre_priorite != "Toutes":
-            df_mouvements = df_mouvements[df_mouvements['Priorité'] == filtre_priorite]
+            df_display = df_display[df_display['Priorité'] == filtre_priorite]
         
         # Affichage
-        st.markdown(f"**{len(df_mouvements)} collaborateurs** correspondent aux filtres")
+        st.markdown(f"**{len(df_display)} collaborateurs** correspondent aux filtres")
         
         # Tableau détaillé
-        df_display = df_mouvements[[
-            'Matricule', 'NOM', 'Prénom', 
-            'Direction libellé', 'Service libellé', 'Poste libellé',
-            'Vœux Retenu', 'Direction_Cible', 'Type_Mouvement', 'Priorité', 'Date de rdv'
-        ]].copy()
-        
-        df_display = df_display.rename(columns={
-            'NOM': 'Nom',
-            'Direction libellé': 'Direction actuelle',
-            'Service libellé': 'Service actuel',
-            'Poste libellé': 'Poste actuel',
-            'Vœux Retenu': 'Poste cible',
-            'Direction_Cible': 'Direction cible',
-            'Type_Mouvement': 'Type de mouvement',
-            'Date de rdv': 'Date RDV'
-        })
-        
         st.dataframe(
             df_display,
             hide_index=True,
@@ -3557,7 +5120,11 @@ elif page == "🏛️ Organigramme Cap25":
             st.info("💡 Exportez la liste filtrée pour un suivi détaillé de la transition")
         
         with col_exp2:
-            excel_mouvements = to_excel(df_display)
+            excel_mouvements = excel_export(
+                SHEET_URL, "mouvements", ("cap2025", "postes"), DONNEES_VERSIONS,
+                {"type": type_mouvement, "nom": search_nom, "priorite": filtre_priorite},
+                df_display
+            )
             st.download_button(
                 label="📥 Télécharger en Excel",
                 data=excel_mouvements,
@@ -3570,7 +5137,7 @@ elif page == "🏛️ Organigramme Cap25":
     # ========================================
     # TAB 5 : ORGANIGRAMMES ANNOTÉS
     # ========================================
-    with tab2:
+    if vue_organigramme == "📌 Organigrammes Annotés":
         if not _HAS_PDF_ANNOTE:
             st.error("⚠️ Les librairies `pypdfium2` et `Pillow` sont requises. Ajoutez-les à requirements.txt.")
         else:
@@ -3691,52 +5258,14 @@ elif page == "🏛️ Organigramme Cap25":
                         res[poste].append(affiche)
                 return res
 
-            def _find_noms(candidats, pos_name):
-                pn = pos_name.lower().strip()
-                for pk, nl in candidats.items():
-                    pk2 = pk.lower().strip()
-                    if pk2 == pn or pk2 in pn or pn in pk2:
-                        return nl
-                return None
-
             def _render_page(page_idx, candidats, scale):
-                import pypdfium2 as pdfium
-                from PIL import Image, ImageDraw, ImageFont
-
-                try:
-                    fb = _PILFont.truetype(_FONT_BOLD, max(10, int(13 * scale)))
-                    fr = _PILFont.truetype(_FONT_REG,  max(9, int(11 * scale)))
-                except Exception:
-                    fb = fr = _PILFont.load_default()
-
-                doc  = pdfium.PdfDocument(_PDF_PATH)
-                page = doc[page_idx]
-                bmp  = page.render(scale=scale)
-                img  = bmp.to_pil().convert("RGBA")
-                ov   = _PILImage.new("RGBA", img.size, (0,0,0,0))
-                d    = _PILDraw.Draw(ov, "RGBA")
-
-                badge_h = max(22, int(22 * scale))
-                for pos_name, (px, py, pw, ph) in _POS_MAP.get(page_idx, {}).items():
-                    x1, y1 = int(px*scale), int(py*scale)
-                    x2, y2 = int((px+pw)*scale), int((py+ph)*scale)
-                    noms = _find_noms(candidats, pos_name)
-                    if noms is None:
-                        d.rectangle([x1, y2-badge_h, x2, y2], fill=(160,160,160,195))
-                        d.text((x1+6, y2-badge_h+4), "Poste vacant", fill=(70,70,70,240), font=fr)
-                    else:
-                        d.rectangle([x1, y2-badge_h, x2, y2], fill=(0,175,152,218))
-                        label = "  ·  ".join(noms)
-                        max_c = max(1, int((x2-x1-14)/8))
-                        if len(label) > max_c:
-                            label = label[:max_c-1] + "…"
-                        d.text((x1+6, y2-badge_h+4), f"✓ {label}", fill=(255,255,255,255), font=fb)
-
-                out = _PILImage.alpha_composite(img, ov).convert("RGB")
-                buf = io.BytesIO()
-                out.save(buf, format="PNG")
-                buf.seek(0)
-                return buf.read()
+                # Page de base en cache : seul le calque des badges est dessiné ici
+                return annotate_page(
+                    base_page_raster(_PDF_PATH, page_idx, scale),
+                    _POS_MAP.get(page_idx, {}), candidats, scale,
+                    load_font(_FONT_BOLD, max(10, int(13 * scale))),
+                    load_font(_FONT_REG,  max(9, int(11 * scale)))
+                )
 
             # ── Interface ──────────────────────────────────────────────────
             st.markdown("""
@@ -3752,12 +5281,18 @@ elif page == "🏛️ Organigramme Cap25":
             </div>
             """, unsafe_allow_html=True)
 
-            candidats_map = _build_candidats(collaborateurs_df)
+            # Noms retenus par poste et leur résolveur : une fois par version de CAP 2025
+            candidats_lookup = derived_dataset(
+                SHEET_URL, "retenus_annotes", ("cap2025",),
+                lambda collabs: build_poste_lookup(_build_candidats(collabs)),
+                copy=False, defaults=(collaborateurs_df,)
+            )
+            candidats_map = candidats_lookup["map"]
             nb_ret = sum(len(v) for v in candidats_map.values())
             total_map = sum(len(v) for v in _POS_MAP.values())
             nb_pourvus = sum(
                 1 for pidx in _POS_MAP for pn in _POS_MAP[pidx]
-                if _find_noms(candidats_map, pn) is not None
+                if find_noms_poste(candidats_lookup, pn) is not None
             )
 
             m1, m2, m3, m4 = st.columns(4)
@@ -3796,7 +5331,7 @@ elif page == "🏛️ Organigramme Cap25":
             else:
                 with st.spinner("Rendu en cours…"):
                     try:
-                        img_bytes = _render_page(page_idx_sel, candidats_map, zoom)
+                        img_bytes = _render_page(page_idx_sel, candidats_lookup, zoom)
                         st.image(img_bytes, use_container_width=True)
                     except Exception as _e:
                         st.error(f"Erreur de rendu : {_e}")
@@ -3808,7 +5343,7 @@ elif page == "🏛️ Organigramme Cap25":
                     st.markdown("#### 📋 Récapitulatif")
                     _rows = []
                     for pn in positions_page:
-                        noms = _find_noms(candidats_map, pn)
+                        noms = find_noms_poste(candidats_lookup, pn)
                         _rows.append({
                             "Poste": pn,
                             "Candidat(s) retenu(s)": ", ".join(noms) if noms else "—",
@@ -3825,28 +5360,33 @@ elif page == "🏛️ Organigramme Cap25":
                         use_container_width=True,
                     )
 
+                show_ambiguous_postes(candidats_lookup)
+
                 # Export PDF
                 st.divider()
                 st.markdown("#### 📥 Export PDF toutes directions")
                 if st.button("🖨️ Générer le PDF annoté complet", type="primary", key="gen_pdf_btn"):
-                    with st.spinner("Génération… (30-60 secondes)"):
-                        try:
-                            import img2pdf as _img2pdf
-                            _pages = []
-                            for _pidx in sorted(_POS_MAP.keys()):
-                                _pages.append(_render_page(_pidx, candidats_map, 1.5))
-                            _pdf_out = _img2pdf.convert(_pages)
-                            st.success("✅ PDF prêt !")
-                            st.download_button(
-                                "📥 Télécharger l'organigramme annoté",
-                                data=_pdf_out,
-                                file_name=f"Organigrammes_CAP25_Annotes_{datetime.now().strftime('%Y%m%d_%H%M')}.pdf",
-                                mime="application/pdf",
-                                type="primary",
-                                use_container_width=True,
+                    _barre = st.progress(0.0, text="Génération des pages…")
+                    try:
+                        _pdf_out = export_annotated_pdf(
+                            _PDF_PATH, _POS_MAP, candidats_lookup, 1.5, _FONT_BOLD, _FONT_REG,
+                            progress=lambda faites, total: _barre.progress(
+                                faites / total, text=f"Page {faites}/{total} assemblée"
                             )
-                        except Exception as _e:
-                            st.error(f"Erreur export : {_e}")
+                        )
+                        _barre.empty()
+                        st.success("✅ PDF prêt !")
+                        st.download_button(
+                            "📥 Télécharger l'organigramme annoté",
+                            data=_pdf_out,
+                            file_name=f"Organigrammes_CAP25_Annotes_{datetime.now().strftime('%Y%m%d_%H%M')}.pdf",
+                            mime="application/pdf",
+                            type="primary",
+                            use_container_width=True,
+                        )
+                    except Exception as _e:
+                        _barre.empty()
+                        st.error(f"Erreur export : {_e}")
 
                 with st.expander("🔧 Outil de calibration", expanded=False):
                     st.markdown("""
@@ -3864,7 +5404,7 @@ elif page == "🏛️ Organigramme Cap25":
     # ========================================
     # TAB 6 ---> 1 : ORGANIGRAMMES DYNAMIQUES GRAPHVIZ
     # ========================================
-    with tab1:
+    if vue_organigramme == "🚀 Organigrammes dynamiques":
         try:
             import graphviz as _gv
             _HAS_GV = True
@@ -4217,24 +5757,9 @@ elif page == "🏛️ Organigramme Cap25":
             }  # fin _ORGS
 
             # ── Lookup postes_df ───────────────────────────────────────────────
-            def _get_poste_info(poste_key, postes_df):
+            def _get_poste_info(poste_key, postes_lookup):
                 """Retourne (mobile: bool, total: int, vacants: int)"""
-                if poste_key is None or postes_df.empty:
-                    return False, 0, 0
-                pk = poste_key.lower().strip()
-                for _, row in postes_df.iterrows():
-                    p = str(row.get("Poste", "")).lower().strip()
-                    if p == pk or pk in p or p in pk:
-                        mobile = str(row.get("Mobilité interne", "")).lower().strip() == "oui"
-                        total  = int(row.get("Nombre total de postes", 0) or 0)
-                        # Robustesse : le nom de colonne peut avoir un espace final
-                        vac_raw = row.get("Nombre de postes vacants ", row.get("Nombre de postes vacants", None))
-                        try:
-                            vacants = int(float(vac_raw)) if vac_raw not in (None, "", float("nan")) else 0
-                        except (ValueError, TypeError):
-                            vacants = 0
-                        return mobile, total, vacants
-                return False, 0, 0
+                return lookup_poste(postes_lookup, poste_key, (False, 0, 0))
 
             # ── Candidats depuis collaborateurs_df ────────────────────────────
             def _build_candidats_map(df):
@@ -4253,17 +5778,25 @@ elif page == "🏛️ Organigramme Cap25":
                         res[poste].append(affiche)
                 return res
 
-            def _find_candidats(candidats_map, poste_key):
-                if not poste_key:
-                    return []
-                pk = poste_key.lower().strip()
-                for k, v in candidats_map.items():
-                    if k.lower().strip() == pk or pk in k.lower() or k.lower() in pk:
-                        return v
-                return []
+            def _find_candidats(candidats_lookup, poste_key):
+                return lookup_poste(candidats_lookup, poste_key, [])
+
+            # ── Effectifs utilisés par une direction (clé du cache Graphviz) ──
+            def _staffing(org, candidats_lookup, postes_lookup):
+                """node_id → (mobile, total, vacants, candidats) pour chaque poste de la direction"""
+                res = {}
+                for node_id, nd in org["nodes"].items():
+                    if nd.get("type", "poste") in ("top", "group"):
+                        continue
+                    poste_key = nd.get("poste")
+                    res[node_id] = (
+                        *_get_poste_info(poste_key, postes_lookup),
+                        tuple(_find_candidats(candidats_lookup, poste_key)),
+                    )
+                return res
 
             # ── Génération du graphe DOT ──────────────────────────────────────
-            def _build_dot(direction_key, org, candidats_map, postes_df, c):
+            def _build_dot(direction_key, org, staffing, c):
                 dot = _gv.Digraph(
                     comment=direction_key,
                     graph_attr={
@@ -4290,7 +5823,6 @@ elif page == "🏛️ Organigramme Cap25":
 
                 for node_id, nd in org["nodes"].items():
                     label     = nd["label"]
-                    poste_key = nd.get("poste")
                     ntype     = nd.get("type", "poste")
 
                     if ntype == "top":
@@ -4309,8 +5841,7 @@ elif page == "🏛️ Organigramme Cap25":
 
                     else:
                         # Poste opérationnel
-                        mobile, total, vacants = _get_poste_info(poste_key, postes_df)
-                        candidats = _find_candidats(candidats_map, poste_key)
+                        mobile, total, vacants, candidats = staffing[node_id]
 
                         # Construction du label enrichi
                         suffix_parts = []
@@ -4407,13 +5938,18 @@ elif page == "🏛️ Organigramme Cap25":
             """, unsafe_allow_html=True)
 
             # Calcul des candidats
-            _candidats_map = _build_candidats_map(collaborateurs_df)
-            _nb_retenus = sum(len(v) for v in _candidats_map.values())
+            # Résolveurs des libellés de poste : une fois par version des données
+            _candidats_lookup = derived_dataset(
+                SHEET_URL, "retenus_dynamiques", ("cap2025",),
+                lambda collabs: build_poste_lookup(_build_candidats_map(collabs)),
+                copy=False, defaults=(collaborateurs_df,)
+            )
+            _postes_lookup = get_postes_lookup(SHEET_URL, postes_df)
+            _nb_retenus = sum(len(v) for v in _candidats_lookup["map"].values())
 
             # KPIs globaux
             _total_postes_mob = int(postes_df[postes_df["Mobilité interne"].str.lower() == "oui"]["Nombre total de postes"].sum()) if not postes_df.empty else 0
-            _col_vac = next((c for c in postes_df.columns if c.strip() == "Nombre de postes vacants"), None)
-            _total_vacants    = postes_df[_col_vac].fillna(0).astype(float).sum() if (not postes_df.empty and _col_vac) else 0
+            _total_vacants    = postes_df["Nombre de postes vacants"].fillna(0).sum() if (not postes_df.empty and "Nombre de postes vacants" in postes_df.columns) else 0
 
             m1, m2, m3 = st.columns(3)
             m1.metric("👥 Candidats positionnés (Vœux Retenu)", _nb_retenus)
@@ -4435,10 +5971,24 @@ elif page == "🏛️ Organigramme Cap25":
                 {_org_data['subtitle']}
             </p>""", unsafe_allow_html=True)
 
-            # Génération et affichage
+            # Génération et affichage (DOT et SVG en cache tant que les effectifs de la direction sont inchangés)
+            _staffings = {}
+
+            def _entry(_dk):
+                if _dk not in _staffings:
+                    _staffings[_dk] = _staffing(_ORGS[_dk], _candidats_lookup, _postes_lookup)
+                return graphviz_entry(
+                    _dk, staffing_hash(_staffings[_dk]),
+                    lambda: _build_dot(_dk, _ORGS[_dk], _staffings[_dk], _C).source
+                )
+
             with st.spinner("Génération de l'organigramme…"):
-                _dot = _build_dot(_dir_sel, _org_data, _candidats_map, postes_df, _C)
-                st.graphviz_chart(_dot.source, use_container_width=True)
+                _gv_entry = _entry(_dir_sel)
+                try:
+                    st.image(graphviz_render(_gv_entry, "svg").decode("utf-8"), use_container_width=True)
+                except Exception:
+                    # Binaire `dot` indisponible côté serveur : mise en page dans le navigateur
+                    st.graphviz_chart(_gv_entry["dot"], use_container_width=True)
 
             # Tableau récapitulatif
             st.divider()
@@ -4447,8 +5997,11 @@ elif page == "🏛️ Organigramme Cap25":
             for nid, nd in _org_data["nodes"].items():
                 if nd.get("type") in ("top", "poste") and nd.get("poste"):
                     pk = nd["poste"]
-                    mobile, total, vacants = _get_poste_info(pk, postes_df)
-                    cands = _find_candidats(_candidats_map, pk)
+                    if nid in _staffings[_dir_sel]:
+                        mobile, total, vacants, cands = _staffings[_dir_sel][nid]
+                    else:
+                        mobile, total, vacants = _get_poste_info(pk, _postes_lookup)
+                        cands = _find_candidats(_candidats_lookup, pk)
                     statut = "✅ Pourvu" if cands else ("⬜ Vacant" if (mobile and vacants>0) else "— Non-mobile")
                     _recap_rows.append({
                         "Poste": nd["label"].replace("\\n", " ").replace("\n", " "),
@@ -4471,6 +6024,8 @@ elif page == "🏛️ Organigramme Cap25":
                     use_container_width=True,
                 )
 
+            show_ambiguous_postes(_candidats_lookup, _postes_lookup)
+
             # ── Export PDF ────────────────────────────────────────────────────
             st.divider()
             st.markdown("#### 📥 Export PDF")
@@ -4495,11 +6050,10 @@ elif page == "🏛️ Organigramme Cap25":
                         try:
                             import io as _io
 
-                            # Générer un PDF par direction
-                            _pdf_pages = []
-                            for _dk in _dirs_to_export:
-                                _d = _build_dot(_dk, _ORGS[_dk], _candidats_map, postes_df, _C)
-                                _pdf_pages.append(_d.pipe(format="pdf"))
+                            # Un PDF par direction : cache, sinon mise en page en parallèle
+                            _pdf_pages = graphviz_render_many(
+                                [_entry(_dk) for _dk in _dirs_to_export], "pdf"
+                            )
 
                             # Fusionner si plusieurs pages
                             if len(_pdf_pages) == 1:
@@ -4606,14 +6160,8 @@ elif page == "🚀✨ Commission RH":
     taux_postes_pourvus = (nb_collaborateurs_retenus / total_postes_ouverts * 100) if total_postes_ouverts > 0 else 0
     
     # 5. Postes saturés (Quota atteint)
-    postes_satures = 0
     df_mobi = postes_df[postes_df["Mobilité interne"].str.lower() == "oui"]
-    for _, poste_row in df_mobi.iterrows():
-        p_name = str(poste_row["Poste"]).strip()
-        quota = int(poste_row.get("Nombre total de postes", 0))
-        nb_retenus = collaborateurs_df[v_retenu_clean == p_name].shape[0]
-        if nb_retenus >= quota:
-            postes_satures += 1
+    postes_satures = compter_postes_satures(df_mobi, v_retenu_clean)
             
     candidats_en_attente = collaborateurs_df[v_retenu_clean == ''].shape[0]
 
@@ -4747,13 +6295,7 @@ elif page == "🚀✨ Commission RH":
         f_nb_retenus = df_kpi_filtre[v_retenu_clean_f != ''].shape[0]
         f_taux_postes_pourvus = (f_nb_retenus / total_postes_ouverts * 100) if total_postes_ouverts > 0 else 0
 
-        f_postes_satures = 0
-        for _, poste_row in df_mobi.iterrows():
-            p_name = str(poste_row["Poste"]).strip()
-            quota = int(poste_row.get("Nombre total de postes", 0))
-            nb_r = df_kpi_filtre[v_retenu_clean_f == p_name].shape[0]
-            if nb_r >= quota:
-                f_postes_satures += 1
+        f_postes_satures = compter_postes_satures(df_mobi, v_retenu_clean_f)
 
         f_candidats_en_attente = df_kpi_filtre[v_retenu_clean_f == ''].shape[0]
 
@@ -4835,101 +6377,27 @@ elif page == "🚀✨ Commission RH":
         filtre_statut_commission = st.multiselect("Statut Poste", options=["🟢 POURVU 💯", "⚠️ Poste totalement vacant", "🟠 Presque pourvu", "🔴 Disponible"], key="statut_comm")
 
 # --- CONSTRUCTION DES DONNÉES DU TABLEAU ---
-    commission_data = []
-
-    for _, poste_row in postes_df[postes_df["Mobilité interne"].str.lower() == "oui"].iterrows():
-        poste_name = poste_row["Poste"]
-        direction = poste_row["Direction"]
-        quota = int(poste_row.get("Nombre total de postes", 0))
-
-        if filtre_direction_commission and direction not in filtre_direction_commission: continue
-        if filtre_poste_commission and poste_name not in filtre_poste_commission: continue
-
-        retenus_df = collaborateurs_df[collaborateurs_df['Vœux Retenu'] == poste_name]
-        nb_retenus = len(retenus_df)
-        liste_retenus = [f"{get_safe_value(ret.get('Prénom', ''))} {get_safe_value(ret.get('NOM', ''))}" for _, ret in retenus_df.iterrows()]
-
-        # Collaborateurs dont "Proposition Comité de mobilité" cible ce poste
-        col_proposition = "Proposition Comité de mobilité"
-        if col_proposition in collaborateurs_df.columns:
-            df_prop = collaborateurs_df[
-                collaborateurs_df[col_proposition].fillna('').astype(str).str.strip() == poste_name
-            ]
-            noms_proposition = [
-                f"{get_safe_value(r.get('Prénom', ''))} {get_safe_value(r.get('NOM', ''))}".strip()
-                for _, r in df_prop.iterrows()
-            ]
-            noms_proposition_clean = [n for n in noms_proposition if n]
-            proposition_comite = "; ".join(noms_proposition_clean)
-            nb_proposition_comite = len(noms_proposition_clean)  # ← NOUVEAU
-        else:
-            proposition_comite = ""
-            nb_proposition_comite = 0  # ← NOUVEAU
-
-        candidats_v1, candidats_v2, candidats_v3, candidats_v4 = [], [], [], []
-        
-        for _, collab in collaborateurs_df.iterrows():
-            if get_safe_value(collab.get('Vœux Retenu', '')): continue 
-            
-            nom_complet = f"{get_safe_value(collab.get('Prénom', ''))} {get_safe_value(collab.get('NOM', ''))}"
-            prio = get_safe_value(collab.get('Priorité', ''))
-            mat = get_safe_value(collab.get('Matricule', ''))
-
-            if filtre_priorite_commission and prio not in filtre_priorite_commission: continue
-
-            c_info = {'nom': nom_complet, 'priorite': prio, 'matricule': mat}
-            
-            if get_safe_value(collab.get('Vœux 1', '')) == poste_name: candidats_v1.append(c_info)
-            if get_safe_value(collab.get('Vœux 2', '')) == poste_name: candidats_v2.append(c_info)
-            if get_safe_value(collab.get('Voeux 3', '')) == poste_name: candidats_v3.append(c_info)
-            if get_safe_value(collab.get('Voeux 4', '')) == poste_name: candidats_v4.append(c_info)
-
-        # Détermination du Statut
-        places_restantes = quota - nb_retenus
-        if nb_retenus >= quota: statut = "🟢 POURVU 💯"
-        elif nb_retenus == 0: statut = "⚠️ Poste totalement vacant"
-        elif places_restantes <= 2: statut = "🟠 Presque pourvu"
-        else: statut = "🔴 Disponible"
-
-        format_names = lambda l: "; ".join([c['nom'] for c in l])
-
-        commission_data.append({
-            "Statut": statut,
-            "Poste": poste_name,
-            "Direction": direction,
-            "Quota": quota,
-            "Retenus": nb_retenus,
-            "Places": places_restantes,
-            "Nbre Prop CM": nb_proposition_comite,  # ← NOUVEAU
-            "Liste des retenus": "; ".join(liste_retenus),
-            "V1": len(candidats_v1),
-            "Candidats V1": format_names(candidats_v1),
-            "V2": len(candidats_v2),
-            "Candidats V2": format_names(candidats_v2),
-            "V3": len(candidats_v3),
-            "Candidats V3": format_names(candidats_v3),
-            "V4": len(candidats_v4),
-            "Candidats V4": format_names(candidats_v4),
-            "Proposition Comité de Mobilité": proposition_comite,
-            "Candidats_V1_Data": candidats_v1,
-            "Candidats_V2_Data": candidats_v2,
-            "Candidats_V3_Data": candidats_v3,
-            "Candidats_V4_Data": candidats_v4
-        })
-
-    df_commission = pd.DataFrame(commission_data)
+    # Une seule passe sur CAP 2025 (index poste → candidats), réutilisée pour le repositionnement
+    versions_commission = dict(DONNEES_VERSIONS)
+    df_commission, candidats_commission = build_commission_table(
+        postes_df, collaborateurs_df,
+        get_poste_candidate_index(SHEET_URL, collaborateurs_df, versions=versions_commission)["long"],
+        priorites=filtre_priorite_commission
+    )
+    if filtre_direction_commission:
+        df_commission = df_commission[df_commission["Direction"].isin(filtre_direction_commission)]
+    if filtre_poste_commission:
+        df_commission = df_commission[df_commission["Poste"].isin(filtre_poste_commission)]
 
     if not df_commission.empty:
         if filtre_statut_commission:
             df_commission = df_commission[df_commission['Statut'].isin(filtre_statut_commission)]
 
         if not df_commission.empty:
-            ordre_statut = {"🟢 POURVU 💯": 1, "🟠 Presque pourvu": 2, "🔴 Disponible": 3, "⚠️ Poste totalement vacant": 4}
-            df_commission['_ordre'] = df_commission['Statut'].map(ordre_statut)
-            df_commission = df_commission.sort_values(['_ordre', 'Direction', 'Poste']).drop(columns=['_ordre'])
+            df_commission = sort_commission_table(df_commission)
 
             st.dataframe(
-                df_commission.drop(columns=['Candidats_V1_Data', 'Candidats_V2_Data', 'Candidats_V3_Data', 'Candidats_V4_Data']),
+                df_commission,
                 use_container_width=True,
                 hide_index=True,
                 column_config={
@@ -4956,7 +6424,7 @@ elif page == "🚀✨ Commission RH":
             st.markdown("<br>", unsafe_allow_html=True)
             col_export1, col_export2 = st.columns([3, 1])
             commission_filtres_actifs = bool(filtre_direction_commission) or bool(filtre_poste_commission) or bool(filtre_priorite_commission) or bool(filtre_voeu_commission) or bool(filtre_statut_commission)
-            df_commission_export = df_commission.drop(columns=['Candidats_V1_Data', 'Candidats_V2_Data', 'Candidats_V3_Data', 'Candidats_V4_Data'])
+            df_commission_export = df_commission
 
             with col_export1:
                 if commission_filtres_actifs:
@@ -4966,7 +6434,13 @@ elif page == "🚀✨ Commission RH":
                 paris_tz_exp = pytz.timezone('Europe/Paris')
                 export_time_comm = datetime.now(paris_tz_exp)
                 filename_comm = f"Commission_RH_{export_time_comm.strftime('%d-%m-%Y_%Hh%M')}.xlsx"
-                excel_data_comm = to_excel(df_commission_export)
+                excel_data_comm = excel_export(
+                    SHEET_URL, "commission", ("cap2025", "postes"), versions_commission,
+                    {"direction": filtre_direction_commission, "poste": filtre_poste_commission,
+                     "priorite": filtre_priorite_commission, "voeu": filtre_voeu_commission,
+                     "statut": filtre_statut_commission},
+                    df_commission_export
+                )
                 st.download_button(
                     label="📥 Télécharger en Excel",
                     data=excel_data_comm,
@@ -4979,23 +6453,10 @@ elif page == "🚀✨ Commission RH":
             st.divider()
             st.subheader("🔄 Candidats à Repositionner - Postes déjà pourvus")
             
-            candidats_a_repositionner = []
-            for _, row_comm in df_commission.iterrows():
-                if row_comm['Statut'] == "🟢 POURVU 💯":
-                    p_sature = row_comm['Poste']
-                    for label, key in [("Vœu 1", 'Candidats_V1_Data'), ("Vœu 2", 'Candidats_V2_Data'), ("Vœu 3", 'Candidats_V3_Data'), ("Vœu 4", 'Candidats_V4_Data')]:
-                        for cand in row_comm[key]:
-                            candidats_a_repositionner.append({
-                                'Nom': cand['nom'],
-                                'Poste pourvu': p_sature,
-                                'Vœu bloqué': label,
-                                'Priorité': cand['priorite'],
-                                'Matricule': cand['matricule']
-                            })
-
-            if candidats_a_repositionner:
-                df_repo = pd.DataFrame(candidats_a_repositionner)
-                df_repo['Vœux alternatifs'] = df_repo.apply(lambda r: get_voeux_alternatifs(collaborateurs_df, r['Matricule'], r['Vœu bloqué']), axis=1)
+            # Candidats en attente sur les postes pourvus, dans l'ordre du tableau puis du vœu
+            df_repo = build_repositionnement_table(df_commission, candidats_commission, collaborateurs_df)
+
+            if not df_repo.empty:
                 st.warning(f"⚠️ **{len(df_repo)} candidat(s)** à repositionner car leur vœu cible un poste déjà pourvu")
                 st.dataframe(df_repo.drop(columns=['Matricule']), use_container_width=True, hide_index=True)
             else:
@@ -5047,16 +6508,11 @@ elif page == "🚀✨ Commission RH":
     entretiens_realises = 0
     entretiens_aujourd_hui = 0
 
-    for _, row in df_entretiens_kpi.iterrows():
-        date_rdv = parse_date(get_safe_value(row.get('Date de rdv', '')))
-        if date_rdv:
-            total_entretiens += 1
-            if date_rdv > today:
-                entretiens_a_venir += 1
-            elif date_rdv < today:
-                entretiens_realises += 1
-            elif date_rdv == today:
-                entretiens_aujourd_hui += 1
+    dates_rdv = df_entretiens_kpi[COL_DATE_RDV]
+    total_entretiens = int(dates_rdv.notna().sum())
+    entretiens_a_venir = int((dates_rdv > pd.Timestamp(today)).sum())
+    entretiens_realises = int((dates_rdv < pd.Timestamp(today)).sum())
+    entretiens_aujourd_hui = int((dates_rdv == pd.Timestamp(today)).sum())
 
     taux_realises = (entretiens_realises / total_entretiens * 100) if total_entretiens > 0 else 0
 
@@ -5117,30 +6573,16 @@ elif page == "🚀✨ Commission RH":
 
     # Filtrer par statut sélectionné
     if statut_entretien == "À venir":
-        df_table = df_table[df_table['Date de rdv'].apply(lambda x: parse_date(x) > today if parse_date(x) else False)]
+        df_table = df_table[df_table[COL_DATE_RDV] > pd.Timestamp(today)]
     elif statut_entretien == "Réalisés":
-        df_table = df_table[df_table['Date de rdv'].apply(lambda x: parse_date(x) < today if parse_date(x) else False)]
+        df_table = df_table[df_table[COL_DATE_RDV] < pd.Timestamp(today)]
     elif statut_entretien == "Aujourd'hui":
-        df_table = df_table[df_table['Date de rdv'].apply(lambda x: parse_date(x) == today if parse_date(x) else False)]
+        df_table = df_table[df_table[COL_DATE_RDV] == pd.Timestamp(today)]
 
     # Préparation finale pour affichage
-    entretiens_display = []
-    for _, row in df_table.iterrows():
-        date_val = get_safe_value(row.get('Date de rdv', ''))
-        if date_val and date_val.strip() != '':
-            entretiens_display.append({
-                'Date': date_val,
-                'Heure': get_safe_value(row.get('Heure de rdv', '')),
-                'Collaborateur': f"{get_safe_value(row.get('Prénom', ''))} {get_safe_value(row.get('NOM', ''))}".upper(),
-                'Direction': get_safe_value(row.get('Direction libellé', '')),
-                'RRH': get_safe_value(row.get('Référente RH', '')),
-                'Vœu Retenu': get_safe_value(row.get('Vœux Retenu', '')),
-                'Mail': get_safe_value(row.get('Mail', '')),
-                'Priorité': get_safe_value(row.get('Priorité', ''))
-            })
+    df_final = build_entretiens_table(df_table)
 
-    if entretiens_display:
-        df_final = pd.DataFrame(entretiens_display).sort_values(by=['Date', 'Heure'])
+    if not df_final.empty:
         
         st.write(f"🔍 **{len(df_final)}** entretien(s) trouvé(s)")
         st.dataframe(
@@ -5159,7 +6601,11 @@ elif page == "🚀✨ Commission RH":
         # Export harmonisé
         col_exp1, col_exp2 = st.columns([4, 1])
         with col_exp2:
-            excel_data = to_excel(df_final)
+            excel_data = excel_export(
+                SHEET_URL, "entretiens", ("cap2025",), DONNEES_VERSIONS,
+                {"direction": filtre_direction_entretien, "statut": statut_entretien, "jour": today},
+                df_final
+            )
             st.download_button(
                 label="📥 Exporter la liste (.xlsx)",
                 data=excel_data,
@@ -5170,6 +6616,40 @@ elif page == "🚀✨ Commission RH":
     else:
         st.info("ℹ️ Aucun entretien ne correspond à vos critères de recherche.")
 
+# --- ÉTAT DE LA SAUVEGARDE (SIDEBAR) ---
+with save_status_placeholder.container():
+    save_status = None
+    if st.session_state.current_matricule:
+        save_status = get_entretien_save_status(SHEET_URL, st.session_state.current_matricule)
+        if save_status and save_status.get("flushed_at"):
+            st.session_state.last_save_time = save_status["flushed_at"]
+
+    if st.session_state.last_save_time:
+        st.caption(f"💾 Sauvegarde : {st.session_state.last_save_time.strftime('%H:%M:%S')}")
+    if save_status and save_status["state"] in ("pending", "writing"):
+        if save_status.get("error"):
+            st.caption(
+                f"⚠️ Échec de sauvegarde, nouvelle tentative automatique "
+                f"({save_status['attempts']}/{AUTOSAVE_MAX_ATTEMPTS})"
+            )
+        else:
+            st.caption("⏳ Modifications en attente d'enregistrement…")
+    elif save_status and save_status["state"] == "error":
+        st.error(f"❌ Modifications non enregistrées : {save_status['error']}")
+
+# --- CONSOMMATION DU QUOTA GOOGLE SHEETS (SIDEBAR) ---
+with st.sidebar.expander("📈 Quota Google Sheets", expanded=False):
+    for kind, label in (("read", "Lectures"), ("write", "Écritures")):
+        usage = get_sheets_usage()[kind]
+        st.caption(
+            f"**{label}** : {usage['last_minute']}/{usage['quota']} sur la dernière minute · "
+            f"{usage['tokens']:.0f} jeton(s) disponible(s) · {usage['queued']} en attente · "
+            f"attente moyenne {usage['avg_wait']:.1f} s · 429 reçus : {usage['throttled']}"
+        )
+    memoire = get_data_store(SHEET_URL)["memoire"].get("cap2025")
+    if memoire:
+        st.caption(f"**Mémoire CAP 2025** : {memoire[0] / 1e6:.1f} Mo → {memoire[1] / 1e6:.1f} Mo (catégories)")
+
 # --- FOOTER ---
 st.divider()
 
@@ -0,0 +1,145 @@
+"""
+Écriture des exports Excel de l'application (classeur openpyxl en écriture seule).
+
+Module séparé de app_rh_cloud.py pour pouvoir mesurer l'export sans exécuter
+l'application Streamlit : `python export_excel.py [lignes ...]` compare le débit
+(lignes/s) de to_excel à celui de l'ancienne écriture par pd.ExcelWriter.
+Aucun appel Streamlit ici.
+"""
+import io
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def _write_sheet(workbook, titre, df):
+    """
+    Ajoute au classeur (écriture seule) une feuille `titre` contenant `df` :
+    lignes écrites en flux, largeurs de colonnes calculées sur le DataFrame,
+    seuls les en-têtes sont mis en forme.
+    """
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, PatternFill, Alignment
+    from openpyxl.utils import get_column_letter
+
+    worksheet = workbook.create_sheet(titre)
+
+    # Valeurs Python natives, cellules vides pour NaN / NA
+    valeurs = df.astype(object).where(df.notna(), None)
+
+    # Auto-ajuster la largeur des colonnes (longueurs de chaînes vectorisées)
+    for position, col in enumerate(valeurs.columns, start=1):
+        max_length = len(str(col))
+        if len(valeurs):
+            serie = valeurs.iloc[:, position - 1]
+            max_length = max(max_length, int(serie.astype(str).where(serie.notna(), "").str.len().max()))
+        worksheet.column_dimensions[get_column_letter(position)].width = min(max_length + 2, 50)
+
+    # Formatage des en-têtes
+    header_fill = PatternFill(start_color="008080", end_color="008080", fill_type="solid")
+    header_font = Font(bold=True, color="FFFFFF")
+    header_alignment = Alignment(horizontal="center", vertical="center")
+    entetes = []
+    for col in valeurs.columns:
+        cell = WriteOnlyCell(worksheet, value=str(col))
+        cell.fill = header_fill
+        cell.font = header_font
+        cell.alignment = header_alignment
+        entetes.append(cell)
+    worksheet.append(entetes)
+
+    for ligne in valeurs.itertuples(index=False, name=None):
+        worksheet.append(ligne)
+
+
+def to_excel_sheets(feuilles):
+    """Classeur Excel en mémoire, une feuille formatée par entrée de {titre: DataFrame}"""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    for titre, df in feuilles.items():
+        _write_sheet(workbook, titre, df)
+
+    output = io.BytesIO()
+    workbook.save(output)
+    return output.getvalue()
+
+
+def to_excel(df):
+    """Convertit un DataFrame en fichier Excel en mémoire avec formatage"""
+    return to_excel_sheets({"Données": df})
+
+
+def _to_excel_excelwriter(df):
+    """Ancienne écriture (pd.ExcelWriter puis relecture de chaque cellule), référence du benchmark"""
+    from openpyxl.styles import Font, PatternFill, Alignment
+
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name='Données')
+        worksheet = writer.sheets['Données']
+
+        header_fill = PatternFill(start_color="008080", end_color="008080", fill_type="solid")
+        header_font = Font(bold=True, color="FFFFFF")
+        for cell in worksheet[1]:
+            cell.fill = header_fill
+            cell.font = header_font
+            cell.alignment = Alignment(horizontal="center", vertical="center")
+
+        for column in worksheet.columns:
+            max_length = 0
+            column_letter = column[0].column_letter
+            for cell in column:
+                try:
+                    if len(str(cell.value)) > max_length:
+                        max_length = len(str(cell.value))
+                except:
+                    pass
+            worksheet.column_dimensions[column_letter].width = min(max_length + 2, 50)
+
+    return output.getvalue()
+
+
+def _jeu_benchmark(lignes, colonnes=76, graine=0):
+    """DataFrame de colonnes mixtes (texte, entiers, flottants avec NaN), comme l'onglet Entretien"""
+    rng = np.random.default_rng(graine)
+    donnees = {}
+    for position in range(colonnes):
+        if position % 3 == 0:
+            donnees[f"Texte {position}"] = [f"Réponse {v} " * (v % 7) for v in rng.integers(0, 1000, lignes)]
+        elif position % 3 == 1:
+            donnees[f"Entier {position}"] = rng.integers(0, 10_000, lignes)
+        else:
+            serie = rng.random(lignes) * 100
+            serie[rng.random(lignes) < 0.2] = np.nan
+            donnees[f"Flottant {position}"] = serie
+    return pd.DataFrame(donnees)
+
+
+def benchmark(tailles=(500, 3000), colonnes=76, repetitions=3):
+    """
+    Débit de to_excel comparé à l'ancienne écriture, meilleur temps sur `repetitions`.
+    Retourne {lignes: {"excelwriter": secondes, "to_excel": secondes}}.
+    """
+    resultats = {}
+    for lignes in tailles:
+        df = _jeu_benchmark(lignes, colonnes)
+        resultats[lignes] = {}
+        for nom, fonction in (("excelwriter", _to_excel_excelwriter), ("to_excel", to_excel)):
+            temps = []
+            for _ in range(repetitions):
+                debut = time.perf_counter()
+                fonction(df)
+                temps.append(time.perf_counter() - debut)
+            resultats[lignes][nom] = min(temps)
+    return resultats
+
+
+if __name__ == "__main__":
+    tailles = tuple(int(arg) for arg in sys.argv[1:]) or (500, 3000)
+    for lignes, temps in benchmark(tailles).items():
+        avant, apres = temps["excelwriter"], temps["to_excel"]
+        print(f"{lignes} lignes : {lignes / avant:.0f} → {lignes / apres:.0f} lignes/s "
+              f"({avant:.2f} s → {apres:.2f} s)")
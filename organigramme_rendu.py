@@ -0,0 +1,86 @@
+"""
+Rendu des pages d'organigrammes annotés (badges des candidats retenus).
+
+Module séparé de app_rh_cloud.py : les processus de l'export PDF complet
+l'importent sans exécuter l'application Streamlit. Aucun appel Streamlit ici.
+"""
+import io
+import os
+
+from PIL import Image, ImageDraw, ImageFont
+
+# État propre à chaque processus de l'export :
+# documents PDF ouverts une fois ((chemin, date de modification) → PdfDocument)
+# et contenu des fichiers de police (chemin → octets, None si introuvable)
+_documents = {}
+_polices = {}
+
+
+def police(data, size):
+    """Police TrueType créée depuis les octets du fichier (police par défaut de Pillow si absente)"""
+    if data is not None:
+        try:
+            return ImageFont.truetype(io.BytesIO(data), size)
+        except Exception:
+            pass
+    return ImageFont.load_default()
+
+
+def compose_badges(img, positions, noms, scale, fb, fr):
+    """
+    Compose les badges (retenu / vacant) sur une page de base et retourne le PNG.
+    `noms` : {boîte: noms retenus, None si vacant}, résolus par l'appelant.
+    """
+    ov   = Image.new("RGBA", img.size, (0,0,0,0))
+    d    = ImageDraw.Draw(ov, "RGBA")
+
+    badge_h = max(22, int(22 * scale))
+    for pos_name, (px, py, pw, ph) in positions.items():
+        x1, y1 = int(px*scale), int(py*scale)
+        x2, y2 = int((px+pw)*scale), int((py+ph)*scale)
+        noms_boite = noms.get(pos_name)
+        if noms_boite is None:
+            d.rectangle([x1, y2-badge_h, x2, y2], fill=(160,160,160,195))
+            d.text((x1+6, y2-badge_h+4), "Poste vacant", fill=(70,70,70,240), font=fr)
+        else:
+            d.rectangle([x1, y2-badge_h, x2, y2], fill=(0,175,152,218))
+            label = "  ·  ".join(noms_boite)
+            max_c = max(1, int((x2-x1-14)/8))
+            if len(label) > max_c:
+                label = label[:max_c-1] + "…"
+            d.text((x1+6, y2-badge_h+4), f"✓ {label}", fill=(255,255,255,255), font=fb)
+
+    out = Image.alpha_composite(img, ov).convert("RGB")
+    buf = io.BytesIO()
+    out.save(buf, format="PNG", compress_level=1)
+    buf.seek(0)
+    return buf.read()
+
+
+def _police_processus(path, size):
+    if path not in _polices:
+        try:
+            with open(path, "rb") as f:
+                _polices[path] = f.read()
+        except OSError:
+            _polices[path] = None
+    return police(_polices[path], size)
+
+
+def render_page(pdf_path, page_idx, scale, positions, noms, font_bold, font_reg):
+    """
+    Rendu complet d'une page dans un processus de l'export : rastérisation
+    (document ouvert une fois par processus), badges, PNG.
+    """
+    import pypdfium2 as pdfium
+
+    key = (pdf_path, os.path.getmtime(pdf_path))
+    doc = _documents.get(key)
+    if doc is None:
+        doc = _documents[key] = pdfium.PdfDocument(pdf_path)
+    img = doc[page_idx].render(scale=scale).to_pil().convert("RGBA")
+    return compose_badges(
+        img, positions, noms, scale,
+        _police_processus(font_bold, max(10, int(13 * scale))),
+        _police_processus(font_reg,  max(9, int(11 * scale)))
+    )